@@ -0,0 +1,9 @@
+"""
+Benchmarks of schedcaster hot paths. Run a benchmark as a module, e.g.:
+
+    python -m benchmarks.engine 10000 100000 1000000
+
+or run all of them and keep the results as JSON:
+
+    python -m benchmarks --out=results.json
+"""
@@ -0,0 +1,97 @@
+"""
+Runs benchmarks and writes their results as JSON, so that runs may be
+compared with each other.
+
+    python -m benchmarks [name ...] [--quick] [--out=results.json]
+                         [--baseline=previous.json]
+
+Names are modules of the package, all of them are run if none is given.
+--quick runs small sizes only, --baseline prints changes against the
+results of an earlier run.
+"""
+
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+
+BENCHMARKS = ('config', 'scheduler', 'caster', 'parser', 'engine')
+# arguments of benchmarks in the quick mode
+QUICK = {
+    'config': ['2000'],
+    'scheduler': ['2000'],
+    'caster': ['500'],
+    'parser': ['2000'],
+    'engine': ['10000'],
+}
+
+
+def environment():
+    '''Describes where the benchmarks were run'''
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'revision': revision,
+    }
+
+
+def compare(baseline, results):
+    '''Prints relative changes of numeric results against a baseline'''
+    for name, runs in sorted(results.items()):
+        for index, (old, new) in enumerate(zip(baseline.get(name, []),
+                                               runs)):
+            for key, value in sorted(new.items()):
+                previous = old.get(key)
+                if isinstance(value, bool) or \
+                   not isinstance(value, (int, float)) or \
+                   not isinstance(previous, (int, float)) or not previous:
+                    continue
+                print("%s[%d].%s: %.4g -> %.4g (%+.1f%%)" % (
+                    name, index, key, previous, value,
+                    (value - previous) * 100.0 / previous))
+
+
+def main(argv):
+    names = [arg for arg in argv if not arg.startswith('--')] or BENCHMARKS
+    options = dict((arg[2:] + '=').split('=')[:2] for arg in argv
+                   if arg.startswith('--'))
+    quick = 'quick' in options
+    results = {}
+    for name in names:
+        if name not in BENCHMARKS:
+            raise RuntimeError("unknown benchmark: %s" % name)
+        print("== %s" % name)
+        module = importlib.import_module('benchmarks.' + name)
+        try:
+            results[name] = module.main(quick and QUICK[name] or [])
+        except ImportError as e:
+            print("skipping %s: %s" % (name, e))
+
+    report = {'environment': environment(), 'quick': quick,
+              'results': results}
+    if options.get('out'):
+        with open(options['out'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if options.get('baseline'):
+        with open(options['baseline']) as f:
+            compare(json.load(f)['results'], results)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,142 @@
+"""
+Measures fan-out of Caster.send: calls per second made to several
+consumers of a local fake VK endpoint, and latency of the calls, for the
+thread pool caster and, if aiohttp is installed, the asyncio one.
+
+    python -m benchmarks.caster [messages ...] [--consumers=n]
+                                [--latency=seconds] [--threads=n]
+"""
+
+import asyncio
+import sys
+import threading
+import time
+
+from schedcaster.caster.multicaster import Caster
+from benchmarks.fakevk import FakeVK, HTTPConsumer
+
+SIZES = (1000, 10000)
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {
+        'latencyP50': latencies[len(latencies) // 2],
+        'latencyP99': latencies[int(len(latencies) * 0.99)],
+        'latencyMax': latencies[-1],
+    }
+
+
+def benchCaster(messages, consumers=3, latency=0.02, threads=32):
+    fake = FakeVK(latency).start()
+    try:
+        caster = Caster(maxThreads=threads)
+        for i in range(consumers):
+            caster.attach(HTTPConsumer(fake.url, owner=str(i)))
+        lock = threading.Lock()
+        latencies = []
+        done = threading.Event()
+        calls = messages * consumers
+
+        def onResult(sent):
+            def callback(result):
+                with lock:
+                    latencies.append(time.time() - sent)
+                    if len(latencies) == calls:
+                        done.set()
+            return callback
+
+        started = time.time()
+        for i in range(messages):
+            caster.send(onResult(time.time()), "post %d" % i)
+        sent = time.time() - started
+        done.wait()
+        elapsed = time.time() - started
+        caster.stop()
+
+        result = {
+            'caster': 'threads',
+            'messages': messages,
+            'consumers': consumers,
+            'threads': threads,
+            'fakeLatency': latency,
+            'sendPerSec': messages / sent,
+            'callsPerSec': calls / elapsed,
+        }
+        result.update(percentiles(latencies))
+        return result
+    finally:
+        fake.stop()
+
+
+def benchAsyncCaster(messages, consumers=3, latency=0.02, concurrency=1000):
+    from schedcaster.caster.asynccaster import AsyncCaster
+    from schedcaster.consumer.asyncvk import Consumer
+
+    fake = FakeVK(latency).start()
+
+    async def run():
+        caster = AsyncCaster(maxConcurrency=concurrency)
+        attached = []
+        for i in range(consumers):
+            consumer = Consumer('token', owner=str(i))
+            consumer.url = fake.url
+            caster.attach(consumer)
+            attached.append(consumer)
+        latencies = []
+
+        def onResult(sent):
+            return lambda result: latencies.append(time.time() - sent)
+
+        started = time.time()
+        tasks = []
+        for i in range(messages):
+            tasks.extend(caster.send(onResult(time.time()), "post %d" % i))
+        sent = time.time() - started
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.time() - started
+        await caster.stop()
+        for consumer in attached:
+            await consumer.close()
+        return sent, elapsed, latencies
+
+    try:
+        sent, elapsed, latencies = asyncio.run(run())
+        result = {
+            'caster': 'asyncio',
+            'messages': messages,
+            'consumers': consumers,
+            'concurrency': concurrency,
+            'fakeLatency': latency,
+            'sendPerSec': messages / sent,
+            'callsPerSec': messages * consumers / elapsed,
+        }
+        result.update(percentiles(latencies))
+        return result
+    finally:
+        fake.stop()
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv if not arg.startswith('--')] or SIZES
+    options = dict(arg[2:].split('=', 1) for arg in argv
+                   if arg.startswith('--') and '=' in arg)
+    consumers = int(options.get('consumers', 3))
+    latency = float(options.get('latency', 0.02))
+    threads = int(options.get('threads', 32))
+    results = []
+    for n in sizes:
+        results.append(benchCaster(n, consumers, latency, threads))
+        print(results[-1])
+        try:
+            results.append(benchAsyncCaster(n, consumers, latency))
+            print(results[-1])
+        except ImportError as e:
+            print("skipping asyncio caster: %s" % e)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+"""
+Measures Config throughput: entries saved one by one and in bulk, and
+entries loaded by get, getActive and getDue, with and without the entry
+cache.
+
+    python -m benchmarks.config [n ...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from schedcaster.config.sqlite import Config
+from benchmarks.generators import makeEntries
+
+SIZES = (10000, 100000)
+# saving entries one by one is slow, so only that many of them are saved
+MAX_SINGLE_SAVES = 5000
+
+
+def timed(fn, *args):
+    started = time.time()
+    result = fn(*args)
+    return result, time.time() - started
+
+
+def bench(n):
+    directory = tempfile.mkdtemp()
+    try:
+        entries = makeEntries(n)
+        config = Config(os.path.join(directory, 'bench.db'))
+
+        single = entries[:min(n, MAX_SINGLE_SAVES)]
+        _, saved = timed(lambda: [config.save(entry) for entry in single])
+        config.clear()
+        _, savedMany = timed(config.saveMany, entries)
+        # nothing is written, when nothing was changed
+        _, resaved = timed(config.saveMany, entries)
+
+        loaded, got = timed(config.get)
+        active, gotActive = timed(config.getActive)
+        ids = [entry.id for entry in entries[::10]]
+        _, gotIds = timed(config.get, ids)
+        due, gotDue = timed(config.getDue, time.time() + 60 * 60 * 24)
+        _, gotOne = timed(lambda: [config.get(id) for id in ids])
+        config.close()
+
+        cached = Config(os.path.join(directory, 'bench.db'),
+                        cacheSize=len(ids))
+        _, gotOneCold = timed(lambda: [cached.get(id) for id in ids])
+        _, gotOneCached = timed(lambda: [cached.get(id) for id in ids])
+        cached.close()
+
+        return {
+            'n': n,
+            'savePerSec': len(single) / saved,
+            'saveManyPerSec': n / savedMany,
+            'unchangedSaveManyPerSec': n / resaved,
+            'getPerSec': len(loaded) / got,
+            'getActivePerSec': len(active) / gotActive,
+            'getActiveSeconds': gotActive,
+            'getByIdsPerSec': len(ids) / gotIds,
+            'getOnePerSec': len(ids) / gotOne,
+            'cachedGetOneColdPerSec': len(ids) / gotOneCold,
+            'cachedGetOnePerSec': len(ids) / gotOneCached,
+            'getDueDay': len(due),
+            'getDueSeconds': gotDue,
+            'dbBytes': os.path.getsize(os.path.join(directory, 'bench.db')),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or SIZES
+    results = []
+    for n in sizes:
+        results.append(bench(n))
+        print(results[-1])
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
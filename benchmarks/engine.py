@@ -0,0 +1,128 @@
+"""
+Compares scheduling backends: time to add and remove n cron jobs, memory
+taken by the jobs and the rate at which due jobs are dispatched.
+
+    python -m benchmarks.engine [n ...] [--backend=heap|apscheduler]
+"""
+
+import datetime
+import gc
+import sys
+import threading
+import time
+import tracemalloc
+
+from schedcaster import cron as Cron
+
+SIZES = (10000, 100000, 1000000)
+# a mix of crons, that share fields the way real schedules do
+CRONS = ('0 0 12 * * * *', '0 30 9 * * * mon-fri', '*/15 * * * * * *',
+         '0 0 0 1 * * *')
+
+
+def makeBackend(name):
+    if name == 'heap':
+        from schedcaster.engine import HeapScheduler
+        return HeapScheduler(misfire_grace_time=60)
+    import apscheduler.scheduler as apscheduler
+    return apscheduler.Scheduler(misfire_grace_time=60)
+
+
+def oneShotCron(i):
+    # distinct one-shots spread over the next year, like scheduled posts
+    fire = datetime.datetime.now() + datetime.timedelta(minutes=10 + i % 500000)
+    return "%d %d %d %d %d %d *" % (fire.second, fire.minute, fire.hour,
+                                    fire.day, fire.month, fire.year)
+
+
+def benchAdd(backendName, n):
+    backend = makeBackend(backendName)
+    backend.start()
+    crons = [i % 2 and CRONS[i % len(CRONS)] or oneShotCron(i)
+             for i in range(n)]
+    noop = lambda: None
+
+    gc.collect()
+    started = time.time()
+    jobs = [backend.add_cron_job(noop, **Cron.split(cron)) for cron in crons]
+    added = time.time() - started
+
+    started = time.time()
+    for job in jobs:
+        backend.unschedule_job(job)
+    removed = time.time() - started
+    backend.shutdown()
+
+    # tracing slows allocations down a lot, so memory is measured apart
+    backend = makeBackend(backendName)
+    backend.start()
+    gc.collect()
+    tracemalloc.start()
+    jobs = [backend.add_cron_job(noop, **Cron.split(cron)) for cron in crons]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    backend.shutdown()
+
+    return {
+        'backend': backendName,
+        'n': n,
+        'addPerSec': n / added,
+        'removePerSec': n / removed,
+        'bytesPerJob': memory / n,
+    }
+
+
+def benchDispatch(backendName, n):
+    '''Measures how fast jobs, that are all due at the same second, are
+       dispatched'''
+    backend = makeBackend(backendName)
+    done = threading.Event()
+    fired = [0]
+
+    def job():
+        fired[0] += 1
+        if fired[0] == n:
+            done.set()
+
+    fire = datetime.datetime.now().replace(microsecond=0) + \
+        datetime.timedelta(seconds=2)
+    cron = "%d %d %d %d %d %d *" % (fire.second, fire.minute, fire.hour,
+                                    fire.day, fire.month, fire.year)
+    for i in range(n):
+        backend.add_cron_job(job, **Cron.split(cron))
+    backend.start()
+    time.sleep(max(0, time.mktime(fire.timetuple()) - time.time()))
+    started = time.time()
+    done.wait(600)
+    elapsed = time.time() - started
+    backend.shutdown()
+
+    return {
+        'backend': backendName,
+        'n': n,
+        'fired': fired[0],
+        'dispatchPerSec': fired[0] / elapsed,
+    }
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv if not arg.startswith('--')] or SIZES
+    backends = [arg.split('=', 1)[1] for arg in argv
+                if arg.startswith('--backend=')] or ['heap', 'apscheduler']
+    results = []
+    for backend in backends:
+        try:
+            makeBackend(backend)
+        except ImportError as e:
+            print("skipping %s: %s" % (backend, e))
+            continue
+        for n in sizes:
+            results.append(benchAdd(backend, n))
+            print(results[-1])
+        results.append(benchDispatch(backend, min(sizes)))
+        print(results[-1])
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
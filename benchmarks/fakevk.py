@@ -0,0 +1,213 @@
+"""
+Local stand-in for VK API, so that casting is measured without the network
+and without VK limits. wall.post and execute are answered after a given
+latency, a share of calls may be throttled the way VK does it, posts with
+given messages are rejected.
+
+    python -m benchmarks.fakevk [port] [--latency=0.05]
+"""
+
+import http.client
+import http.server
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+from schedcaster.caster.ratelimit import Throttled
+from schedcaster.consumer.vk import THROTTLE_ERROR_CODES
+
+
+class FakeVK(object):
+    def __init__(self, latency=0.05, jitter=0.0, throttleShare=0.0, port=0,
+                 seed=0, rejected=()):
+        '''
+           :param latency: seconds every call takes
+           :param jitter: max seconds added to the latency at random
+           :param throttleShare: share of calls rejected with error 6
+           :param port: port to listen at on localhost, 0 for any free one
+           :param rejected: messages of posts to reject with error 214. In
+                            execute only their calls fail, they are replied
+                            with false, like VK does'''
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleShare = throttleShare
+        self.rejected = set(rejected)
+        self.port = port
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__calls = 0
+        self.__methods = {}  # method => number of calls
+        self.__throttled = 0
+        self.__postIds = 0
+
+    @property
+    def url(self):
+        '''Base url of methods, same as Consumer.url of asyncvk'''
+        return 'http://127.0.0.1:%d/method/' % self.port
+
+    def start(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keeps connections alive, like VK does
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                args = urllib.parse.parse_qs(
+                    self.rfile.read(length).decode('utf-8'))
+                method = self.path.rsplit('/', 1)[-1].split('?')[0]
+                body = json.dumps(fake.call(method, args)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self.__server = Server(('127.0.0.1', self.port), Handler)
+        self.port = self.__server.server_address[1]
+        thread = threading.Thread(target=self.__server.serve_forever,
+                                  name='FakeVK')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.__server != None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def call(self, method, args):
+        '''Answers a call the way VK does
+           :rtype: reply as a dict'''
+        with self.__lock:
+            self.__calls += 1
+            self.__methods[method] = self.__methods.get(method, 0) + 1
+            delay = self.latency + self.__random.random() * self.jitter
+            throttled = self.__random.random() < self.throttleShare
+            if throttled:
+                self.__throttled += 1
+        time.sleep(delay)
+        if throttled:
+            return {'error': {'error_code': 6,
+                              'error_msg': 'Too many requests per second'}}
+        if method == 'wall.post':
+            if args.get('message', [''])[0] in self.rejected:
+                return {'error': self.__rejection('wall.post')}
+            return {'response': {'post_id': self.__nextPostId()}}
+        if method == 'execute':
+            replies = []
+            errors = []
+            for message in self.__executedPosts(args.get('code', [''])[0]):
+                if message in self.rejected:
+                    replies.append(False)
+                    errors.append(self.__rejection('wall.post'))
+                else:
+                    replies.append({'post_id': self.__nextPostId()})
+            reply = {'response': replies}
+            if errors:
+                reply['execute_errors'] = errors
+            return reply
+        return {'error': {'error_code': 3,
+                          'error_msg': 'Unknown method passed'}}
+
+    def stats(self):
+        with self.__lock:
+            return {'calls': self.__calls, 'throttled': self.__throttled,
+                    'methods': dict(self.__methods)}
+
+    @staticmethod
+    def __executedPosts(code):
+        '''Gets messages of API.wall.post calls in the code of execute'''
+        decoder = json.JSONDecoder()
+        messages = []
+        start = code.find('API.wall.post(')
+        while start >= 0:
+            args, end = decoder.raw_decode(code, start + len('API.wall.post('))
+            messages.append(args.get('message', ''))
+            start = code.find('API.wall.post(', end)
+        return messages
+
+    @staticmethod
+    def __rejection(method):
+        return {'method': method, 'error_code': 214,
+                'error_msg': 'Access to adding post denied'}
+
+    def __nextPostId(self):
+        with self.__lock:
+            self.__postIds += 1
+            return self.__postIds
+
+
+class HTTPConsumer(object):
+    '''Blocking consumer for Caster, that posts to a VK-like endpoint over
+       a keep-alive connection per thread, much like the vk consumer does'''
+    def __init__(self, url, owner=None, timeout=30):
+        self.url = urllib.parse.urlparse(url)
+        self.owner = owner
+        self.timeout = timeout
+        self.__local = threading.local()
+
+    def consume(self, post, attachments=None, **kwargs):
+        args = {'message': post}
+        if self.owner != None:
+            args['owner_id'] = self.owner
+        if attachments:
+            args['attachments'] = ",".join(attachments.split('\n'))
+        reply = self.call('wall.post', **args)
+        return reply['post_id']
+
+    def call(self, method, **args):
+        body = urllib.parse.urlencode(args)
+        connection = getattr(self.__local, 'connection', None)
+        if connection == None:
+            connection = http.client.HTTPConnection(self.url.hostname,
+                                                    self.url.port,
+                                                    timeout=self.timeout)
+            self.__local.connection = connection
+        try:
+            connection.request('POST', self.url.path + method, body,
+                               {'Content-Type':
+                                'application/x-www-form-urlencoded'})
+            reply = json.loads(connection.getresponse().read()
+                               .decode('utf-8'))
+        except Exception:
+            connection.close()
+            self.__local.connection = None
+            raise
+        if 'error' in reply:
+            if reply['error']['error_code'] in THROTTLE_ERROR_CODES:
+                raise Throttled(reply['error']['error_msg'])
+            raise RuntimeError(reply['error']['error_msg'])
+        return reply['response']
+
+
+def main(argv):
+    ports = [int(arg) for arg in argv if not arg.startswith('--')]
+    latency = [float(arg.split('=', 1)[1]) for arg in argv
+               if arg.startswith('--latency=')]
+    fake = FakeVK(latency and latency[0] or 0.05,
+                  port=ports and ports[0] or 0).start()
+    print("fake VK API at %s" % fake.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
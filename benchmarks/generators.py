@@ -0,0 +1,101 @@
+"""
+Synthetic inputs of benchmarks: entry sets, spreadsheet rows and workbooks,
+that look like real schedules. Generators are seeded, so that runs with the
+same arguments get the same inputs and their results may be compared.
+"""
+
+import datetime
+import random
+
+from schedcaster.scheduler import Entry, STATE_ONESHOT, ARG_HASH, digest
+from schedcaster.parser.spec import Spec, SheetSpec, ColumnSpec, HashSpec
+
+# most of the entries are posts scheduled once, the rest are recurring
+ONESHOT_SHARE = 0.9
+# recurring crons the way real schedules use them: daily, on weekdays,
+# every quarter of an hour, monthly and on weekends
+RECURRING_CRONS = ('0 0 12 * * * *', '0 30 9 * * * mon-fri',
+                   '0 */15 * * * * *', '0 0 0 1 * * *',
+                   '0 0 18 * * * sat,sun')
+MEDIA = ('photo', 'video', 'audio', 'doc')
+WORDS = ('schedule', 'post', 'news', 'today', 'sale', 'new', 'photo', 'week',
+         'event', 'join', 'us', 'at', 'the', 'of', 'and', 'for')
+SHEET = 'posts'
+
+
+def cronAt(fire):
+    '''Gets the cron of a one-shot fired at a datetime'''
+    return "%d %d %d %d %d %d *" % (fire.second, fire.minute, fire.hour,
+                                    fire.day, fire.month, fire.year)
+
+
+def makeText(rng, minWords=3, maxWords=80):
+    return " ".join(rng.choice(WORDS)
+                    for i in range(rng.randint(minWords, maxWords)))
+
+
+def makeAttachments(rng, maxCount=3):
+    '''Gets attachments of a post as they are kept in spreadsheets, one
+       media reference per line'''
+    return "\n".join("%s%d_%d" % (rng.choice(MEDIA), rng.randint(1, 10**8),
+                                  rng.randint(1, 10**6))
+                     for i in range(rng.randint(0, maxCount)))
+
+
+def makeEntries(n, seed=0, start=None, spread=365 * 24 * 60 * 60,
+                oneShotShare=ONESHOT_SHARE):
+    '''Makes entries with a mix of one-shots and recurring crons
+       :param start: datetime one-shots start at, a minute from now if None
+       :param spread: seconds one-shots are spread over after the start
+       :rtype: list of Entry'''
+    rng = random.Random(seed)
+    start = start or datetime.datetime.now().replace(microsecond=0) + \
+        datetime.timedelta(minutes=1)
+    entries = []
+    for i in range(n):
+        if rng.random() < oneShotShare:
+            fire = start + datetime.timedelta(seconds=rng.randrange(spread))
+            entry = Entry(cron=cronAt(fire), state=STATE_ONESHOT,
+                          handler='post')
+        else:
+            entry = Entry(cron=rng.choice(RECURRING_CRONS), handler='post')
+        entry.id = digest(b"benchmark %d %d" % (seed, i))
+        entry.arg('post', makeText(rng))
+        attachments = makeAttachments(rng)
+        if attachments:
+            entry.arg('attachments', attachments)
+        entry.arg(ARG_HASH, digest(repr((entry.cron, i)).encode('utf-8')))
+        entries.append(entry)
+    return entries
+
+
+def makeSpec():
+    '''Gets the spec of sheets made by makeRows'''
+    return Spec([SheetSpec(SHEET, [
+        ColumnSpec('A', '@cron'),
+        ColumnSpec('B', 'post', filterFn=lambda v: v != None),
+        ColumnSpec('C', 'attachments'),
+    ], HashSpec(['A', 'B']))])
+
+
+def makeRows(n, seed=0):
+    '''Makes rows of a sheet, that match makeSpec: one-shots a minute apart
+       starting from tomorrow, some of them without attachments
+       :rtype: list of [cron, post, attachments]'''
+    rng = random.Random(seed)
+    start = datetime.datetime.now().replace(microsecond=0) + \
+        datetime.timedelta(days=1)
+    return [[cronAt(start + datetime.timedelta(minutes=i)),
+             "%d %s" % (i, makeText(rng)),
+             makeAttachments(rng) or None]
+            for i in range(n)]
+
+
+def writeWorkbook(filename, rows, sheetName=SHEET):
+    '''Writes rows to an xlsx workbook, requires openpyxl'''
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet(sheetName)
+    for row in rows:
+        sheet.append(row)
+    wb.save(filename)
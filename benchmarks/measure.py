@@ -0,0 +1,61 @@
+"""
+Helpers to measure memory of benchmarks. Peak RSS of a process only grows,
+so benchmarks, that report it, run in a child process of their own.
+"""
+
+import multiprocessing
+import os
+import resource
+import sys
+import traceback
+
+
+def peakRss():
+    '''Gets peak resident set size of this process
+       :rtype: bytes'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def currentRss():
+    '''Gets resident set size of this process
+       :rtype: bytes or None, if it is unknown on this platform'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def isolated(fn, *args):
+    '''Runs a benchmark in a forked child, so that its peak RSS isn't
+       hidden by the ones run before it. Runs it in this process, if fork
+       isn't available
+       :param fn: function, that returns a dict of results
+       :rtype: the dict with 'peakRss' and 'baseRss' (RSS before the run)
+               added'''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        base = currentRss()
+        result = fn(*args)
+        result.update({'peakRss': peakRss(), 'baseRss': base})
+        return result
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    child = context.Process(target=__runChild, args=(results, fn, args))
+    child.start()
+    ok, result = results.get()
+    child.join()
+    if not ok:
+        raise RuntimeError("benchmark failed:\n%s" % result)
+    return result
+
+
+def __runChild(results, fn, args):
+    try:
+        base = currentRss()
+        result = fn(*args)
+        result.update({'peakRss': peakRss(), 'baseRss': base})
+        results.put((True, result))
+    except BaseException:
+        results.put((False, traceback.format_exc()))
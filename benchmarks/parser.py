@@ -0,0 +1,93 @@
+"""
+Compares parsers on the same schedule: rows per second and peak memory of
+the workbook, CSV and NDJSON parsers, and whether they give the same
+entries.
+
+    python -m benchmarks.parser [n ...]
+"""
+
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from schedcaster.parser import flatfile
+from benchmarks.generators import SHEET, makeSpec, makeRows, writeWorkbook
+from benchmarks.measure import isolated
+
+SIZES = (10000, 100000)
+
+
+def writeFiles(directory, rows):
+    '''Writes the rows in every supported format
+       :rtype: dict of format => file name'''
+    files = {}
+    files['csv'] = os.path.join(directory, SHEET + '.csv')
+    with open(files['csv'], 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows(rows)
+    files['ndjson'] = os.path.join(directory, SHEET + '.ndjson')
+    with open(files['ndjson'], 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+    try:
+        writeWorkbook(os.path.join(directory, SHEET + '.xlsx'), rows)
+        files['xlsx'] = os.path.join(directory, SHEET + '.xlsx')
+    except ImportError as e:
+        print("skipping xlsx: %s" % e)
+    return files
+
+
+def parserOf(format):
+    if format == 'xlsx':
+        from schedcaster.parser import officeopenXML
+        return officeopenXML.parse
+    return flatfile.parse
+
+
+def bench(n):
+    directory = tempfile.mkdtemp()
+    try:
+        files = writeFiles(directory, makeRows(n))
+        spec = makeSpec()
+        results = []
+        reference = None
+        for format, filename in sorted(files.items()):
+            result = isolated(benchParse, format, filename, spec, n)
+            keys = result.pop('keys')
+            reference = reference or keys
+            result['sameEntries'] = keys == reference
+            results.append(result)
+            print(results[-1])
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchParse(format, filename, spec, n):
+    parse = parserOf(format)
+    started = time.time()
+    entries = parse(filename, spec)
+    elapsed = time.time() - started
+    return {
+        'format': format,
+        'n': n,
+        'rowsPerSec': n / elapsed,
+        'bytes': os.path.getsize(filename),
+        # entries are compared by id and hash, that covers every cell
+        'keys': [(entry.id, entry.args['hash'].value) for entry in entries],
+    }
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or SIZES
+    results = []
+    for n in sizes:
+        results.extend(bench(n))
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,157 @@
+"""
+Measures Scheduler: time to refresh from a config of n entries, both from
+scratch and when nothing was changed, time to restart from a snapshot,
+memory it takes, and how late entries are fired, when many of them are due
+at once.
+
+    python -m benchmarks.scheduler [n ...] [--backend=heap|apscheduler]
+                                   [--window=seconds]
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from schedcaster.config.sqlite import Config
+from schedcaster.scheduler import Scheduler, Entry, STATE_ONESHOT, \
+    BACKEND_HEAP
+from benchmarks.generators import makeEntries, cronAt
+from benchmarks.measure import isolated
+
+SIZES = (10000, 100000)
+# number of entries fired at once by the lag benchmark
+BURST = 2000
+
+
+def benchRefresh(n, backend=BACKEND_HEAP, window=None):
+    directory = tempfile.mkdtemp()
+    try:
+        config = Config(os.path.join(directory, 'bench.db'))
+        config.saveMany(makeEntries(n))
+        scheduler = Scheduler(config, backend=backend, window=window)
+        scheduler.start(False)
+
+        started = time.time()
+        scheduler.refresh()
+        refreshed = time.time() - started
+        started = time.time()
+        scheduler.refresh()
+        unchanged = time.time() - started
+        scheduler.stop()
+        config.close()
+
+        return {
+            'n': n,
+            'backend': backend,
+            'window': window,
+            'refreshSeconds': refreshed,
+            'unchangedRefreshSeconds': unchanged,
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchRestore(n, backend=BACKEND_HEAP):
+    '''Restarts a scheduler of n entries from its snapshot'''
+    directory = tempfile.mkdtemp()
+    try:
+        config = Config(os.path.join(directory, 'bench.db'))
+        config.saveMany(makeEntries(n))
+        snapshot = os.path.join(directory, 'bench.snapshot')
+        scheduler = Scheduler(config, backend=backend, snapshot=snapshot)
+        started = time.time()
+        scheduler.start()
+        cold = time.time() - started
+        started = time.time()
+        scheduler.stop()
+        saved = time.time() - started
+        size = os.path.getsize(snapshot)
+
+        started = time.time()
+        scheduler.start()
+        warm = time.time() - started
+        scheduler.stop()
+        config.close()
+
+        return {
+            'n': n,
+            'backend': backend,
+            'coldStartSeconds': cold,
+            'snapshotSaveSeconds': saved,
+            'snapshotBytes': size,
+            'warmStartSeconds': warm,
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchLag(n, backend=BACKEND_HEAP):
+    '''Fires n one-shots due at the same second and measures how late they
+       are fired'''
+    directory = tempfile.mkdtemp()
+    try:
+        config = Config(os.path.join(directory, 'bench.db'))
+        fire = datetime.datetime.now().replace(microsecond=0) + \
+            datetime.timedelta(seconds=3)
+        due = time.mktime(fire.timetuple())
+        entries = []
+        for i in range(n):
+            entry = Entry(id=b"lag %d" % i, cron=cronAt(fire),
+                          state=STATE_ONESHOT, handler='post')
+            entry.arg('post', "post %d" % i)
+            entries.append(entry)
+        config.saveMany(entries)
+
+        lags = []
+        done = threading.Event()
+
+        def post(post):
+            lags.append(time.time() - due)
+            if len(lags) == n:
+                done.set()
+
+        scheduler = Scheduler(config, backend=backend)
+        scheduler.addHandler('post', post)
+        scheduler.start()
+        done.wait(max(60, n / 100.0))
+        scheduler.stop()
+        config.close()
+
+        lags.sort()
+        return {
+            'n': n,
+            'backend': backend,
+            'fired': len(lags),
+            'lagP50': lags and lags[len(lags) // 2],
+            'lagP99': lags and lags[int(len(lags) * 0.99)],
+            'lagMax': lags and lags[-1],
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv if not arg.startswith('--')] or SIZES
+    backends = [arg.split('=', 1)[1] for arg in argv
+                if arg.startswith('--backend=')] or [BACKEND_HEAP]
+    windows = [float(arg.split('=', 1)[1]) for arg in argv
+               if arg.startswith('--window=')] or [None, 60 * 60]
+    results = []
+    for backend in backends:
+        for n in sizes:
+            for window in windows:
+                results.append(isolated(benchRefresh, n, backend, window))
+                print(results[-1])
+            results.append(isolated(benchRestore, n, backend))
+            print(results[-1])
+        results.append(benchLag(min(BURST, min(sizes)), backend))
+        print(results[-1])
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,2 +1,18 @@
-from schedcaster.scheduler import Scheduler
+import importlib
 
+
+# subpackages are imported on first use, so that e.g. a parser or a config
+# doesn't pay for the scheduler and its backends
+def __getattr__(name):
+    if name == 'Scheduler':
+        from schedcaster.scheduler import Scheduler
+        return Scheduler
+    if not name.startswith('_'):
+        try:
+            # e.g. schedcaster.scheduler.Entry after a bare import schedcaster
+            return importlib.import_module(__name__ + '.' + name)
+        except ModuleNotFoundError as e:
+            # a missing dependency of an existing submodule surfaces as is
+            if e.name != __name__ + '.' + name:
+                raise
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,313 @@
+"""
+asyncio counterpart of schedcaster.scheduler.Scheduler. Entries are kept in
+a heap ordered by their next fire time and are fired by a single task of
+the event loop. Handlers may be coroutine functions, so that thousands of
+them may be in progress at once without a thread each. Plain handlers are
+called right on the loop and must not block.
+
+Config is blocking, so its calls are run in the default executor of the
+loop.
+"""
+
+import asyncio
+import datetime
+import heapq
+import inspect
+import itertools
+import logging
+import time
+
+from schedcaster import cron as Cron
+from schedcaster.config.writebehind import WriteBehind
+from schedcaster.catchup import CatchUpQueue, STATUS_EXPIRED
+from schedcaster.scheduler import STATE_DONE, STATE_ONESHOT, Job, \
+    argsToMap, entryFingerprint, FIRE_LAG, RESCHEDULE_SECONDS, \
+    SCHEDULED_ENTRIES
+
+
+class AsyncJob(Job):
+    '''Scheduled entry along with its place in the heap'''
+    __slots__ = ('cron', 'scheduled', 'running')
+
+    def __init__(self, entry, fingerprint, cron=None):
+        Job.__init__(self, entry, fingerprint)
+        self.cron = cron
+        self.scheduled = False
+        self.running = False
+
+
+class AsyncScheduler(object):
+    def __init__(self, config, grace_time=None, flushInterval=1.0,
+                 catchUpRate=1.0, catchUpBurst=1):
+        '''
+           :param config: config provider to get entries from
+           :param grace_time: seconds after the designated fire time, during
+                              which a missed job is still run
+           :param flushInterval: max seconds state changes of fired entries
+                                 wait to be written to the config together,
+                                 0 to write each of them at once
+           :param catchUpRate: max number of missed one-shots fired per
+                               second, oldest ones go first
+           :param catchUpBurst: max number of missed one-shots fired at once'''
+        self.config = config
+        self.grace_time = grace_time or 60 * 60 * 24  # 1 day
+        self.handlers = {}
+        self.__jobs = {}  # entry id => AsyncJob
+        self.__heap = []  # (fire timestamp, sequence number, job)
+        self.__sequence = itertools.count()
+        self.__cancelled = 0
+        self.__tasks = set()  # handlers in progress
+        self.__dispatcher = None
+        self.__wakeup = None
+        # states of fired entries are already known to this scheduler, the
+        # same way as to Scheduler, so they don't advance the change counter
+        self.__writer = WriteBehind(config, interval=flushInterval,
+                                    track=False)
+        self.__catchUp = CatchUpQueue(catchUpRate, catchUpBurst,
+                                      self.grace_time)
+
+    def addHandler(self, name, handler):
+        self.handlers[name] = handler
+
+    def removeHandler(self, name):
+        if name in self.handlers:
+            self.handlers.pop(name)
+
+    async def start(self, refresh=True):
+        if self.started():
+            return
+        self.__wakeup = asyncio.Event()
+        self.__dispatcher = asyncio.ensure_future(self.__dispatch())
+        if refresh:
+            await self.refresh()
+
+    async def stop(self, wait=True):
+        '''Stops firing entries
+           :param wait: whether to wait for handlers in progress'''
+        if not self.started():
+            return
+        dispatcher = self.__dispatcher
+        self.__dispatcher = None
+        dispatcher.cancel()
+        try:
+            await dispatcher
+        except asyncio.CancelledError:
+            pass
+        self.__jobs = {}
+        self.__heap = []
+        self.__cancelled = 0
+        self.__catchUp.clear()
+        if wait and self.__tasks:
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+        # write down what was done before the stop
+        await asyncio.get_event_loop().run_in_executor(None,
+                                                       self.__writer.close)
+
+    async def refresh(self, restart=False):
+        '''Synchronizes scheduled jobs with active entries of the config.
+           Only jobs of new, changed or removed entries are touched
+           :param restart: whether to drop all jobs and rebuild them from
+                           scratch'''
+        if restart:
+            await self.stop(False)
+            await self.start(False)
+        started = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        # one-shots, that were done already, must not be seen as active
+        await loop.run_in_executor(None, self.__writer.flush)
+        entries = await loop.run_in_executor(None, self.config.getActive)
+
+        seen = set()
+        for entry in entries:
+            seen.add(entry.id)
+            self.upsertEntry(entry)
+        for id in [id for id in self.__jobs if id not in seen]:
+            self.removeEntry(id)
+        SCHEDULED_ENTRIES.set(len(self.__jobs))
+        RESCHEDULE_SECONDS.observe(time.perf_counter() - started)
+
+    def upsertEntry(self, entry):
+        '''Schedules a new entry or reschedules a changed one, unchanged
+           entries are left as they are. Must be called from the loop
+           :param entry: entry to schedule
+           :rtype: whether the entry was (re)scheduled'''
+        if entry.state & STATE_DONE:
+            self.removeEntry(entry.id)
+            return False
+
+        fingerprint = entryFingerprint(entry)
+        job = self.__jobs.get(entry.id)
+        if job != None:
+            if job.fingerprint == fingerprint:
+                return False
+            self.__unschedule(job)
+        self.__jobs[entry.id] = self.__schedule(entry, fingerprint)
+        # args of entries loaded from the config are loaded again on fire
+        entry.dropArgs()
+        return True
+
+    def removeEntry(self, id):
+        '''Unschedules an entry. Must be called from the loop
+           :param id: id of the entry
+           :rtype: whether the entry was scheduled'''
+        job = self.__jobs.pop(id, None)
+        if job == None:
+            return False
+        self.__unschedule(job)
+        return True
+
+    def started(self):
+        return self.__dispatcher != None
+
+    def catchUpStats(self):
+        '''Gets number of missed one-shots waiting to be fired and seconds
+           it takes to fire them, see CatchUpQueue.stats
+           :rtype: dict'''
+        return self.__catchUp.stats()
+
+    def pendingHandlers(self):
+        '''Gets number of handlers, that are in progress right now'''
+        return len(self.__tasks)
+
+    def __schedule(self, entry, fingerprint):
+        try:
+            job = AsyncJob(entry, fingerprint, Cron.compile(entry.cron))
+        except ValueError as e:
+            logging.error("not scheduling entry %s: %s" % (entry.id, e))
+            return AsyncJob(entry, fingerprint)
+
+        fire = job.cron.nextFireAfter(datetime.datetime.now())
+        if fire != None:
+            self.__push(job, fire.timestamp())
+            job.scheduled = True
+        elif entry.state & STATE_ONESHOT:
+            # if job is scheduled at the past and it was not done before,
+            # let it catch up along with the other missed ones
+            due = job.cron.firstFire()
+            if due != None:
+                self.__catchUp.put(job, due.timestamp())
+                if self.__wakeup != None:
+                    self.__wakeup.set()
+        return job
+
+    def __unschedule(self, job):
+        if not job.scheduled:
+            return
+        job.scheduled = False
+        self.__cancelled += 1
+        # drop cancelled jobs once they take the most of the heap, so that
+        # memory is not wasted on them
+        if self.__cancelled > len(self.__heap) // 2:
+            self.__heap = [item for item in self.__heap if item[2].scheduled]
+            heapq.heapify(self.__heap)
+            self.__cancelled = 0
+
+    def __push(self, job, fireTime):
+        item = (fireTime, next(self.__sequence), job)
+        heapq.heappush(self.__heap, item)
+        if self.__wakeup != None and self.__heap[0] is item:
+            self.__wakeup.set()
+
+    async def __dispatch(self):
+        while True:
+            self.__wakeup.clear()
+            item = self.__catchUp.pop()
+            if item != None:
+                self.__releaseCatchUp(*item)
+                continue
+
+            now = time.time()
+            timeout = self.__catchUp.wait()
+            if self.__heap and not self.__heap[0][2].scheduled:
+                heapq.heappop(self.__heap)
+                self.__cancelled -= 1
+                continue
+            if self.__heap and self.__heap[0][0] <= now:
+                self.__fireDue(now)
+                continue
+            if self.__heap and (timeout == None or
+                                self.__heap[0][0] - now < timeout):
+                timeout = self.__heap[0][0] - now
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def __fireDue(self, now):
+        fireTime, _, job = heapq.heappop(self.__heap)
+        # multiple missed runs are coalesced into a single one
+        fire = job.cron.nextFireAfter(
+            datetime.datetime.fromtimestamp(max(now, fireTime)))
+        if fire == None:
+            job.scheduled = False
+        else:
+            self.__push(job, fire.timestamp())
+
+        if now - fireTime > self.grace_time:
+            logging.warning("Run time of entry %s was missed by %s" % (
+                job.entry.id, datetime.timedelta(seconds=now - fireTime)))
+            return
+        if job.running:
+            logging.warning("Entry %s is still in progress, skipping it"
+                            % job.entry.id)
+            return
+        FIRE_LAG.observe(max(now - fireTime, 0.0))
+        self.__startTask(self.__run(job))
+
+    def __releaseCatchUp(self, job, due, expired):
+        # the entry was changed or removed while it waited
+        if self.__jobs.get(job.entry.id) is not job:
+            return
+        if expired:
+            self.__startTask(self.__expire(job, due))
+        else:
+            FIRE_LAG.observe(max(time.time() - due, 0.0))
+            self.__startTask(self.__run(job))
+
+    def __startTask(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __expire(self, job, due):
+        entry = job.entry
+        logging.warning("Entry %s was missed by %s, it won't be run" % (
+            entry.id, datetime.timedelta(seconds=time.time() - due)))
+        entry.state |= STATE_DONE
+        entry.status = STATUS_EXPIRED
+        if self.__jobs.get(entry.id) is job:
+            self.__jobs.pop(entry.id)
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.__writer.put, entry.id, {'state': entry.state,
+                                                'status': entry.status})
+
+    async def __run(self, job):
+        entry = job.entry
+        if entry.state & STATE_DONE:
+            return
+        job.running = True
+        loop = asyncio.get_event_loop()
+        try:
+            if entry.handler in self.handlers:
+                # args may have to be loaded from the config
+                args = await loop.run_in_executor(None, getattr, entry,
+                                                  'args')
+                result = self.handlers[entry.handler](**argsToMap(args))
+                if inspect.isawaitable(result):
+                    await result
+        except Exception:
+            logging.exception("Handler of entry %s raised an exception" %
+                              entry.id)
+            return
+        finally:
+            job.running = False
+
+        if entry.state & STATE_ONESHOT:
+            entry.state |= STATE_DONE
+            if self.__jobs.get(entry.id) is job:
+                self.__jobs.pop(entry.id)
+            # one-shots may have non-one-shot crons (e.g. * * * * * * *)
+            self.__unschedule(job)
+            # put blocks only if updates are written at once
+            await loop.run_in_executor(None, self.__writer.put, entry.id,
+                                       {'state': entry.state})
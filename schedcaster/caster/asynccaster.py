@@ -0,0 +1,142 @@
+"""
+asyncio counterpart of schedcaster.caster.multicaster.Caster. Each consumer
+call is a task of the event loop, a semaphore bounds how many of them talk
+to consumers at once. Consumers with a coroutine consume method are awaited
+right on the loop, blocking ones are run in an executor.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import time
+from schedcaster.caster.ratelimit import Throttled
+
+
+class AsyncCaster(object):
+    def __init__(self, maxConcurrency=1000, executor=None):
+        '''
+           :param maxConcurrency: max number of consumer calls in progress
+           :param executor: concurrent.futures executor to run blocking
+                            consumers with, the loop's default one if None'''
+        self.maxConcurrency = maxConcurrency
+        self.executor = executor
+        self.__consumers = []
+        self.__limiters = {}  # consumer => RateLimiter
+        self.__semaphore = None
+        self.__tasks = set()
+
+    def attach(self, consumer, limiter=None):
+        '''Attaches a consumer
+           :param limiter: RateLimiter for calls of the consumer, consumers
+                           sharing an API token should share it as well
+           :rtype: whether the consumer wasn't attached before'''
+        if not consumer in self.__consumers:
+            self.__consumers.append(consumer)
+            if limiter != None:
+                self.__limiters[consumer] = limiter
+            return True
+        else:
+            return False
+
+    def detach(self, consumer):
+        if consumer in self.__consumers:
+            self.__consumers.remove(consumer)
+            self.__limiters.pop(consumer, None)
+            return True
+        else:
+            return False
+
+    def send(self, callback=None, *args, **kwargs):
+        '''Passes a message to every attached consumer in background. Must
+           be called from the event loop
+           :param callback: called with each consumer's result or exception,
+                            awaited if it returns an awaitable
+           :rtype: list of asyncio.Task, one per consumer'''
+        if self.__semaphore == None:
+            self.__semaphore = asyncio.Semaphore(self.maxConcurrency)
+        tasks = []
+        for consumer in self.__consumers:
+            task = asyncio.ensure_future(self.__run(
+                consumer, self.__limiters.get(consumer), callback,
+                args, kwargs))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__done)
+            tasks.append(task)
+        return tasks
+
+    async def stop(self):
+        '''Waits for the calls in progress'''
+        if self.__tasks:
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    def activeTasks(self):
+        '''Gets number of calls, that are not complete yet'''
+        return len(self.__tasks)
+
+    async def __run(self, consumer, limiter, callback, args, kwargs):
+        attempts = 0
+        while True:
+            if limiter != None:
+                delay = limiter.acquire()
+                while delay > 0:
+                    await asyncio.sleep(delay)
+                    delay = limiter.acquire()
+            attempts += 1
+            started = time.time()
+            # (success, throttled, retry after) of the call for the limiter,
+            # None if the task was cancelled meanwhile
+            outcome = None
+            try:
+                async with self.__semaphore:
+                    result = await self.__consume(consumer, args, kwargs)
+                outcome = (True, False, None)
+            except Throttled as e:
+                outcome = (False, True, e.retryAfter)
+                error = e
+            except Exception as e:
+                outcome = (False, False, None)
+                error = e
+            finally:
+                # CancelledError isn't an Exception, the slot must be given
+                # back anyway, or the consumer is blocked for good
+                if limiter != None:
+                    if outcome == None:
+                        limiter.cancel()
+                    else:
+                        limiter.release(time.time() - started, *outcome)
+            if outcome[0]:
+                await self.__finish(callback, result)
+                return result
+            # the limiter is drained now, so the call waits for a token
+            if outcome[1] and limiter != None and \
+               attempts <= limiter.maxRetries:
+                continue
+            await self.__finish(callback, exception=error)
+            raise error
+
+    async def __consume(self, consumer, args, kwargs):
+        if inspect.iscoroutinefunction(consumer.consume):
+            return await consumer.consume(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(
+            consumer.consume, *args, **kwargs))
+
+    async def __finish(self, callback, result=None, exception=None):
+        if exception != None:
+            logging.error("Exception at consumer: %s" % str(exception))
+        if callback == None:
+            return
+        try:
+            reply = callback(exception or result)
+            if inspect.isawaitable(reply):
+                await reply
+        except Exception as e:
+            logging.error("Exception at callback: %s" % str(e))
+
+    def __done(self, task):
+        self.__tasks.discard(task)
+        # failures are reported by __finish already, so don't let asyncio
+        # complain about exceptions, that were never retrieved
+        if not task.cancelled():
+            task.exception()
@@ -7,54 +7,403 @@ Created on Sun Aug  5 00:14:40 2012
 
 import threading
 import logging
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
 import queue
+import time
+from schedcaster import metrics as Metrics
+from schedcaster.caster.ratelimit import Throttled
+from schedcaster.caster.outbox import jobKey
+import schedcaster.scheduler as Scheduler
+
+# modes of Broadcast.wait
+FIRST_COMPLETED = concurrent.futures.FIRST_COMPLETED
+FIRST_EXCEPTION = concurrent.futures.FIRST_EXCEPTION
+ALL_COMPLETED = concurrent.futures.ALL_COMPLETED
+
+QUEUE_DEPTH = Metrics.gauge('schedcaster_caster_queue_depth',
+    'Number of caster jobs waiting for a worker or for their rate limit')
+ACTIVE_WORKERS = Metrics.gauge('schedcaster_caster_active_workers',
+    'Number of caster workers running a job')
+JOBS = Metrics.counter('schedcaster_caster_jobs',
+    'Caster jobs by their outcome', ('outcome',))
+ABANDONED_WORKERS = Metrics.counter('schedcaster_caster_abandoned_workers',
+    'Caster workers replaced, since they were stuck past a deadline')
+
+
+class Job(concurrent.futures.Future):
+    '''A single consumer call, that was issued by Caster.send. Being a
+       future, it tells if the call is complete and what it returned'''
+    def __init__(self, id, consumer, fn, callback=None, limiter=None,
+                 key=None, deadline=None):
+        concurrent.futures.Future.__init__(self)
+        self.id = id
+        self.consumer = consumer
+        self.fn = fn
+        self.callback = callback
+        self.limiter = limiter
+        self.key = key  # key in the outbox, if any
+        self.deadline = deadline  # timestamp the call must be done by
+        self.attempts = 0
+
+    def expired(self, now=None):
+        return self.deadline != None and self.deadline <= (now or time.time())
+
+    def finish(self, result=None, exception=None):
+        if exception != None:
+            logging.error("Exception at consumer: %s" % str(exception))
+        if self.callback != None:
+            try:
+                self.callback(exception or result)
+            except Exception as e:
+                logging.error("Exception at callback: %s" % str(e))
+        if exception != None:
+            self.set_exception(exception)
+        else:
+            self.set_result(result)
+
+
+class Broadcast(list):
+    '''Jobs issued by a single Caster.send, one per consumer'''
+
+    def wait(self, timeout=None, returnWhen=ALL_COMPLETED):
+        '''Waits for the jobs
+           :param timeout: max seconds to wait, None to wait forever
+           :param returnWhen: FIRST_COMPLETED, FIRST_EXCEPTION or
+                              ALL_COMPLETED
+           :rtype: (set of complete jobs, set of the rest of them)'''
+        return concurrent.futures.wait(self, timeout, returnWhen)
+
+    def done(self):
+        return all(job.done() for job in self)
+
+    def cancel(self):
+        '''Cancels jobs, that are not started yet. Started ones are stopped
+           only by their deadline
+           :rtype: number of cancelled jobs'''
+        return len([job for job in self if job.cancel()])
+
+    def results(self, timeout=None):
+        '''Waits for the jobs and gets what each consumer returned
+           :param timeout: max seconds to wait, None to wait forever
+           :rtype: map of consumer to its result or exception, jobs, that
+                   are not complete yet, are left out'''
+        done, _ = self.wait(timeout)
+        results = {}
+        for job in self:
+            if job not in done:
+                continue
+            if job.cancelled():
+                results[job.consumer] = concurrent.futures.CancelledError()
+            else:
+                results[job.consumer] = job.exception() or job.result()
+        return results
+
+    def addDoneCallback(self, fn):
+        '''Calls fn with the broadcast once all of its jobs are complete'''
+        left = [len(self)]
+        lock = threading.Lock()
+
+        def onDone(job):
+            with lock:
+                left[0] -= 1
+                if left[0] > 0:
+                    return
+            try:
+                fn(self)
+            except Exception as e:
+                logging.error("Exception at callback: %s" % str(e))
+        if not self:
+            onDone(None)
+        for job in self:
+            job.add_done_callback(onDone)
 
 
 class Caster(object):
-    def __init__(self, maxThreads=4):
+    def __init__(self, maxThreads=4, maxQueue=0, timeout=None, outbox=None,
+                 deadline=None):
+        '''
+           :param maxThreads: number of worker threads, that run consumers
+           :param maxQueue: max number of pending jobs, including ones
+                            parked by rate limiters and ones being written
+                            to the outbox, 0 for no limit
+           :param timeout: seconds send() waits for free space in the queue,
+                           None to wait forever, 0 to reject at once
+           :param outbox: Outbox to persist jobs in, so that they are run
+                          even if the process stops before they are done.
+                          Jobs are queued once they are persisted
+           :param deadline: default seconds a job has since send() to be
+                            done, None for no limit, see send'''
         self.__maxThreads = maxThreads
+        self.__maxQueue = maxQueue
+        self.timeout = timeout
+        self.deadline = deadline
         self.__consumers = []
-        self.__maxJobId = 0
-        self.__maxJobIdLock = threading.Lock()
-        self.__renewLock = threading.Lock()
-        self.__threadPool = queue.Queue()
-        self.__activePool = {}  # jobId => thread
-        self.__activePoolLock = threading.Lock()
-
-    def __endJob(self, jobId):
-        self.__activePoolLock.acquire()
-        try:
-            self.__activePool[jobId]
-            self.__activePool.pop(jobId)
-            self.__renewActiveJobs()
-        finally:
-            self.__activePoolLock.release()
-
-    def __pushJob(self, fn):
-        self.__maxJobIdLock.acquire()
-        try:
-            jobId = self.__maxJobId
-            self.__maxJobId += 1
-        finally:
-            self.__maxJobIdLock.release()
-        self.__threadPool.put((jobId, fn))
-        self.__renewActiveJobs()
-
-    def __renewActiveJobs(self):
-        self.__renewLock.acquire()
+        self.__limiters = {}  # consumer => RateLimiter
+        self.__keys = {}  # consumer => key in the outbox
+        self.__outbox = outbox
+        self.__jobIds = itertools.count()
+        self.__condition = threading.Condition()
+        self.__pending = collections.deque()
+        self.__delayed = []  # (time to run at, job id, job)
+        self.__workers = []
+        self.__workerIds = itertools.count()
+        self.__running = {}  # job => worker thread
+        self.__watchdog = None
+        self.__active = 0
+        self.__abandoned = 0
+        self.__stopping = False
+        self.__reserved = 0  # places held for jobs being written to outbox
+
+    def __pushJobs(self, jobs, force=False, reserved=0):
+        '''
+           :param force: whether to ignore the queue limit
+           :param reserved: number of places held for the jobs by __reserve,
+                            they are pushed regardless of the limit'''
+        with self.__condition:
+            self.__reserved -= reserved
+            if reserved:
+                # some of the jobs may have been dropped as duplicates
+                self.__condition.notify_all()
+            if self.__stopping:
+                raise RuntimeError("caster is stopped")
+            if not force and not reserved:
+                self.__waitForRoom(len(jobs))
+            self.__pending.extend(jobs)
+            QUEUE_DEPTH.set(self.__queued())
+            self.__startWorkers()
+            if self.__watchdog == None and \
+               any(job.deadline != None for job in jobs):
+                self.__watchdog = threading.Thread(target=self.__watch,
+                                                   name='Caster-watchdog')
+                self.__watchdog.daemon = True
+                self.__watchdog.start()
+            self.__condition.notify_all()
+
+    def __reserve(self, n):
+        '''Holds places for n jobs, that are pushed once they are written
+           to the outbox, so that the writer thread never waits for them'''
+        with self.__condition:
+            if self.__stopping:
+                raise RuntimeError("caster is stopped")
+            self.__waitForRoom(n)
+            self.__reserved += n
+
+    def __waitForRoom(self, n):
+        '''Waits for room for n jobs in the queue. Must be called with the
+           condition held
+           :raises queue.Full: if there is no room for timeout seconds'''
+        # all consumers get the job or none of them
+        if self.__maxQueue > 0 and \
+           not self.__condition.wait_for(lambda: self.__queued() +
+                self.__reserved + n <= max(self.__maxQueue, n),
+                self.timeout):
+            raise queue.Full("caster queue is full")
+
+    def __queued(self):
+        '''Gets number of jobs, that wait for a worker, whether they may run
+           now or are parked by rate limiters. Must be called with the
+           condition held'''
+        return len(self.__pending) + len(self.__delayed)
+
+    def __startWorkers(self):
+        # must be called with the condition held
+        while len(self.__workers) < self.__maxThreads:
+            worker = threading.Thread(target=self.__work,
+                                      name='Caster-%d' %
+                                      next(self.__workerIds))
+            worker.daemon = True
+            self.__workers.append(worker)
+            worker.start()
+
+    def __work(self):
+        me = threading.current_thread()
+        while True:
+            with self.__condition:
+                # the worker was abandoned by the watchdog and replaced
+                if me not in self.__workers:
+                    return
+                job = self.__nextJob()
+                if job == None:
+                    self.__workers.remove(me)
+                    self.__condition.notify_all()
+                    return
+                self.__active += 1
+                ACTIVE_WORKERS.set(self.__active)
+                QUEUE_DEPTH.set(self.__queued())
+                # wakes up senders, that wait for free space, as well
+                self.__condition.notify_all()
+            try:
+                self.__run(job)
+            finally:
+                with self.__condition:
+                    self.__active -= 1
+                    ACTIVE_WORKERS.set(self.__active)
+
+    def __watch(self):
+        '''Fails running jobs, that are past their deadline, and replaces
+           their workers, so that a hung call does not hold a worker forever.
+           The call itself can't be interrupted, whatever it returns later
+           is dropped'''
+        while True:
+            with self.__condition:
+                now = time.time()
+                expired = [(job, worker)
+                           for job, worker in self.__running.items()
+                           if job.expired(now)]
+                for job, worker in expired:
+                    del self.__running[job]
+                    if worker in self.__workers:
+                        self.__workers.remove(worker)
+                        self.__abandoned += 1
+                        ABANDONED_WORKERS.inc()
+                if expired and not self.__stopping:
+                    self.__startWorkers()
+                if not expired:
+                    if self.__stopping and not self.__workers:
+                        self.__watchdog = None
+                        return
+                    deadlines = [job.deadline for job in self.__running
+                                 if job.deadline != None]
+                    if deadlines:
+                        self.__condition.wait(max(min(deadlines) - now, 0))
+                    else:
+                        self.__condition.wait()
+                    continue
+            for job, worker in expired:
+                logging.warning("%s is stuck at job %d, replacing it" %
+                                (worker.name, job.id))
+                self.__timeOut(job)
+
+    def __timeOut(self, job):
+        self.__finish(job, exception=concurrent.futures.TimeoutError(
+            "job %d missed its deadline" % job.id))
+
+    def __claim(self, job):
+        '''Takes a running job back from the watchdog
+           :rtype: whether the job is still ours to finish'''
+        with self.__condition:
+            if self.__running.pop(job, None) != None:
+                return True
+        logging.warning("dropping result of job %d, that missed its "
+                        "deadline" % job.id)
+        return False
+
+    def __nextJob(self):
+        '''Waits for a job, that may be run now. Must be called with the
+           condition held
+           :rtype: Job or None, if the caster is stopped'''
+        while True:
+            now = time.time()
+            due = []
+            while self.__delayed and self.__delayed[0][0] <= now:
+                due.append(heapq.heappop(self.__delayed)[2])
+            # delayed jobs were sent earlier, so they go first
+            self.__pending.extendleft(reversed(due))
+
+            if self.__pending:
+                job = self.__pending.popleft()
+                if job.attempts == 0 and job.cancelled():
+                    # lets waiters know, the limiter is left alone
+                    job.set_running_or_notify_cancel()
+                    continue
+                if job.limiter == None:
+                    return job
+                delay = job.limiter.acquire()
+                if delay <= 0:
+                    return job
+                # park the job, so that jobs of other consumers may run
+                heapq.heappush(self.__delayed, (now + delay, job.id, job))
+            elif self.__stopping and not self.__delayed:
+                return None
+            elif self.__delayed:
+                self.__condition.wait(self.__delayed[0][0] - now)
+            else:
+                self.__condition.wait()
+
+    def __run(self, job):
+        if job.attempts == 0 and not job.set_running_or_notify_cancel():
+            # cancelled after its call was acquired
+            if job.limiter != None:
+                job.limiter.cancel()
+            return
+        if job.expired():
+            # the job waited in the queue for too long
+            if job.limiter != None:
+                job.limiter.release(0, False)
+            self.__timeOut(job)
+            return
+        job.attempts += 1
+        started = time.time()
+        with self.__condition:
+            self.__running[job] = threading.current_thread()
+            if job.deadline != None:
+                self.__condition.notify_all()
         try:
-            while not self.__threadPool.empty() and \
-               len(self.__activePool) < self.__maxThreads:
-                jobId, fn = self.__threadPool.get()
-                thread = threading.Thread(target=fn, kwargs={'jobId': jobId})
-                self.__activePool[jobId] = thread
-                thread.start()
-        finally:
-            self.__renewLock.release()
-
-    def attach(self, consumer):
+            result = job.fn()
+        except Throttled as e:
+            if job.limiter == None:
+                if self.__claim(job):
+                    self.__finish(job, exception=e)
+                return
+            job.limiter.release(time.time() - started, False, True,
+                                e.retryAfter)
+            if not self.__claim(job):
+                return
+            if job.attempts > job.limiter.maxRetries:
+                self.__finish(job, exception=e)
+                return
+            # the limiter is drained now, so the job waits for a token
+            with self.__condition:
+                self.__pending.appendleft(job)
+                self.__condition.notify()
+            return
+        except Exception as e:
+            if job.limiter != None:
+                job.limiter.release(time.time() - started, False)
+            if self.__claim(job):
+                self.__finish(job, exception=e)
+            return
+        if job.limiter != None:
+            job.limiter.release(time.time() - started)
+        if self.__claim(job):
+            self.__finish(job, result)
+
+    def __finish(self, job, result=None, exception=None):
+        if exception == None:
+            JOBS.labels('done').inc()
+        elif isinstance(exception, concurrent.futures.TimeoutError):
+            JOBS.labels('timeout').inc()
+        else:
+            JOBS.labels('failed').inc()
+        if job.key != None and self.__outbox != None:
+            self.__outbox.ack(job.key, exception != None)
+        job.finish(result, exception)
+
+    def attach(self, consumer, limiter=None, key=None):
+        '''Attaches a consumer. Jobs of the consumer, that were left in the
+           outbox by the previous run, are replayed
+           :param limiter: RateLimiter for calls of the consumer, consumers
+                           sharing an API token should share it as well
+           :param key: name of the consumer in the outbox, that must stay the
+                       same between runs, defaults to its class name
+           :rtype: whether the consumer wasn't attached before'''
         if not consumer in self.__consumers:
+            if self.__outbox != None:
+                key = key or "%s.%s" % (type(consumer).__module__,
+                                        type(consumer).__name__)
+                if key in self.__keys.values():
+                    raise RuntimeError("consumer key %s is used already, "
+                                       "give each consumer its own" % key)
+                self.__keys[consumer] = key
             self.__consumers.append(consumer)
+            if limiter != None:
+                self.__limiters[consumer] = limiter
+            if self.__outbox != None:
+                self.__replay(consumer)
             return True
         else:
             return False
@@ -62,22 +411,108 @@ class Caster(object):
     def detach(self, consumer):
         if consumer in self.__consumers:
             self.__consumers.remove(consumer)
+            self.__limiters.pop(consumer, None)
+            self.__keys.pop(consumer, None)
             return True
         else:
             return False
 
-    def send(self, callback=None, *args, **kwargs):
+    def send(self, callback=None, *args, entryId=None, due=None,
+             deadline=None, **kwargs):
+        '''Passes a message to every attached consumer in background.
+           Calls of rate limited consumers are delayed until allowed
+           :param callback: called with each consumer's result or exception
+           :param entryId: id of the entry, that the message comes from,
+                           defaults to the one being processed by Scheduler
+                           in this thread. With an outbox, a consumer gets
+                           the message of a fire of an entry only once
+           :param due: scheduled fire time of the entry, that the message
+                       comes from, defaults to the one being processed
+           :param deadline: seconds each consumer has to be done, defaults to
+                            the one of the caster. Jobs, that are late, fail
+                            with concurrent.futures.TimeoutError and their
+                            workers are replaced
+           :raises queue.Full: if the queue stays full for timeout seconds
+           :rtype: Broadcast of Job, one per consumer'''
+        if entryId == None:
+            entryId = Scheduler.currentEntryId()
+            due = due or Scheduler.currentDue()
+        if deadline == None:
+            deadline = self.deadline
+        if deadline != None:
+            deadline += time.time()
+        jobs = Broadcast()
         for consumer in self.__consumers:
-            # a hack (entry=entry) to avoid lexical passing of object
-            # see: http://stackoverflow.com/questions/233673
-            def run(jobId=None, consumer=consumer):
-                try:
-                    result = consumer.consume(*args, **kwargs)
-                    if callback != None:
-                        callback(result)
-                except Exception as e:
-                    logging.error("Exception at consumer: %s" % str(e))
-                    callback(e)
-                finally:
-                    self.__endJob(jobId)
-            self.__pushJob(run)
\ No newline at end of file
+            key = None
+            if self.__outbox != None:
+                key = jobKey(entryId, self.__keys[consumer], due)
+            jobs.append(self.__makeJob(consumer, callback, args, kwargs, key,
+                                       deadline))
+        if self.__outbox == None:
+            self.__pushJobs(jobs)
+            return jobs
+
+        def onCommit(isNew, jobs=jobs):
+            # jobs, that were sent already, are dropped
+            for job, new in zip(jobs, isNew):
+                if not new:
+                    job.cancel()
+            self.__pushJobs([job for job, new in zip(jobs, isNew) if new],
+                            reserved=len(jobs))
+        # the limit is applied here, rather than by the writer thread
+        self.__reserve(len(jobs))
+        self.__outbox.add([(job.key, self.__keys[job.consumer], args, kwargs)
+                           for job in jobs], onCommit)
+        return jobs
+
+    def __makeJob(self, consumer, callback, args, kwargs, key=None,
+                  deadline=None):
+        fn = functools.partial(consumer.consume, *args, **kwargs)
+        return Job(next(self.__jobIds), consumer, fn, callback,
+                   self.__limiters.get(consumer), key, deadline)
+
+    def __replay(self, consumer):
+        deadline = self.deadline
+        if deadline != None:
+            deadline += time.time()
+        jobs = [self.__makeJob(consumer, None, args, kwargs, key, deadline)
+                for key, args, kwargs in
+                self.__outbox.pending(self.__keys[consumer])]
+        if jobs:
+            logging.info("replaying %d jobs of %s" % (len(jobs),
+                                                      self.__keys[consumer]))
+            self.__pushJobs(jobs, True)
+
+    def stop(self, wait=True):
+        '''Stops workers, once they are done with the pending jobs
+           :param wait: whether to wait for the workers to finish'''
+        me = threading.current_thread()
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+            if wait:
+                # workers leave the list once they are done, or once they
+                # are abandoned at a job past its deadline
+                self.__condition.wait_for(
+                    lambda: not [w for w in self.__workers if w != me])
+        if wait:
+            if self.__outbox != None:
+                # acks of the last jobs
+                self.__outbox.close()
+
+    def queueDepth(self):
+        '''Gets number of jobs, that wait for a free worker or for their rate
+           limiters'''
+        with self.__condition:
+            return self.__queued()
+
+    def activeWorkers(self):
+        '''Gets number of workers, that are running a job right now'''
+        with self.__condition:
+            return self.__active
+
+    def abandonedWorkers(self):
+        '''Gets number of workers, that were replaced, since they were stuck
+           at a job past its deadline'''
+        with self.__condition:
+            return self.__abandoned
@@ -0,0 +1,237 @@
+"""
+Persistent log of Caster jobs, so that consumer calls, that were sent but
+not complete, survive a crash or a restart and are replayed, when their
+consumer is attached again.
+
+Jobs are written by a single thread: whatever was sent or completed while
+the previous transaction was being committed goes into the next one, so
+send() never waits for the disk and a burst of jobs costs a few commits.
+Every job has a key, a job with the key of a job, that is pending or was
+done recently, is dropped, so a post is not made twice when the same fire
+of its entry is repeated after a restart. Keys of failed jobs may be used
+again, so that the post is retried.
+"""
+
+import logging
+import pickle
+import threading
+import time
+import uuid
+import schedcaster.scheduler as Scheduler
+from schedcaster.config.pool import ConnectionPool
+
+STATUS_PENDING = 0
+STATUS_DONE = 1
+STATUS_FAILED = 2
+
+
+def jobKey(entryId, consumerKey, due=None):
+    '''Gets key of a job, that passes a fire of an entry to a consumer.
+       Jobs, that don't belong to an entry, get unique keys
+       :param due: scheduled time of the fire, every fire of a recurring
+                   entry gets a key of its own
+       :rtype: bytes'''
+    if entryId == None:
+        return uuid.uuid4().bytes
+    return Scheduler.digest(repr((entryId, consumerKey, due))
+                            .encode('utf-8'))
+
+
+class Outbox(object):
+    # keeps 'in (...)' lists below sqlite's limit of statement parameters
+    __chunkSize = 500
+
+    def __init__(self, filename, retention=60 * 60 * 24):
+        '''
+           :param filename: sqlite database file, usually the one of Config
+           :param retention: seconds keys of done jobs are remembered'''
+        self.filename = filename
+        self.retention = retention
+        self.__pool = ConnectionPool(filename, 2)
+        self.__condition = threading.Condition()
+        self.__adds = []  # [(records, onCommit)]
+        self.__acks = []  # [(status, finished, key)]
+        self.__thread = None
+        self.__closing = False
+        self.__written = 0  # number of add/ack batches committed so far
+        self.__queued = 0  # number of add/ack batches queued so far
+        self.__added = 0
+        self.__duplicates = 0
+        self.__acked = 0
+        self.__commits = 0
+        self.__purged = time.time()
+        self.__makeTables()
+
+    def add(self, records, onCommit):
+        '''Queues jobs to be written
+           :param records: list of (key, consumer key, args, kwargs)
+           :param onCommit: called by the writer thread once the records are
+                            committed, with a list of flags telling which
+                            of them were new rather than duplicates'''
+        with self.__condition:
+            self.__adds.append((records, onCommit))
+            self.__wakeUp()
+
+    def ack(self, key, failed=False):
+        '''Queues a mark of a complete job'''
+        with self.__condition:
+            self.__acks.append((failed and STATUS_FAILED or STATUS_DONE,
+                                time.time(), key))
+            self.__wakeUp()
+
+    def pending(self, consumerKey):
+        '''Gets jobs of a consumer, that were not complete
+           :rtype: list of (key, args, kwargs)'''
+        self.flush()
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            # the status is inlined, so that the partial index is used
+            cursor.execute("""select key, payload from tbl_outbox
+                where consumer=? and status=%d order by created""" %
+                STATUS_PENDING, (consumerKey,))
+            return [(row[0],) + pickle.loads(row[1]) for row in cursor]
+
+    def flush(self):
+        '''Waits until everything queued so far is committed'''
+        with self.__condition:
+            target = self.__queued
+            self.__condition.wait_for(lambda: self.__written >= target or
+                                      self.__thread == None)
+
+    def close(self):
+        '''Commits everything queued and stops the writer thread. The
+           outbox may be used again afterwards'''
+        with self.__condition:
+            thread = self.__thread
+            self.__closing = True
+            self.__condition.notify_all()
+        if thread != None and thread != threading.current_thread():
+            thread.join()
+        with self.__condition:
+            self.__closing = False
+
+    def stats(self):
+        '''Gets a snapshot of outbox counters
+           :rtype: dict'''
+        with self.__condition:
+            return {
+                'queued': sum(len(records) for records, _ in self.__adds),
+                'added': self.__added,
+                'duplicates': self.__duplicates,
+                'acked': self.__acked,
+                'commits': self.__commits,
+            }
+
+    def __wakeUp(self):
+        # must be called with the condition held
+        self.__queued += 1
+        if self.__thread == None:
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='Outbox')
+            self.__thread.daemon = True
+            self.__thread.start()
+        self.__condition.notify_all()
+
+    def __run(self):
+        connection = self.__pool.checkout()
+        try:
+            while True:
+                with self.__condition:
+                    self.__condition.wait_for(lambda: self.__closing or
+                                              self.__adds or self.__acks)
+                    adds, self.__adds = self.__adds, []
+                    acks, self.__acks = self.__acks, []
+                    if not adds and not acks:
+                        self.__thread = None
+                        self.__condition.notify_all()
+                        return
+
+                try:
+                    results = self.__write(connection, adds, acks)
+                except Exception:
+                    logging.exception("failed to write the outbox")
+                    connection.rollback()
+                    # let the jobs run anyway, they are just not durable
+                    results = [[True] * len(records) for records, _ in adds]
+
+                for (records, onCommit), isNew in zip(adds, results):
+                    try:
+                        onCommit(isNew)
+                    except Exception:
+                        logging.exception("outbox commit callback failed")
+
+                with self.__condition:
+                    self.__written += len(adds) + len(acks)
+                    self.__condition.notify_all()
+        finally:
+            self.__pool.checkin(connection)
+
+    def __write(self, connection, adds, acks):
+        '''Writes a group of batches in a single transaction
+           :rtype: list of new record flags per batch'''
+        cursor = connection.cursor()
+        keys = [record[0] for records, _ in adds for record in records]
+        existing = set()
+        for i in range(0, len(keys), self.__chunkSize):
+            chunk = tuple(keys[i:i + self.__chunkSize])
+            # failed jobs don't hold their keys, they may be sent again
+            cursor.execute("""select key from tbl_outbox
+                where key in (%s) and status != %d""" % (
+                ",".join(('?',) * len(chunk)), STATUS_FAILED), chunk)
+            existing.update(row[0] for row in cursor)
+
+        now = time.time()
+        rows = []
+        results = []
+        for records, _ in adds:
+            isNew = []
+            for key, consumerKey, args, kwargs in records:
+                isNew.append(key not in existing)
+                if key in existing:
+                    self.__duplicates += 1
+                    continue
+                existing.add(key)
+                rows.append((key, consumerKey,
+                             pickle.dumps((args, kwargs)), now,
+                             STATUS_PENDING))
+            results.append(isNew)
+        cursor.executemany("""insert into tbl_outbox
+            (key, consumer, payload, created, status)
+            values
+            (?, ?, ?, ?, ?)
+            on conflict (key) do update set
+                consumer=excluded.consumer, payload=excluded.payload,
+                created=excluded.created, status=excluded.status,
+                finished=null""", rows)
+        cursor.executemany("""update tbl_outbox
+            set status=?, finished=?
+            where key=?""", acks)
+
+        if now - self.__purged > self.retention / 10:
+            # forget keys of jobs complete long ago
+            cursor.execute("""delete from tbl_outbox
+                where status != ? and finished < ?""",
+                (STATUS_PENDING, now - self.retention))
+            self.__purged = now
+        connection.commit()
+
+        self.__added += len(rows)
+        self.__acked += len(acks)
+        self.__commits += 1
+        return results
+
+    def __makeTables(self):
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""create table if not exists tbl_outbox
+            (key blob,
+             consumer text,
+             payload blob,
+             created real,
+             status integer,
+             finished real,
+             primary key (key));""")
+            cursor.execute("""create index if not exists idx_outbox_pending
+            on tbl_outbox (consumer, created) where status = %d;""" %
+                STATUS_PENDING)
+            connection.commit()
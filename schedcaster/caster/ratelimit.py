@@ -0,0 +1,151 @@
+"""
+Rate limiting of consumer calls. A RateLimiter combines a token bucket,
+that caps the call rate, with an AIMD (additive increase, multiplicative
+decrease) limit of concurrent calls, that adapts to errors and latency.
+Consumers, that share an API token, should share a limiter as well.
+"""
+
+import threading
+import time
+
+
+class Throttled(RuntimeError):
+    '''Raised by a consumer, when the remote side asks to slow down. Caster
+       delays and retries such calls rather than failing them'''
+    def __init__(self, message, retryAfter=None):
+        RuntimeError.__init__(self, message)
+        self.retryAfter = retryAfter
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        '''
+           :param rate: tokens added per second
+           :param burst: max number of tokens, that may be spent at once'''
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.__updated = time.time()
+
+    def take(self, now=None):
+        '''Takes a token if there is one
+           :rtype: 0 if a token was taken, else seconds until it is there'''
+        now = now or time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def delay(self, now=None):
+        '''Gets seconds until a token is there, without taking it'''
+        now = now or time.time()
+        tokens = min(self.burst,
+                     self.tokens + (now - self.__updated) * self.rate)
+        return max(0, (1 - tokens) / self.rate)
+
+    def drain(self, seconds):
+        '''Pauses the bucket, e.g. when the remote side throttles us'''
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class AdaptiveLimit(object):
+    '''Limit of concurrent calls, that grows by `increase` per limit calls,
+       that succeed, and shrinks `decrease` times on errors and slow calls'''
+    def __init__(self, initial=1, minimum=1, maximum=16, increase=1.0,
+                 decrease=0.5, targetLatency=None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.targetLatency = targetLatency
+        self.inFlight = 0
+
+    def tryAcquire(self):
+        if self.inFlight >= int(self.limit):
+            return False
+        self.inFlight += 1
+        return True
+
+    def release(self, latency, success=True):
+        self.inFlight -= 1
+        if success and (self.targetLatency == None or
+                        latency <= self.targetLatency):
+            self.limit = min(self.maximum,
+                             self.limit + self.increase / self.limit)
+        else:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class RateLimiter(object):
+    # seconds to wait before retrying, when the concurrency limit is hit
+    pollInterval = 0.05
+
+    def __init__(self, rate, burst=1, concurrency=None, maxRetries=10):
+        '''
+           :param rate: max calls per second
+           :param burst: max number of calls, that may be made at once
+           :param concurrency: AdaptiveLimit, defaults to one, that lets at
+                               most `burst` calls run simultaneously
+           :param maxRetries: number of times a throttled call is retried
+                              before it fails'''
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency or AdaptiveLimit(maximum=max(burst, 1))
+        self.maxRetries = maxRetries
+        self.__lock = threading.Lock()
+        self.__calls = 0
+        self.__throttled = 0
+        self.__errors = 0
+
+    def acquire(self):
+        '''Tries to start a call
+           :rtype: 0 if the call may start now, else seconds to wait'''
+        with self.__lock:
+            if not self.concurrency.tryAcquire():
+                return self.pollInterval
+            delay = self.bucket.take()
+            if delay > 0:
+                self.concurrency.inFlight -= 1
+            return delay
+
+    def release(self, latency, success=True, throttled=False,
+                retryAfter=None):
+        '''Reports the end of a call, that was started with acquire
+           :param latency: seconds the call took
+           :param success: whether the call succeeded
+           :param throttled: whether the remote side asked to slow down
+           :param retryAfter: seconds the remote side asked to wait'''
+        with self.__lock:
+            self.__calls += 1
+            if throttled:
+                self.__throttled += 1
+                self.bucket.drain(retryAfter or 1 / self.bucket.rate)
+            elif not success:
+                self.__errors += 1
+            self.concurrency.release(latency, success and not throttled)
+
+    def cancel(self):
+        '''Gives back a call, that was started with acquire, but was never
+           made or was abandoned, e.g. since its job was cancelled. Neither
+           the limit nor the counters are affected'''
+        with self.__lock:
+            self.concurrency.inFlight -= 1
+            self.bucket.tokens = min(self.bucket.burst,
+                                     self.bucket.tokens + 1)
+
+    def stats(self):
+        '''Gets a snapshot of limiter counters
+           :rtype: dict'''
+        with self.__lock:
+            return {
+                'rate': self.bucket.rate,
+                'tokens': self.bucket.tokens,
+                'limit': self.concurrency.limit,
+                'inFlight': self.concurrency.inFlight,
+                'calls': self.__calls,
+                'throttled': self.__throttled,
+                'errors': self.__errors,
+            }
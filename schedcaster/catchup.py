@@ -0,0 +1,95 @@
+"""
+Catch-up of one-shots, that were missed while the scheduler was down.
+Rather than firing all of them at once, schedulers put them into a
+CatchUpQueue, that releases the oldest ones first at a limited rate and
+tells which ones were missed by more than the grace time.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from schedcaster.caster.ratelimit import TokenBucket
+
+# status of one-shots, that were missed by more than the grace time
+STATUS_EXPIRED = 'expired'
+
+
+class CatchUpQueue(object):
+    def __init__(self, rate=1.0, burst=1, graceTime=None):
+        '''
+           :param rate: max number of jobs released per second
+           :param burst: max number of jobs, that may be released at once
+           :param graceTime: seconds after the due time, during which a job
+                             is still released, None for no limit'''
+        self.graceTime = graceTime
+        self.__bucket = TokenBucket(rate, burst)
+        self.__lock = threading.Lock()
+        self.__heap = []  # (due timestamp, sequence number, job)
+        self.__sequence = itertools.count()
+        self.__released = 0
+        self.__expired = 0
+
+    def put(self, job, due):
+        '''Queues an overdue job
+           :param due: timestamp the job was due at'''
+        with self.__lock:
+            heapq.heappush(self.__heap, (due, next(self.__sequence), job))
+
+    def pop(self, now=None):
+        '''Takes the oldest job, if it may be released now. Expired jobs are
+           taken regardless of the rate
+           :rtype: (job, due timestamp, whether it expired) or None, if no
+                   job may be released now, see wait'''
+        now = now or time.time()
+        with self.__lock:
+            if not self.__heap:
+                return None
+            due = self.__heap[0][0]
+            expired = self.__isExpired(due, now)
+            if not expired and self.__bucket.take(now) > 0:
+                return None
+            job = heapq.heappop(self.__heap)[2]
+            if expired:
+                self.__expired += 1
+            else:
+                self.__released += 1
+            return job, due, expired
+
+    def wait(self, now=None):
+        '''Gets seconds until pop may return a job
+           :rtype: float or None, if the queue is empty'''
+        now = now or time.time()
+        with self.__lock:
+            if not self.__heap:
+                return None
+            if self.__isExpired(self.__heap[0][0], now):
+                return 0
+            return self.__bucket.delay(now)
+
+    def clear(self):
+        with self.__lock:
+            self.__heap = []
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__heap)
+
+    def stats(self, now=None):
+        '''Gets backlog size, time to drain it and counters of released and
+           expired jobs
+           :rtype: dict'''
+        now = now or time.time()
+        with self.__lock:
+            return {
+                'backlog': len(self.__heap),
+                # expired jobs don't take time, but they can't be told apart
+                # without walking the heap, so it is an upper bound
+                'eta': len(self.__heap) / self.__bucket.rate,
+                'oldest': self.__heap and now - self.__heap[0][0] or 0.0,
+                'released': self.__released,
+                'expired': self.__expired,
+            }
+
+    def __isExpired(self, due, now):
+        return self.graceTime != None and now - due > self.graceTime
@@ -0,0 +1,194 @@
+import sqlite3 as sqlite
+import threading
+import contextlib
+import time
+
+
+class ConnectionPool(object):
+    '''Bounded pool of SQLite connections. A connection is checked out by a
+       single thread at a time, nested checkouts from the same thread get
+       the same connection back. Connections are opened in WAL mode, so
+       readers don't block behind writers'''
+
+    # applied to every new connection, see http://www.sqlite.org/pragma.html
+    pragmas = (
+        ("journal_mode", "wal"),
+        # safe in wal mode: only the last transactions may be lost on
+        # power failure, but db never gets corrupted
+        ("synchronous", "normal"),
+        # negative value is a size in KiB rather than in pages
+        ("cache_size", -8192),
+    )
+
+    def __init__(self, filename, maxSize=8, timeout=None, busyTimeout=30.0):
+        '''
+           :param filename: sqlite database file
+           :param maxSize: max number of simultaneously open connections
+           :param timeout: max seconds to wait for a free connection, None to
+                           wait forever
+           :param busyTimeout: seconds a connection waits for a db lock'''
+        self.filename = filename
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.busyTimeout = busyTimeout
+        self.__condition = threading.Condition()
+        self.__idle = []
+        self.__leases = {}  # thread -> [connection, depth]
+        self.__size = 0
+        self.__closed = False
+        self.__checkouts = 0
+        self.__waits = 0
+        self.__reaped = 0
+        self.__latencyTotal = 0.0
+        self.__latencyMax = 0.0
+
+    def checkout(self):
+        '''Gets a connection for the current thread, waiting for one to be
+           returned if the pool is exhausted
+           :rtype: sqlite3.Connection'''
+        thread = threading.current_thread()
+        started = time.time()
+        with self.__condition:
+            lease = self.__leases.get(thread)
+            if lease != None:
+                lease[1] += 1
+                self.__checkouts += 1
+                return lease[0]
+
+            waited = False
+            while not self.__idle and self.__size >= self.maxSize:
+                if self.__closed:
+                    raise RuntimeError("connection pool is closed")
+                if self.__reap():
+                    continue
+                if not waited:
+                    waited = True
+                    self.__waits += 1
+                remaining = None
+                if self.timeout != None:
+                    remaining = started + self.timeout - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError(
+                            "timed out waiting for a connection to %s" %
+                            self.filename)
+                # wake up from time to time to reap leases of dead threads
+                self.__condition.wait(min(remaining or 1.0, 1.0))
+
+            connection = None
+            if self.__idle:
+                connection = self.__idle.pop()
+            else:
+                self.__size += 1
+
+        if connection == None:
+            try:
+                connection = self.connect()
+            except:
+                with self.__condition:
+                    self.__size -= 1
+                    self.__condition.notify()
+                raise
+
+        with self.__condition:
+            self.__leases[thread] = [connection, 1]
+            self.__checkouts += 1
+            latency = time.time() - started
+            self.__latencyTotal += latency
+            self.__latencyMax = max(self.__latencyMax, latency)
+        return connection
+
+    def checkin(self, connection, close=False):
+        '''Returns a connection, obtained with checkout, to the pool. The
+           connection is really released only by the outermost checkin
+           :param close: whether to close the connection instead of reusing'''
+        thread = threading.current_thread()
+        with self.__condition:
+            lease = self.__leases.get(thread)
+            if lease == None or lease[0] is not connection:
+                # an abandoned generator may be finalized by another thread
+                owners = [owner for owner, lease in self.__leases.items()
+                          if lease[0] is connection]
+                if not owners:
+                    # already reaped
+                    return
+                thread = owners[0]
+                lease = self.__leases[thread]
+            lease[1] -= 1
+            if lease[1] > 0 and not close:
+                return
+            self.__leases.pop(thread)
+            self.__release(connection, close or self.__closed)
+            # there are at most maxSize leases, so it is cheap
+            self.__reap()
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''Context manager version of checkout/checkin'''
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def close(self):
+        '''Closes idle connections, connections in use are closed as soon as
+           they are returned'''
+        with self.__condition:
+            self.__closed = True
+            while self.__idle:
+                self.__idle.pop().close()
+                self.__size -= 1
+            self.__condition.notify_all()
+
+    def stats(self):
+        '''Gets a snapshot of pool counters
+           :rtype: dict'''
+        with self.__condition:
+            return {
+                'size': self.__size,
+                'maxSize': self.maxSize,
+                'idle': len(self.__idle),
+                'inUse': len(self.__leases),
+                'checkouts': self.__checkouts,
+                'waits': self.__waits,
+                'reaped': self.__reaped,
+                'latencyAvg': self.__checkouts and
+                              self.__latencyTotal / self.__checkouts or 0.0,
+                'latencyMax': self.__latencyMax,
+            }
+
+    def connect(self):
+        '''Opens a new connection with the settings of the pool, that isn't
+           counted by the pool, e.g. for a thread, that keeps it for itself
+           :rtype: sqlite3.Connection'''
+        # connections migrate between threads, but are never used by two
+        # threads at once
+        connection = sqlite.connect(self.filename, timeout=self.busyTimeout,
+                                    check_same_thread=False)
+        connection.text_factory = str
+        for name, value in self.pragmas:
+            connection.execute("pragma %s=%s" % (name, value))
+        return connection
+
+    def __release(self, connection, close):
+        # must be called with the condition held
+        if close:
+            connection.close()
+            self.__size -= 1
+        else:
+            # never hand an unfinished transaction over to another thread
+            if connection.in_transaction:
+                connection.rollback()
+            self.__idle.append(connection)
+        self.__condition.notify()
+
+    def __reap(self):
+        '''Takes back connections of threads that died without returning
+           them. Must be called with the condition held
+           :rtype: whether any connection was reaped'''
+        dead = [thread for thread in self.__leases if not thread.is_alive()]
+        for thread in dead:
+            connection = self.__leases.pop(thread)[0]
+            self.__release(connection, self.__closed)
+            self.__reaped += 1
+        return len(dead) > 0
@@ -0,0 +1,285 @@
+"""
+Sharded scheduling, so that several scheduler processes, on one host or
+on many hosts sharing the db, may serve the same config.
+
+Entries are split into a fixed number of shards by a hash of their ids. A
+process fires only entries of the shards it holds a lease on. Leases are
+rows of the db, that expire unless renewed, and every live process takes
+about an equal number of shards, so shards of a crashed process are taken
+over by the rest once their leases expire, and a new process gets its
+share once the others release it.
+
+A lease alone can't prevent double firing while a shard changes hands,
+so each fire is claimed by a row keyed by the entry id and the fire time,
+along with a check of the lease, in a single statement.
+"""
+
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+import schedcaster.scheduler as Scheduler
+from schedcaster.config.pool import ConnectionPool
+
+
+def shardOf(id, shards):
+    '''Gets the shard of an entry
+       :param shards: number of shards
+       :rtype: int'''
+    if not isinstance(id, bytes):
+        id = str(id).encode('utf-8')
+    return int.from_bytes(Scheduler.digest(id)[:8], 'big') % shards
+
+
+class ShardLeases(object):
+    def __init__(self, filename, shards=16, owner=None, ttl=30.0,
+                 retention=60 * 60 * 24):
+        '''
+           :param filename: sqlite database file, the one of Config
+           :param shards: number of shards, must be the same for every
+                          process sharing the db
+           :param owner: unique name of this process, defaults to host name,
+                         pid and a random suffix
+           :param ttl: seconds a lease lasts unless renewed, leases are
+                       renewed every ttl / 3 seconds
+           :param retention: seconds claims of fires are kept'''
+        self.filename = filename
+        self.shards = shards
+        self.owner = owner or "%s:%d:%s" % (socket.gethostname(),
+                                            os.getpid(), uuid.uuid4().hex[:8])
+        self.ttl = ttl
+        self.retention = retention
+        self.__pool = ConnectionPool(filename, 2)
+        self.__lock = threading.Lock()
+        self.__held = {}  # shard => timestamp our lease surely lasts until
+        self.__listeners = []
+        self.__stopped = None
+        self.__purged = 0
+        self.__claims = 0
+        self.__duplicates = 0
+        self.__makeTables()
+
+    def addListener(self, listener):
+        '''Adds a function, that is called with sets of acquired and
+           released shards, whenever shards held by this process change'''
+        self.__listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def start(self):
+        '''Takes a share of shards and keeps renewing the leases in
+           background'''
+        with self.__lock:
+            if self.__stopped != None:
+                return
+            self.__stopped = threading.Event()
+            stopped = self.__stopped
+        self.renew()
+        thread = threading.Thread(target=self.__run, args=(stopped,),
+                                  name='ShardLeases')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        '''Stops renewing the leases and gives the shards away at once'''
+        with self.__lock:
+            if self.__stopped == None:
+                return
+            self.__stopped.set()
+            self.__stopped = None
+            released = set(self.__held)
+            self.__held = {}
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""update tbl_leases
+                set owner=null, expires=0
+                where owner=?""", (self.owner,))
+            cursor.execute("""delete from tbl_workers where owner=?""",
+                           (self.owner,))
+            connection.commit()
+        self.__notify(set(), released)
+
+    def started(self):
+        return self.__stopped != None
+
+    def held(self):
+        '''Gets shards held by this process
+           :rtype: set of int'''
+        now = time.time()
+        with self.__lock:
+            return set(shard for shard, until in self.__held.items()
+                       if until > now)
+
+    def owns(self, id):
+        '''Tells whether an entry belongs to a shard held by this process'''
+        until = self.__held.get(shardOf(id, self.shards))
+        return until != None and until > time.time()
+
+    def claim(self, id, fire):
+        '''Claims a fire of an entry. Only one process gets a claim of the
+           same fire, and only while it holds the lease on the shard
+           :param fire: timestamp the entry is fired for
+           :rtype: whether the entry should be fired by this process'''
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""insert or ignore into tbl_fires
+                (id, fire, owner)
+                select ?, ?, ?
+                where exists (select 1 from tbl_leases
+                    where shard=? and owner=? and expires>?)""",
+                (id, fire, self.owner, shardOf(id, self.shards), self.owner,
+                 time.time()))
+            claimed = cursor.rowcount == 1
+            connection.commit()
+        with self.__lock:
+            if claimed:
+                self.__claims += 1
+            else:
+                self.__duplicates += 1
+        return claimed
+
+    def claimed(self, id, fire):
+        '''Tells whether a fire of an entry was claimed by any process, e.g.
+           to tell a fire done elsewhere from a claim refused because the
+           lease lapsed'''
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""select 1 from tbl_fires
+                where id=? and fire=?""", (id, fire))
+            return cursor.fetchone() != None
+
+    def renew(self):
+        '''Renews the leases held and takes or gives away shards, so that
+           every live process holds about the same number of them'''
+        started = time.time()
+        expires = started + self.ttl
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            # other processes must not take the same shards meanwhile
+            cursor.execute("""begin immediate""")
+            try:
+                cursor.execute("""insert or replace into tbl_workers
+                    (owner, expires)
+                    values
+                    (?, ?)""", (self.owner, expires))
+                cursor.execute("""delete from tbl_workers where expires<?""",
+                               (started,))
+                cursor.execute("""select count(*) from tbl_workers""")
+                share = int(math.ceil(self.shards / cursor.fetchone()[0]))
+
+                cursor.execute("""update tbl_leases set expires=?
+                    where owner=?""", (expires, self.owner))
+                cursor.execute("""select shard from tbl_leases
+                    where owner=? order by shard""", (self.owner,))
+                mine = [row[0] for row in cursor]
+                if len(mine) > share:
+                    cursor.executemany("""update tbl_leases
+                        set owner=null, expires=0
+                        where shard=?""", [(shard,) for shard in mine[share:]])
+                    mine = mine[:share]
+                elif len(mine) < share:
+                    cursor.execute("""select shard from tbl_leases
+                        where owner is null or expires<?
+                        order by shard limit ?""",
+                        (started, share - len(mine)))
+                    free = [row[0] for row in cursor]
+                    cursor.executemany("""update tbl_leases
+                        set owner=?, expires=?, epoch=epoch+1
+                        where shard=?""",
+                        [(self.owner, expires, shard) for shard in free])
+                    mine += free
+
+                if started - self.__purged > self.retention / 10:
+                    cursor.execute("""delete from tbl_fires where fire<?""",
+                                   (started - self.retention,))
+                    self.__purged = started
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+
+        with self.__lock:
+            if self.__stopped == None:
+                # stopped meanwhile, the leases are released already
+                return
+            acquired = set(mine) - set(self.__held)
+            released = set(self.__held) - set(mine)
+            # counted from before the write, so that it never outlasts the
+            # lease as other processes see it
+            self.__held = dict((shard, expires) for shard in mine)
+        if acquired or released:
+            logging.info("%s holds shards %s" % (self.owner, sorted(mine)))
+            self.__notify(acquired, released)
+
+    def stats(self):
+        '''Gets a snapshot of lease counters
+           :rtype: dict'''
+        with self.__lock:
+            return {
+                'held': len(self.__held),
+                'claims': self.__claims,
+                'duplicates': self.__duplicates,
+            }
+
+    def __notify(self, acquired, released):
+        for listener in list(self.__listeners):
+            try:
+                listener(acquired, released)
+            except Exception:
+                logging.exception("shard listener failed")
+
+    def __run(self, stopped):
+        while not stopped.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except Exception:
+                # leases are kept until they expire, the next renewal may
+                # still make it
+                logging.exception("failed to renew shard leases")
+                with self.__lock:
+                    now = time.time()
+                    lost = set(shard for shard, until in self.__held.items()
+                               if until <= now)
+                if lost:
+                    self.__notify(set(), lost)
+
+    def __makeTables(self):
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""begin immediate""")
+            try:
+                cursor.execute("""create table if not exists tbl_leases
+                (shard integer,
+                 owner text,
+                 expires real,
+                 epoch integer,
+                 primary key (shard));""")
+                cursor.execute("""create table if not exists tbl_workers
+                (owner text,
+                 expires real,
+                 primary key (owner));""")
+                cursor.execute("""create table if not exists tbl_fires
+                (id blob,
+                 fire real,
+                 owner text,
+                 primary key (id, fire));""")
+                cursor.execute("""select count(*) from tbl_leases""")
+                count = cursor.fetchone()[0]
+                if count == 0:
+                    cursor.executemany("""insert into tbl_leases
+                        (shard, owner, expires, epoch)
+                        values
+                        (?, null, 0, 0)""",
+                        [(shard,) for shard in range(self.shards)])
+                elif count != self.shards:
+                    raise RuntimeError("%s is split into %d shards, not %d" %
+                                       (self.filename, count, self.shards))
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
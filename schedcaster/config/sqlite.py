@@ -1,19 +1,59 @@
-import sqlite3 as sqlite
-import types
+import collections
 import threading
+import time
+import types
 import schedcaster.scheduler as Scheduler
+from schedcaster import metrics as Metrics
+from schedcaster.config.pool import ConnectionPool
+
+QUERY_SECONDS = Metrics.histogram('schedcaster_config_query_seconds',
+    'Seconds taken by config queries', ('query',))
 
 
 class Config(object):
     '''Config provider for Scheduler service, that uses SQLite to store
        schedules'''
-    # should be used, because sqlite3 connections are not thread-safe
-    __connectionPool = {}  # threadHash -> connection
+    # keeps 'in (...)' lists below sqlite's limit of statement parameters
+    __chunkSize = 500
+    # stored in 'pragma user_version', see __migrate
+    __schemaVersion = 2
+    # columns of tbl_sched, that may be updated
+    __columns = ('cron', 'state', 'name', 'handler', 'status', 'next_fire')
+    # condition of active entries, that idx_sched_next_fire is made for
+    __active = "(state & 1) = 0"
+    # columns of tbl_sched, that are logged to tbl_changes when updated
+    __logged = ('cron', 'state', 'name', 'handler', 'status')
+    # min seconds between prunes of tbl_changes
+    __pruneInterval = 60 * 60
 
-    def __init__(self, filename):
+    def __init__(self, filename, poolSize=8, cacheSize=0,
+                 changeRetention=60 * 60 * 24):
+        '''
+           :param filename: sqlite database file
+           :param poolSize: max number of connections, that are used
+                            simultaneously by different threads
+           :param cacheSize: max number of entries, that get and getArgs
+                             keep in memory, least recently used ones are
+                             dropped first, 0 to always read the db
+           :param changeRetention: seconds changes are kept in the change
+                                   log, see changesSince'''
         self.filename = filename
-        # can't use persistent connection, because it is not thread-safe
-        #self.connection = sqlite.connect(filename)
+        # sqlite3 connections must not be shared between threads at the same
+        # time, so every call checks out its own connection from the pool
+        self.__pool = ConnectionPool(filename, poolSize)
+        self.cacheSize = cacheSize
+        self.changeRetention = changeRetention
+        self.__cache = collections.OrderedDict()  # id => Entry
+        self.__cacheLock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        # a connection of its own, 'pragma data_version' of which tells
+        # whether anyone else has written to the db since the last check
+        self.__watch = None
+        self.__watchLock = threading.Lock()
+        self.__dataVersion = None
+        self.__position = None  # last change of the log seen by the cache
+        self.__pruned = 0.0
 
         self.__makeTables()
 
@@ -26,35 +66,51 @@ class Config(object):
            :param commit: whether to autocommit changes after the function call
            :param close: whether to close connection after the call'''
         def decorator(fn):
+            timer = QUERY_SECONDS.labels(fn.__name__)
+
             def withConnection(self, *args, **kwargs):
-                selfClass = self.__class__
-                # doesn't work for some reason
-                #threadHash = hash(threading.currentThread())
-                threadHash = threading.currentThread()
-                connection = None
-                if (threadHash in selfClass.__connectionPool and\
-                  selfClass.__connectionPool[threadHash] != None):
-                    connection = selfClass.__connectionPool[threadHash]
-                else:
-                    connection = sqlite.connect(self.filename)
-                    connection.text_factory = str
-                    selfClass.__connectionPool[threadHash] = connection
-                ret = fn(self, connection, *args, **kwargs)
-                if commit:
-                    connection.commit()
-                if close:
-                    connection.close()
-                    selfClass.__connectionPool[threadHash] = None
+                started = time.perf_counter()
+                connection = self.__pool.checkout()
+                try:
+                    ret = fn(self, connection, *args, **kwargs)
+                    if commit:
+                        connection.commit()
+                except:
+                    # don't let a half-done transaction be committed by
+                    # the next call on the same connection
+                    if commit:
+                        connection.rollback()
+                    raise
+                finally:
+                    self.__pool.checkin(connection, close)
+                    timer.observe(time.perf_counter() - started)
                 return ret
             return withConnection
         return decorator
 
+    def close(self):
+        '''Closes all connections to the db'''
+        with self.__watchLock:
+            if self.__watch != None:
+                self.__watch.close()
+                self.__watch = None
+        self.__pool.close()
+
+    def poolStats(self):
+        '''Gets connection pool counters, see ConnectionPool.stats
+           :rtype: dict'''
+        return self.__pool.stats()
+
     @__requireConnection()
     def clear(self, connection):
         '''Removes all schedules from the db'''
         cursor = connection.cursor()
         cursor.execute("""delete from tbl_sched;""")
         cursor.execute("""delete from tbl_sched_args;""")
+        cursor.execute("""delete from tbl_imports;""")
+        self.__advance(connection)
+        with self.__cacheLock:
+            self.__cache.clear()
 
     def saveOrUpdate(self, entry):
         '''Saves an object, if it doesn't exists else updates
@@ -67,17 +123,154 @@ class Config(object):
         else:
             self.update(entry)
 
+    @__requireConnection()
+    def saveMany(self, connection, entries):
+        '''Saves or updates many entries at once inside a single transaction.
+           Existing rows and args are fetched in bulk and compared with the
+           given entries, so only new or changed rows are written. As with
+           update, args missing from an entry are left intact in the db
+           :param entries: iterable of entries with unique ids
+           :rtype: SaveStats'''
+        stats = SaveStats()
+        chunk = []
+        for entry in entries:
+            if entry.id == None:
+                raise RuntimeError("entry must have a unique id")
+            chunk.append(entry)
+            if len(chunk) >= self.__chunkSize:
+                self.__saveChunk(connection, chunk, stats)
+                chunk = []
+        if chunk:
+            self.__saveChunk(connection, chunk, stats)
+        if stats.inserted or stats.updated:
+            self.__advance(connection)
+
+        return stats
+
+    @__requireConnection()
+    def updateMany(self, connection, updates, track=True):
+        '''Updates columns of many entries at once inside a single
+           transaction. Only the given columns are written, args are left
+           intact
+           :param updates: iterable of (id, map of column names to values)
+           :param track: whether the update advances changeCounter,
+                         schedulers don't track states of fired entries,
+                         they already know of them
+           :rtype: number of entries updated'''
+        # entries, that change the same columns, share a statement
+        groups = {}
+        changed = []
+        for id, columns in updates:
+            for name in columns:
+                if name not in self.__columns:
+                    raise RuntimeError("unknown column: %s" % name)
+            # entries don't hold next_fire, so their cached copies are kept
+            if any(name in self.__logged for name in columns):
+                changed.append(id)
+            if ('cron' in columns or 'state' in columns) and \
+               'next_fire' not in columns:
+                columns = dict(columns)
+                state = columns.get('state')
+                if 'cron' in columns and 'state' in columns or \
+                   state != None and state & Scheduler.STATE_DONE:
+                    columns['next_fire'] = Scheduler.nextFireOf(
+                        columns.get('cron'), state)
+                else:
+                    # it is unknown without both, 0 makes the entry due
+                    # now, so that a scheduler loads it and sorts it out
+                    columns['next_fire'] = 0
+            names = tuple(sorted(columns))
+            groups.setdefault(names, []).append(
+                tuple(columns[name] for name in names) + (id,))
+
+        cursor = connection.cursor()
+        updated = 0
+        for names, rows in groups.items():
+            cursor.executemany("""update tbl_sched set %s where id=?""" %
+                               ", ".join("%s=?" % name for name in names),
+                               rows)
+            updated += cursor.rowcount
+        if track and updated:
+            self.__advance(connection)
+        elif updated:
+            # schedulers flush fire states untracked, and may be the only
+            # writers of the db
+            self.__prune(connection)
+        self.__uncache(changed)
+        return updated
+
+    @__requireConnection()
+    def remove(self, connection, ids):
+        '''Removes entries along with their args
+           :param ids: list of entry ids
+           :rtype: number of entries removed'''
+        cursor = connection.cursor()
+        removed = 0
+        for i in range(0, len(ids), self.__chunkSize):
+            chunk = tuple(ids[i:i + self.__chunkSize])
+            placeholders = ",".join(('?',) * len(chunk))
+            cursor.execute("""delete from tbl_sched where id in (%s)""" %
+                           placeholders, chunk)
+            removed += cursor.rowcount
+            cursor.execute("""delete from tbl_sched_args
+                where source_id in (%s)""" % placeholders, chunk)
+        if removed:
+            self.__advance(connection)
+        self.__uncache(ids)
+        return removed
+
+    @__requireConnection(commit=False)
+    def getImport(self, connection, source):
+        '''Gets fingerprint of the last import of a file
+           :param source: name of the imported file
+           :rtype: (size, mtime, digest) or None, if it wasn't imported'''
+        cursor = connection.cursor()
+        cursor.execute("""select size, mtime, digest from tbl_imports
+            where source=?""", (source,))
+        row = cursor.fetchone()
+        return row and tuple(row)
+
+    @__requireConnection()
+    def saveImport(self, connection, source, size, mtime, digest):
+        '''Remembers fingerprint of an imported file'''
+        cursor = connection.cursor()
+        cursor.execute("""insert into tbl_imports
+            (source, size, mtime, digest)
+            values
+            (?, ?, ?, ?)
+            on conflict (source) do update set
+                size=excluded.size, mtime=excluded.mtime,
+                digest=excluded.digest""", (source, size, mtime, digest))
+
+    def iterateImported(self, source):
+        '''Gets ids and hashes of the entries, that were imported from a
+           file, without loading the entries themselves
+           :param source: name of the imported file
+           :rtype: generator of (id, hash)'''
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            # the arg name is inlined, so that the partial index is used
+            cursor.execute("""select i.source_id, h.value
+                from tbl_sched_args i
+                left join tbl_sched_args h
+                    on h.source_id = i.source_id and h.name = ?
+                where i.name = '%s' and i.value = ?""" % Scheduler.ARG_IMPORT,
+                (Scheduler.ARG_HASH, source))
+            for row in cursor:
+                yield row[0], row[1]
+
     @__requireConnection()
     def save(self, connection, entry):
         '''Save a new entry and update input object's id accordingly
            :param entry: entry to save'''
         cursor = connection.cursor()
         cursor.execute("""insert into tbl_sched
-            (id, cron, state, name, handler, status)
+            (id, cron, state, name, handler, status, next_fire)
             values
-            (?, ?, ?, ?, ?, ?)""",
+            (?, ?, ?, ?, ?, ?, ?)""",
             (entry.id, entry.cron, entry.state, entry.name,
-            entry.handler, entry.status))
+            entry.handler, entry.status,
+            Scheduler.nextFireOf(entry.cron, entry.state)))
         cursor = connection.cursor()
         cursor.execute("""select (last_insert_rowid());""")
         #id = cursor.fetchone()[0]
@@ -91,6 +284,8 @@ class Config(object):
                 values
                 (?, ?, ?);""",
                 (entry.id, arg.name, arg.value))
+        self.__advance(connection)
+        self.__uncache((entry.id,))
 
     @__requireConnection()
     def update(self, connection, entry):
@@ -102,10 +297,10 @@ class Config(object):
         cursor = connection.cursor()
         cursor.execute("""update tbl_sched
             set
-                cron=?, state=?, name=?, handler=?, status=?
+                cron=?, state=?, name=?, handler=?, status=?, next_fire=?
             where id=?""",
             (entry.cron, entry.state, entry.name, entry.handler, entry.status,
-            entry.id))
+            Scheduler.nextFireOf(entry.cron, entry.state), entry.id))
 
         for arg in entry.args.values():
             cursor = connection.cursor()
@@ -133,46 +328,156 @@ class Config(object):
                         values
                         (?, ?, ?)""",
                         (entry.id, arg.name, arg.value))
+        self.__advance(connection)
+        self.__uncache((entry.id,))
 
-    @__requireConnection()
-    def get(self, connection, id=None):
+    @__requireConnection(commit=False)
+    def changeCounter(self, connection):
+        '''Gets a number, that grows with every change of entries made by
+           a Config, so that data derived from them, e.g. a snapshot of a
+           scheduler, can tell whether it is stale
+           :rtype: int'''
+        cursor = connection.cursor()
+        cursor.execute("""select value from tbl_counters
+            where name = 'changes'""")
+        return cursor.fetchone()[0]
+
+    def changesSince(self, position=None):
+        '''Gets ids of entries, that were changed after a position of the
+           change log, whether by this or by other processes. It is cheap,
+           when nothing was written to the db, so it may be polled often.
+           Updates of next_fire alone are not logged
+           :param position: position returned by an earlier call, None to
+                            get the current position only
+           :rtype: (position, set of ids), ids are None, if the changes were
+                   pruned from the log before they were seen, then all
+                   entries must be read again'''
+        current = self.__poll()
+        if position == None or position == current:
+            return current, set()
+        with self.__pool.connection() as connection:
+            return self.__readChanges(connection, position)
+
+    def cacheStats(self):
+        '''Gets counters of the entry cache
+           :rtype: dict'''
+        with self.__cacheLock:
+            return {
+                'size': len(self.__cache),
+                'maxSize': self.cacheSize,
+                'hits': self.__hits,
+                'misses': self.__misses,
+            }
+
+    @QUERY_SECONDS.labels('get').time()
+    def get(self, id=None):
         '''Get:
            a) all entries if id = None
            b) some entries if id is a list pr a tuple of ids (e.g. id=[1,2,3])
            c) one entry if id is an integer (e.g. id=3)
            Independent of input parameters, method always returns an _array_ of
-           entries.
+           entries. Entries of the given ids are served from the cache, if it
+           is enabled
            :param id: int, [int] or None, specifying the criteria of fetching
            :rtype: list of int'''
-        cursor = connection.cursor()
+        if id == None or self.cacheSize <= 0:
+            return list(self.iterate(id))
+        ids = id if isinstance(id, (list, tuple)) else [id]
+        return self.__getCached(ids)
+
+    @QUERY_SECONDS.labels('getActive').time()
+    def getActive(self):
+        '''Gets all entries with their DONE mark unset.
+           :rtype: list of int'''
+        return list(self.iterateActive())
+
+    @QUERY_SECONDS.labels('getArgs').time()
+    def getArgs(self, id):
+        '''Gets args of an entry, from the cache, if it is enabled
+           :rtype: map of arg names to Arg'''
+        if self.cacheSize > 0:
+            entries = self.__getCached([id])
+            return entries and entries[0].args or {}
+        with self.__pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""select name, value from tbl_sched_args
+                where source_id=?""", (id,))
+            entry = Scheduler.Entry(id)
+            arrays = {}
+            for name, value in cursor:
+                self.__addArg(entry, arrays, name, value)
+            return self.__finishEntry(entry, arrays).args
+
+    def iterate(self, id=None):
+        '''Same as get, but yields entries one by one, so that the whole
+           result set is never held in memory at once
+           :param id: int, [int] or None, specifying the criteria of fetching
+           :rtype: generator of entries'''
+        # a generator can't use __requireConnection, because the connection
+        # must stay checked out until the generator is exhausted
+        with self.__pool.connection() as connection:
+            for entry in self.__iterate(connection, id):
+                yield entry
+
+    def __iterate(self, connection, id):
         if id == None:
-            cursor.execute("""select id, cron, state, name, handler, status
-                from tbl_sched;""")
-        elif type(id) == types.ListType or type(id) == types.TupleType:
-            # hack, because '?' placeholder doesn't support lists
+            for entry in self.__queryEntries(connection, "", ()):
+                yield entry
+        elif isinstance(id, (list, tuple)):
+            # '?' placeholder doesn't support lists, and the number of
+            # placeholders per statement is limited, so query in chunks
             # see http://stackoverflow.com/questions/7418849/
-            cursor.execute("""select id, cron, state, name, handler, status
-                from tbl_sched where id in (%s)""" %
-                ",".join(('?',) * len(id)), id)
+            for i in range(0, len(id), self.__chunkSize):
+                chunk = tuple(id[i:i + self.__chunkSize])
+                for entry in self.__queryEntries(connection,
+                  "where s.id in (%s)" % ",".join(('?',) * len(chunk)),
+                  chunk):
+                    yield entry
         else:
-            cursor.execute("""select id, cron, state, name, handler, status
-                from tbl_sched where id=?""", (id,))
+            for entry in self.__queryEntries(connection, "where s.id=?",
+                                             (id,)):
+                yield entry
 
-        return self.__makeEntries(cursor)
+    def iterateActive(self):
+        '''Same as getActive, but yields entries one by one
+           :rtype: generator of entries'''
+        with self.__pool.connection() as connection:
+            for entry in QUERY_SECONDS.labels('iterateActive').timeIteration(
+                    self.__queryEntries(connection,
+                                        "where %s" % self.__active, ())):
+                yield entry
 
-    @__requireConnection()
-    def getActive(self, connection):
-        '''Gets all entries with their DONE mark unset.
-           :rtype: list of int'''
-        cursor = connection.cursor()
-        cursor.execute("""select id, cron, state, name, handler, status
-            from tbl_sched where (state & 1) = 0""")
+    @QUERY_SECONDS.labels('getDue').time()
+    def getDue(self, until):
+        '''Gets active entries, that are due to be fired by the given time,
+           including missed one-shots, that were not done yet
+           :param until: timestamp
+           :rtype: list of entries'''
+        return list(self.iterateDue(until))
 
-        return self.__makeEntries(cursor)
+    def iterateDue(self, until):
+        '''Same as getDue, but yields entries one by one
+           :rtype: generator of entries'''
+        with self.__pool.connection() as connection:
+            # the condition of the partial index must be repeated verbatim,
+            # and the ids are selected apart, or else ordering by id makes
+            # the planner scan the whole table by its primary key
+            for entry in QUERY_SECONDS.labels('iterateDue').timeIteration(
+                    self.__queryEntries(connection,
+                    """where s.id in (select id from tbl_sched
+                        where %s and next_fire <= ?)""" % self.__active,
+                    (until,))):
+                yield entry
 
     @__requireConnection()
     def __makeTables(self, connection):
         cursor = connection.cursor()
+        cursor.execute("""pragma user_version""")
+        version = cursor.fetchone()[0]
+        cursor.execute("""select count(*) from sqlite_master
+            where type = 'table' and name = 'tbl_sched'""")
+        if cursor.fetchone()[0] and version < self.__schemaVersion:
+            self.__migrate(connection, version)
         cursor.execute("""create table if not exists tbl_sched
         (id blob,
          cron varchar,
@@ -180,12 +485,189 @@ class Config(object):
          name varchar,
          handler varchar,
          status text,
+         next_fire real,
          primary key (id));""")
+        cursor.execute("""create index if not exists idx_sched_next_fire
+        on tbl_sched (next_fire) where %s;""" % self.__active)
         cursor.execute("""create table if not exists tbl_sched_args
         (source_id integer,
          name varchar,
          value text,
          primary key (source_id, name));""")
+        cursor.execute("""create index if not exists idx_sched_args_import
+        on tbl_sched_args (value) where name = '%s';""" % Scheduler.ARG_IMPORT)
+        cursor.execute("""create table if not exists tbl_imports
+        (source text,
+         size integer,
+         mtime real,
+         digest blob,
+         primary key (source));""")
+        cursor.execute("""create table if not exists tbl_counters
+        (name text,
+         value integer,
+         primary key (name));""")
+        cursor.execute("""insert or ignore into tbl_counters (name, value)
+            values ('changes', 0)""")
+        # ids of changed entries are logged by triggers, so that writes of
+        # other processes and tools are seen too
+        cursor.execute("""create table if not exists tbl_changes
+        (seq integer primary key autoincrement,
+         id blob,
+         time real);""")
+        now = "(julianday('now') - 2440587.5) * 86400.0"
+        for table, column, events in (
+                ('tbl_sched', 'id', (
+                    ('insert', 'new'), ('delete', 'old'),
+                    ('update of %s' % ", ".join(self.__logged), 'new'))),
+                ('tbl_sched_args', 'source_id', (
+                    ('insert', 'new'), ('delete', 'old'),
+                    ('update', 'new')))):
+            for event, row in events:
+                cursor.execute("""create trigger if not exists trg_%s_%s
+                    after %s on %s
+                    begin
+                        insert into tbl_changes (id, time)
+                        values (%s.%s, %s);
+                    end;""" % (table[4:], event.split()[0], event, table,
+                                  row, column, now))
+        cursor.execute("""pragma user_version=%d""" % self.__schemaVersion)
+
+    def __migrate(self, connection, version):
+        '''Upgrades db made by an older version of the schema'''
+        cursor = connection.cursor()
+        if version < 1:
+            # ids made by parsers used to be whole utf-16 strings of hash
+            # columns, now they are compact digests of the same strings.
+            # Only ids starting with a utf-16 byte order mark are parser
+            # made, ids given by others are left as they are
+            connection.create_function('schedcaster_id', 1,
+                                       Scheduler.makeId)
+            parserMade = """typeof(%s) = 'blob'
+                and substr(%s, 1, 2) in (x'fffe', x'feff')
+                and length(%s) %% 2 = 0"""
+            cursor.execute("""update tbl_sched set id = schedcaster_id(id)
+                where %s""" % (parserMade % (('id',) * 3)))
+            cursor.execute("""update tbl_sched_args
+                set source_id = schedcaster_id(source_id)
+                where %s""" % (parserMade % (('source_id',) * 3)))
+        if version < 2:
+            # time of the next fire is kept, so that schedulers may load
+            # only entries due soon
+            cursor.execute("""alter table tbl_sched
+                add column next_fire real""")
+            connection.create_function('schedcaster_next_fire', 2,
+                                       Scheduler.nextFireOf)
+            cursor.execute("""update tbl_sched
+                set next_fire = schedcaster_next_fire(cron, state)""")
+
+    def __advance(self, connection):
+        '''Advances the change counter within the current transaction, and
+           prunes the change log from time to time'''
+        connection.cursor().execute("""update tbl_counters
+            set value = value + 1 where name = 'changes'""")
+        self.__prune(connection)
+
+    def __prune(self, connection):
+        '''Drops changes older than changeRetention from the change log
+           within the current transaction, at most once per __pruneInterval'''
+        now = time.time()
+        if now - self.__pruned >= self.__pruneInterval:
+            self.__pruned = now
+            connection.cursor().execute("""delete from tbl_changes
+                where time < ?""", (now - self.changeRetention,))
+
+    def __poll(self):
+        '''Drops entries, that were changed by anyone, from the cache. The
+           log is read only if the db was written to since the last call.
+           The log is pruned from here as well, for readers, that never
+           write to the db
+           :rtype: position of the last change'''
+        if time.time() - self.__pruned >= self.__pruneInterval:
+            with self.__pool.connection() as connection:
+                self.__prune(connection)
+                connection.commit()
+        with self.__watchLock:
+            if self.__watch == None:
+                self.__watch = self.__pool.connect()
+            cursor = self.__watch.cursor()
+            cursor.execute("""pragma data_version""")
+            version = cursor.fetchone()[0]
+            if version == self.__dataVersion:
+                return self.__position
+            position, ids = self.__readChanges(self.__watch, self.__position)
+            self.__dataVersion = version
+            self.__position = position
+        if ids == None:
+            with self.__cacheLock:
+                self.__cache.clear()
+        else:
+            self.__uncache(ids)
+        return position
+
+    def __readChanges(self, connection, position):
+        '''Reads ids of entries changed after a position of the change log
+           :param position: seq of a change, None to get the last one only
+           :rtype: (seq of the last change, set of ids or None, if changes
+                   after the position were pruned already)'''
+        cursor = connection.cursor()
+        # a single read transaction, so that the log isn't pruned meanwhile
+        cursor.execute("""begin""")
+        try:
+            cursor.execute("""select seq from sqlite_sequence
+                where name = 'tbl_changes'""")
+            row = cursor.fetchone()
+            last = row and row[0] or 0
+            if position == None or position == last:
+                return last, set()
+            cursor.execute("""select min(seq) from tbl_changes""")
+            first = cursor.fetchone()[0]
+            if position > last or first == None or first > position + 1:
+                return last, None
+            cursor.execute("""select id from tbl_changes
+                where seq > ? and seq <= ?""", (position, last))
+            return last, set(row[0] for row in cursor)
+        finally:
+            cursor.execute("""commit""")
+
+    def __getCached(self, ids):
+        '''Gets entries from the cache, reading missing ones from the db.
+           Copies of the cached entries are returned, args are shared
+           between them and must not be changed
+           :rtype: list of entries'''
+        self.__poll()
+        found = {}
+        missing = []
+        with self.__cacheLock:
+            for id in ids:
+                entry = self.__cache.get(id)
+                if entry == None:
+                    missing.append(id)
+                else:
+                    self.__cache.move_to_end(id)
+                    found[id] = entry
+            self.__hits += len(found)
+            self.__misses += len(missing)
+        if missing:
+            with self.__pool.connection() as connection:
+                loaded = list(self.__iterate(connection, missing))
+            with self.__cacheLock:
+                for entry in loaded:
+                    found[entry.id] = entry
+                    self.__cache[entry.id] = entry
+                while len(self.__cache) > self.cacheSize:
+                    self.__cache.popitem(last=False)
+        return [Scheduler.Entry(entry.id, entry.cron, entry.state, entry.name,
+                                entry.handler, entry.status,
+                                args=dict(entry.args))
+                for entry in (found[id] for id in dict.fromkeys(ids)
+                              if id in found)]
+
+    def __uncache(self, ids):
+        if self.cacheSize <= 0:
+            return
+        with self.__cacheLock:
+            for id in ids:
+                self.__cache.pop(id, None)
 
     @__requireConnection()
     def __entryExists(self, connection, entry):
@@ -197,55 +679,155 @@ class Config(object):
         except StopIteration:
             return False
 
-    def __makeEntries(self, cursor):
-        entries = []
-        while True:
-            row = cursor.fetchone()
-            if row == None:
-                break
-            entry = self.__makeEntry(row)
-            entries.append(entry)
+    def __saveChunk(self, connection, entries, stats):
+        # the last entry wins if the same id is given more than once
+        byId = dict((entry.id, entry) for entry in entries)
+        stats.unchanged += len(entries) - len(byId)
+        ids = tuple(byId.keys())
+        placeholders = ",".join(('?',) * len(ids))
 
-        return entries
+        cursor = connection.cursor()
+        cursor.execute("""select id, cron, state, name, handler, status
+            from tbl_sched where id in (%s)""" % placeholders, ids)
+        rows = dict((row[0], tuple(row[1:])) for row in cursor)
+        cursor.execute("""select source_id, name, value
+            from tbl_sched_args where source_id in (%s)""" % placeholders,
+            ids)
+        args = {}
+        for row in cursor:
+            args.setdefault(row[0], {})[row[1]] = row[2]
 
-    @__requireConnection()
-    def __makeEntry(self, connection, row):
-        entry = Scheduler.Entry(*row)
+        rowsToWrite = []
+        argsToWrite = []
+        casts = connection.cursor()
+        for id, entry in byId.items():
+            row = (entry.cron, entry.state, entry.name, entry.handler,
+                   entry.status)
+            oldArgs = args.get(id, {})
+            newArgs = [(id, name, value)
+                       for name, value in self.__flattenArgs(entry)
+                       if name not in oldArgs or
+                          oldArgs[name] != self.__storedValue(casts, value)]
 
+            if id not in rows:
+                stats.inserted += 1
+            elif rows[id] != row or newArgs:
+                stats.updated += 1
+            else:
+                stats.unchanged += 1
+                continue
+            if rows.get(id) != row:
+                rowsToWrite.append((id,) + row + (
+                    Scheduler.nextFireOf(entry.cron, entry.state),))
+            argsToWrite.extend(newArgs)
+
+        cursor.executemany("""insert into tbl_sched
+            (id, cron, state, name, handler, status, next_fire)
+            values
+            (?, ?, ?, ?, ?, ?, ?)
+            on conflict (id) do update set
+                cron=excluded.cron, state=excluded.state,
+                name=excluded.name, handler=excluded.handler,
+                status=excluded.status,
+                next_fire=excluded.next_fire""", rowsToWrite)
+        cursor.executemany("""insert into tbl_sched_args
+            (source_id, name, value)
+            values
+            (?, ?, ?)
+            on conflict (source_id, name) do update set
+                value=excluded.value""", argsToWrite)
+        self.__uncache(set(row[0] for row in rowsToWrite) |
+                       set(row[0] for row in argsToWrite))
+
+    def __flattenArgs(self, entry):
+        '''Yields (name, value) pairs of entry's args as they are stored in
+           the db, i.e. with array items stored as separate 'name:index'
+           args'''
+        for arg in entry.args.values():
+            if isinstance(arg.value, list):
+                for index, value in enumerate(arg.value):
+                    yield "%s:%d" % (arg.name, index), value
+            elif isinstance(arg.value, dict):
+                for key, value in arg.value.items():
+                    yield "%s:%s" % (arg.name, key), value
+            else:
+                yield arg.name, arg.value
+
+    def __storedValue(self, cursor, value):
+        '''Gets an arg value the way it is read back from the db. The value
+           column has text affinity, so anything but text, blobs and nulls
+           is stored as text, e.g. True as '1' and 1e20 as '1.0e+20'
+           :param cursor: cursor to let sqlite format values with'''
+        if value == None or isinstance(value, (str, bytes)):
+            return value
+        if isinstance(value, int):
+            # bools are ints to sqlite as well
+            return str(int(value))
+        cursor.execute("""select cast(? as text)""", (value,))
+        return cursor.fetchone()[0]
+
+    def __queryEntries(self, connection, where, params):
+        '''Fetches entries together with their args using a single joined
+           query. Rows are ordered by entry id, so all args of an entry are
+           adjacent and entries can be built while the cursor is consumed
+           :param where: sql condition on tbl_sched (aliased as s)
+           :param params: parameters for the condition
+           :rtype: generator of entries'''
         cursor = connection.cursor()
-        cursor.execute("""select name, value from tbl_sched_args
-            where source_id=?""", (entry.id,))
+        cursor.execute("""select s.id, s.cron, s.state, s.name, s.handler,
+                s.status, a.name, a.value
+            from tbl_sched s
+            left join tbl_sched_args a on a.source_id = s.id
+            %s
+            order by s.id""" % where, params)
+
+        # lets holders of entries drop args and load them again later
+        loader = self.getArgs
+        entry = None
         arrays = {}
-        while True:
-            rowArg = cursor.fetchone()
-            if rowArg == None:
-                break
-
-            if len(rowArg[0]) > 1 and rowArg[0][0] != ':' and \
-               ":" in rowArg[0][0]:
-                pair = rowArg[0][0].split(":", 2)
-                handle = None
-                if pair[0] in arrays:
-                    handle = arrays[pair[0]]
-                else:
-                    handle = Scheduler.Arg(entry, pair[0], [])
-                    arrays[pair[0]] = handle
-                if pair[1] == '':
-                    handle.value.append(rowArg[1])
-                else:
-                    # try to build simple array if possible, else revert to map
-                    try:
-                        handle.value[int(pair[1])] = rowArg[1]
-                    except ValueError:
-                        handle.value[pair[1]] = rowArg[1]
-            else:
-                arg = Scheduler.Arg()
-                arg.source = entry
-                arg.name = rowArg[0]
-                arg.value = rowArg[1]
-                entry.args[arg.name] = arg
+        for row in cursor:
+            if entry == None or row[0] != entry.id:
+                if entry != None:
+                    yield self.__finishEntry(entry, arrays)
+                entry = Scheduler.Entry(*row[:6], args={}, loader=loader)
+                arrays = {}
+            # entries without args still produce one row w/ nulls in it
+            if row[6] != None:
+                self.__addArg(entry, arrays, row[6], row[7])
+
+        if entry != None:
+            yield self.__finishEntry(entry, arrays)
+
+    def __addArg(self, entry, arrays, name, value):
+        # array items are stored as separate args named 'name:index'
+        if len(name) > 1 and name[0] != ':' and ":" in name:
+            arrayName, index = name.split(":", 1)
+            arrays.setdefault(arrayName, []).append((index, value))
+        else:
+            entry.args[name] = Scheduler.Arg(name=name, value=value)
 
-        for array in arrays.values():
-            entry.args[arg.name] = arg
+    def __finishEntry(self, entry, arrays):
+        for name, items in arrays.items():
+            # try to build simple array if possible, else revert to map
+            try:
+                indexed = sorted((int(index), value)
+                                 for index, value in items if index != '')
+                value = [item[1] for item in indexed] + \
+                        [value for index, value in items if index == '']
+            except ValueError:
+                value = dict(items)
+            entry.args[name] = Scheduler.Arg(name=name, value=value)
 
         return entry
+
+
+class SaveStats(object):
+    '''Row counters of Config.saveMany'''
+    def __init__(self, inserted=0, updated=0, unchanged=0):
+        self.inserted = inserted
+        self.updated = updated
+        self.unchanged = unchanged
+
+    def __repr__(self):
+        return "SaveStats(inserted=%d, updated=%d, unchanged=%d)" % \
+            (self.inserted, self.updated, self.unchanged)
@@ -0,0 +1,107 @@
+import logging
+import threading
+
+
+class WriteBehind(object):
+    '''Buffers column updates of entries and writes them to a config in a
+       single transaction, once enough of them are pending or once the
+       interval passes. Updates of the same entry are merged, so that only
+       the latest value of each changed column is written'''
+
+    def __init__(self, config, maxSize=500, interval=1.0, track=True):
+        '''
+           :param config: config with updateMany method
+           :param maxSize: number of pending entries, that triggers a flush
+           :param interval: max seconds an update stays pending, 0 to write
+                            every update at once
+           :param track: whether updates advance the change counter of the
+                         config, see Config.updateMany'''
+        self.config = config
+        self.maxSize = maxSize
+        self.interval = interval
+        self.track = track
+        self.__condition = threading.Condition()
+        # flushes are serialized, so that updates are written in order
+        self.__flushLock = threading.Lock()
+        self.__pending = {}  # entry id => {column name: value}
+        self.__thread = None
+        self.__closing = False
+        self.__flushes = 0
+        self.__written = 0
+
+    def put(self, id, columns):
+        '''Schedules an update of an entry
+           :param columns: map of column names to new values'''
+        if self.interval <= 0:
+            self.config.updateMany([(id, dict(columns))], track=self.track)
+            return
+        with self.__condition:
+            self.__pending.setdefault(id, {}).update(columns)
+            if self.__thread == None:
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name='WriteBehind')
+                self.__thread.daemon = True
+                self.__thread.start()
+            if len(self.__pending) >= self.maxSize:
+                self.__condition.notify()
+
+    def flush(self):
+        '''Writes pending updates now'''
+        with self.__flushLock:
+            with self.__condition:
+                pending = self.__pending
+                self.__pending = {}
+            if not pending:
+                return
+            try:
+                written = self.config.updateMany(pending.items(),
+                                                 track=self.track)
+            except:
+                # put the updates back under the ones, that came meanwhile
+                with self.__condition:
+                    for id, columns in pending.items():
+                        columns.update(self.__pending.get(id, {}))
+                        self.__pending[id] = columns
+                raise
+            with self.__condition:
+                self.__flushes += 1
+                self.__written += written
+
+    def close(self):
+        '''Writes pending updates and stops the background thread. The
+           buffer may be used again afterwards'''
+        with self.__condition:
+            thread = self.__thread
+            self.__closing = True
+            self.__condition.notify()
+        if thread != None and thread != threading.current_thread():
+            thread.join()
+        with self.__condition:
+            self.__thread = None
+            self.__closing = False
+        self.flush()
+
+    def stats(self):
+        '''Gets a snapshot of buffer counters
+           :rtype: dict'''
+        with self.__condition:
+            return {
+                'pending': len(self.__pending),
+                'flushes': self.__flushes,
+                'written': self.__written,
+            }
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(
+                    lambda: self.__closing or
+                            len(self.__pending) >= self.maxSize,
+                    self.interval)
+                if self.__closing:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # updates are kept, so they are retried on the next flush
+                logging.exception("failed to write pending updates")
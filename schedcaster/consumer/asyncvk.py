@@ -0,0 +1,85 @@
+"""
+VK consumer for AsyncCaster. Calls VK API over HTTP with aiohttp, a single
+session keeps a pool of keep-alive connections, so that thousands of posts
+may be in progress without a thread or a new connection each.
+"""
+
+import aiohttp
+import time
+from schedcaster.caster.ratelimit import Throttled
+from schedcaster.consumer.vk import THROTTLE_ERROR_CODES, postArgs, postId,\
+    CONSUME_SECONDS, CONSUME_ERRORS
+
+
+class Consumer(object):
+    url = 'https://api.vk.com/method/'
+
+    def __init__(self, token, owner=None, version='5.131',
+                 maxConnections=100, timeout=30, session=None):
+        '''
+           :param token: access token, unlike the blocking consumer it can't
+                         be obtained from app id and secret
+           :param owner: id of the wall to post to, negative for groups
+           :param version: VK API version
+           :param maxConnections: max number of simultaneously open
+                                  connections to VK
+           :param timeout: max seconds a single API call may take
+           :param session: aiohttp.ClientSession to share with others, a
+                           new one is made on the first call if None'''
+        self.token = token
+        self.owner = owner
+        self.version = version
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.__session = session
+        self.__ownSession = session == None
+
+    async def consume(self, post, attachment=None, **kwargs):
+        args = postArgs(self.owner, post, **kwargs)
+        started = time.perf_counter()
+        try:
+            reply = await self.call('wall.post', **args)
+            return postId(post, reply)
+        except Throttled:
+            CONSUME_ERRORS.labels('throttled').inc()
+            raise
+        except Exception:
+            CONSUME_ERRORS.labels('error').inc()
+            raise
+        finally:
+            CONSUME_SECONDS.observe(time.perf_counter() - started)
+
+    async def call(self, method, **args):
+        '''Calls VK API method, translating throttling errors to Throttled
+           :rtype: response part of the reply'''
+        args['access_token'] = self.token
+        if self.version != None:
+            args['v'] = self.version
+        async with self.__getSession().post(self.url + method,
+                                            data=args) as response:
+            response.raise_for_status()
+            reply = await response.json(content_type=None)
+        if 'error' in reply:
+            error = reply['error']
+            message = "VK error %s: %s" % (error.get('error_code'),
+                                           error.get('error_msg'))
+            # let the caster retry it later
+            if error.get('error_code') in THROTTLE_ERROR_CODES:
+                raise Throttled(message)
+            raise RuntimeError(message)
+        return reply.get('response')
+
+    async def close(self):
+        '''Closes connections, unless the session was given by the caller'''
+        if self.__ownSession and self.__session != None:
+            await self.__session.close()
+        self.__session = None
+
+    def __getSession(self):
+        # the session is bound to the running loop, so it is made lazily
+        if self.__session == None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.maxConnections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.__ownSession = True
+        return self.__session
@@ -5,12 +5,27 @@ Created on Tue Aug  7 18:47:08 2012
 @author: avsh
 """
 
-import vkontakte as api
+import concurrent.futures
+import json
 import re
+import threading
+import time
+from schedcaster import metrics as Metrics
+from schedcaster.caster.ratelimit import Throttled
 
 __urlIsVMediaRe = re.compile("""^(photo|video|audio|doc)\\d+_\\d+$""")
 __urlToVMediaRe = re.compile("""((?:photo|video|audio|doc)\\d+_\\d+)""")
 
+# 'too many requests per second' and 'flood control' errors
+THROTTLE_ERROR_CODES = (6, 9)
+# max number of API calls in a single 'execute' call
+MAX_EXECUTE_CALLS = 25
+
+CONSUME_SECONDS = Metrics.histogram('schedcaster_vk_consume_seconds',
+    'Seconds taken to make a post on VK')
+CONSUME_ERRORS = Metrics.counter('schedcaster_vk_consume_errors',
+    'Failed posts on VK by the kind of failure', ('kind',))
+
 
 def urlIsVMedia(url):
     return __urlIsVMediaRe.match(url) and True or False
@@ -26,39 +41,168 @@ def urlToVMedia(url):
 
 
 class Consumer(object):
-    def __init__(self, apiId=None, apiSecret=None, token=None, owner=None):
+    def __init__(self, apiId=None, apiSecret=None, token=None, owner=None,
+                 batchSize=0, batchDelay=0.1, timeout=None):
+        '''
+           :param owner: id of the wall to post to, negative for groups
+           :param batchSize: if > 1, posts made by concurrent consume calls
+                             are submitted together via 'execute' method,
+                             up to batchSize (at most 25) posts at once.
+                             A batch only collects posts, that are being
+                             consumed at the same time, so it never holds
+                             more of them than maxThreads of the caster:
+                             keep maxThreads at least batchSize, otherwise
+                             every batch waits for batchDelay to pass
+           :param batchDelay: max seconds a post waits for its batch
+           :param timeout: seconds an API request may take, None for the
+                           default of vkontakte. Set it below the deadline
+                           of the caster, so that stuck requests fail
+                           rather than being abandoned'''
         self.owner = owner
+        options = {}
+        if timeout != None:
+            options['timeout'] = timeout
+
+        # vkontakte is imported on first use, so that the module's helpers
+        # are usable without it
+        import vkontakte as api
 
         # try to default to the given token
         self.token = token
         if self.token == None:
-            self.api = api.API(apiId, apiSecret)
+            self.api = api.API(apiId, apiSecret, **options)
             self.token = self.api.token
         else:
-            self.api = api.API(token=token)
+            self.api = api.API(token=token, **options)
             self.token = token
 
+        self.batcher = None
+        if batchSize > 1:
+            self.batcher = Batcher(self.api,
+                                   min(batchSize, MAX_EXECUTE_CALLS),
+                                   batchDelay)
+
     def consume(self, post, attachment=None, **kwargs):
-        args = {'message': post}
-        if self.owner != None:
-            args['owner_id'] = self.owner
-            # if id is negative, it's a group, post on its behalf
-            if self.owner[0] == '-':
-                args['from_group'] = 1
-        if 'attachments' in kwargs and type(kwargs['attachments']) == str and\
-                                            kwargs['attachments']  != '':
-            # convert from \n separator to ',' and ensure that urls are in
-            # correct format
-            args['attachments'] = ",".join(
-                map(lambda u: urlToVMedia(u),
-                    kwargs['attachments'].split('\n')))
-
-        # post with retrieved params
-        reply = self.api.wall.post(**args)
-
-        if type(reply) == dict and 'post_id' in reply and\
-           reply['post_id'] != None:
-            return reply['post_id']
-        else:
-            raise RuntimeError('wrong reply from VK, message: %s, reply: %s' %\
-                (post, str(reply)))
\ No newline at end of file
+        args = postArgs(self.owner, post, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            # post with retrieved params
+            if self.batcher != None:
+                reply = self.batcher.post(args)
+            else:
+                reply = callAPI(self.api.wall.post, **args)
+            return postId(post, reply)
+        except Throttled:
+            CONSUME_ERRORS.labels('throttled').inc()
+            raise
+        except Exception:
+            CONSUME_ERRORS.labels('error').inc()
+            raise
+        finally:
+            CONSUME_SECONDS.observe(time.perf_counter() - started)
+
+
+class Batcher(object):
+    '''Collects wall.post calls, that are made simultaneously by different
+       threads, and submits them with a single 'execute' call. Each caller
+       waits for its own part of the reply. A batch is submitted once size
+       callers wait for it, or once delay passes since the first of them,
+       so batches get full only with at least size calling threads'''
+    def __init__(self, api, size=MAX_EXECUTE_CALLS, delay=0.1):
+        self.api = api
+        self.size = size
+        self.delay = delay
+        self.__lock = threading.Lock()
+        self.__pending = []  # [(wall.post args, future)]
+        self.__batchId = 0
+
+    def post(self, args):
+        '''Makes wall.post call as a part of a batch
+           :rtype: reply to the call'''
+        future = concurrent.futures.Future()
+        batch = None
+        with self.__lock:
+            self.__pending.append((args, future))
+            if len(self.__pending) >= self.size:
+                batch = self.__take()
+            elif len(self.__pending) == 1:
+                timer = threading.Timer(self.delay, self.__flush,
+                                        (self.__batchId,))
+                timer.daemon = True
+                timer.start()
+        if batch != None:
+            self.__submit(batch)
+        return future.result()
+
+    def __take(self):
+        # must be called with the lock held
+        batch = self.__pending
+        self.__pending = []
+        self.__batchId += 1
+        return batch
+
+    def __flush(self, batchId):
+        with self.__lock:
+            # the batch may have been submitted already, once it was full
+            if batchId != self.__batchId or not self.__pending:
+                return
+            batch = self.__take()
+        self.__submit(batch)
+
+    def __submit(self, batch):
+        code = "return [%s];" % ",".join(
+            "API.wall.post(%s)" % json.dumps(args, ensure_ascii=False)
+            for args, future in batch)
+        try:
+            replies = callAPI(self.api.execute, code=code)
+            if type(replies) != list or len(replies) != len(batch):
+                raise RuntimeError('wrong reply from VK to execute: %s' %
+                                   str(replies))
+        except Exception as e:
+            for args, future in batch:
+                future.set_exception(e)
+            return
+        # failed calls are replied with false, postId() rejects them
+        for (args, future), reply in zip(batch, replies):
+            future.set_result(reply)
+
+
+def postArgs(owner, post, **kwargs):
+    '''Gets wall.post arguments for a post'''
+    args = {'message': post}
+    if owner != None:
+        args['owner_id'] = owner
+        # if id is negative, it's a group, post on its behalf
+        if owner[0] == '-':
+            args['from_group'] = 1
+    if 'attachments' in kwargs and type(kwargs['attachments']) == str and\
+                                        kwargs['attachments']  != '':
+        # convert from \n separator to ',' and ensure that urls are in
+        # correct format
+        args['attachments'] = ",".join(
+            map(lambda u: urlToVMedia(u),
+                kwargs['attachments'].split('\n')))
+    return args
+
+
+def callAPI(method, **args):
+    '''Calls VK API method, translating throttling errors to Throttled'''
+    import vkontakte as api
+    try:
+        return method(**args)
+    except api.VKError as e:
+        # let the caster retry it later
+        if e.code in THROTTLE_ERROR_CODES:
+            raise Throttled(str(e))
+        raise
+
+
+def postId(post, reply):
+    '''Gets id of a new post from wall.post reply'''
+    if type(reply) == dict and 'post_id' in reply and\
+       reply['post_id'] != None:
+        return reply['post_id']
+    else:
+        raise RuntimeError('wrong reply from VK, message: %s, reply: %s' %\
+            (post, str(reply)))
@@ -0,0 +1,247 @@
+"""
+Computation of fire times for the 7-field cron format used by schedules:
+
+    second minute hour day month year day_of_week
+
+Each field supports the same syntax as apscheduler: '*', '*/step', 'a',
+'a-b', 'a-b/step' and comma separated lists of those. Day of week is 0-6
+starting from monday or a three letter name (mon, tue, ...), day may also
+be 'last' for the last day of a month.
+"""
+
+import calendar
+import datetime
+import functools
+
+MIN_YEAR = 1970
+MAX_YEAR = 9999
+
+# (name, min value, max value) in the order of the cron string
+FIELDS = (
+    ('second', 0, 59),
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('year', MIN_YEAR, MAX_YEAR),
+    ('day_of_week', 0, 6),
+)
+SECOND, MINUTE, HOUR, DAY, MONTH, YEAR, DAY_OF_WEEK = range(len(FIELDS))
+ALL_WEEKDAYS = (1 << 7) - 1
+
+# number of distinct compiled crons to keep, most of the schedules share a
+# handful of crons, while one-shots are rarely compiled more than twice
+CACHE_SIZE = 16384
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MONTHS = ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+          'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+
+
+def split(cron):
+    '''Splits a cron string into a map of apscheduler field names to field
+       expressions
+       :rtype: dict'''
+    split = str(cron).split()
+    if len(split) != len(FIELDS):
+        raise ValueError("cron must have %d fields, got '%s'" %
+                         (len(FIELDS), cron))
+    return dict((field[0], value) for field, value in zip(FIELDS, split))
+
+
+def compile(cron):
+    '''Gets a compiled cron expression. Compiled expressions are immutable
+       and are shared between all users of the same cron string
+       :raises ValueError: if the cron is malformed
+       :rtype: CronExpression'''
+    return __compile(str(cron))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def __compile(cron):
+    return CronExpression(cron)
+
+
+def cacheInfo():
+    '''Gets hit/miss statistics of the compiled expressions cache'''
+    return __compile.cache_info()
+
+
+class CronExpression(object):
+    '''Parsed cron string, that is able to compute its fire times. Allowed
+       values of each field are stored as a bitset: bit i is set if value
+       min + i is allowed. Use compile() to get a cached instance'''
+    __slots__ = ('cron', '__fields', '__masks', '__lastDay', '__anyDay')
+
+    def __init__(self, cron):
+        self.cron = cron
+        self.__fields = split(cron)
+        self.__masks = []
+        self.__lastDay = False
+        for name, minValue, maxValue in FIELDS:
+            mask = 0
+            for expr in self.__fields[name].lower().split(','):
+                if name == 'day' and expr == 'last':
+                    self.__lastDay = True
+                    continue
+                for value in self.__parse(name, expr, minValue, maxValue):
+                    mask |= 1 << (value - minValue)
+            self.__masks.append(mask)
+        self.__masks = tuple(self.__masks)
+        self.__anyDay = (self.__fields['day'] == '*' and
+                         self.__fields['day_of_week'] == '*')
+
+    @property
+    def fields(self):
+        '''Map of apscheduler field names to field expressions'''
+        return dict(self.__fields)
+
+    def nextFireAfter(self, after):
+        '''Computes the first fire time, that is strictly later than given
+           :param after: naive datetime
+           :rtype: datetime or None, if the cron will never fire again'''
+        t = after.replace(microsecond=0) + datetime.timedelta(seconds=1)
+        while True:
+            if t.year > MAX_YEAR:
+                return None
+            year = self.__next(YEAR, t.year)
+            if year == None:
+                return None
+            if year != t.year:
+                t = datetime.datetime(year, 1, 1)
+                continue
+
+            month = self.__next(MONTH, t.month)
+            if month == None:
+                t = self.__startOfYear(t.year + 1)
+                if t == None:
+                    return None
+                continue
+            if month != t.month:
+                t = datetime.datetime(t.year, month, 1)
+                continue
+
+            if not self.__dayMatches(t):
+                t = self.__nextDay(t)
+                continue
+
+            hour = self.__next(HOUR, t.hour)
+            if hour == None:
+                t = datetime.datetime(t.year, t.month, t.day) + \
+                    datetime.timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0, second=0)
+                continue
+
+            minute = self.__next(MINUTE, t.minute)
+            if minute == None:
+                t = t.replace(minute=0, second=0) + \
+                    datetime.timedelta(hours=1)
+                continue
+            if minute != t.minute:
+                t = t.replace(minute=minute, second=0)
+                continue
+
+            second = self.__next(SECOND, t.second)
+            if second == None:
+                t = t.replace(second=0) + datetime.timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+
+    def firstFire(self):
+        '''Computes the earliest fire time, e.g. when a one-shot was due
+           :rtype: datetime or None, if the cron never fires'''
+        return self.nextFireAfter(datetime.datetime(MIN_YEAR, 1, 1) -
+                                  datetime.timedelta(seconds=1))
+
+    def nextFires(self, after, n):
+        '''Computes up to n next fire times, that are strictly later than
+           given, e.g. to preview a schedule
+           :param after: naive datetime
+           :rtype: list of datetime'''
+        fires = []
+        while len(fires) < n:
+            after = self.nextFireAfter(after)
+            if after == None:
+                break
+            fires.append(after)
+        return fires
+
+    def __repr__(self):
+        return "CronExpression('%s')" % self.cron
+
+    def __next(self, field, value):
+        '''Gets the smallest allowed value of the field, that is >= value'''
+        minValue = FIELDS[field][1]
+        mask = self.__masks[field] >> (value - minValue)
+        if not mask:
+            return None
+        # index of the lowest set bit
+        return value + (mask & -mask).bit_length() - 1
+
+    def __contains(self, field, value):
+        return self.__masks[field] >> (value - FIELDS[field][1]) & 1
+
+    def __startOfYear(self, year):
+        if year > MAX_YEAR:
+            return None
+        return datetime.datetime(year, 1, 1)
+
+    def __nextDay(self, t):
+        '''Gets the start of the next day, that may match'''
+        if self.__masks[DAY_OF_WEEK] == ALL_WEEKDAYS and not self.__lastDay:
+            # only day of month matters, so skip straight to it
+            day = self.__next(DAY, t.day + 1) if t.day < 31 else None
+            if day != None and \
+               day <= calendar.monthrange(t.year, t.month)[1]:
+                return datetime.datetime(t.year, t.month, day)
+            if t.month == 12:
+                return datetime.datetime(t.year + 1, 1, 1)
+            return datetime.datetime(t.year, t.month + 1, 1)
+        return datetime.datetime(t.year, t.month, t.day) + \
+            datetime.timedelta(days=1)
+
+    def __dayMatches(self, t):
+        if self.__anyDay:
+            return True
+        if not self.__contains(DAY_OF_WEEK, t.weekday()):
+            return False
+        if self.__contains(DAY, t.day):
+            return True
+        return self.__lastDay and \
+            t.day == calendar.monthrange(t.year, t.month)[1]
+
+    def __parse(self, name, expr, minValue, maxValue):
+        step = 1
+        if '/' in expr:
+            expr, step = expr.split('/', 1)
+            step = self.__number(name, step)
+            if step < 1:
+                raise ValueError("wrong step in %s field: '%s'" %
+                                 (name, self.cron))
+        if expr == '*':
+            first, last = minValue, maxValue
+        elif '-' in expr:
+            first, last = expr.split('-', 1)
+            first = self.__number(name, first)
+            last = self.__number(name, last)
+        else:
+            first = last = self.__number(name, expr)
+            if step != 1:
+                last = maxValue
+        if first < minValue or last > maxValue or first > last:
+            raise ValueError("%s field is out of range in '%s'" %
+                             (name, self.cron))
+        return range(first, last + 1, step)
+
+    def __number(self, name, value):
+        if name == 'day_of_week' and value in WEEKDAYS:
+            return WEEKDAYS.index(value)
+        if name == 'month' and value in MONTHS:
+            return MONTHS.index(value) + 1
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError("wrong value '%s' in %s field of '%s'" %
+                             (value, name, self.cron))
@@ -0,0 +1,221 @@
+"""
+Scheduling engine for very large sets of jobs. Jobs are kept in a binary
+heap ordered by their next fire time and are run by a single dispatcher
+thread, so adding or removing a job costs O(log n) and a job takes only a
+small constant amount of memory.
+
+HeapScheduler implements the subset of apscheduler.scheduler.Scheduler API,
+that is used by schedcaster.scheduler.Scheduler, so they are
+interchangeable.
+"""
+
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from schedcaster import cron as Cron
+
+
+class HeapJob(object):
+    __slots__ = ('func', 'args', 'kwargs', 'trigger', 'nextFire', 'scheduled')
+
+    def __init__(self, func, trigger, args=None, kwargs=None):
+        self.func = func
+        self.trigger = trigger
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.nextFire = None  # timestamp
+        self.scheduled = False
+
+
+class DateTrigger(object):
+    '''Trigger, that fires only once at the given date'''
+    def __init__(self, date):
+        self.date = date
+
+    def nextFireAfter(self, after):
+        if after < self.date:
+            return self.date
+        return None
+
+
+class LazyCronTrigger(object):
+    '''Trigger of a cron string, that is compiled only once it is needed,
+       so that restored jobs cost nothing until they are fired'''
+    __slots__ = ('cron', 'compiled')
+
+    def __init__(self, cron):
+        self.cron = cron
+        self.compiled = None
+
+    def nextFireAfter(self, after):
+        if self.compiled == None:
+            self.compiled = Cron.compile(self.cron)
+        return self.compiled.nextFireAfter(after)
+
+
+class HeapScheduler(object):
+    def __init__(self, misfire_grace_time=1, executor=None):
+        '''
+           :param misfire_grace_time: seconds after the designated fire time,
+                                      during which the job is still run
+           :param executor: concurrent.futures executor to run jobs with,
+                            jobs are run by the dispatcher thread if None'''
+        self.misfire_grace_time = misfire_grace_time
+        self.executor = executor
+        self.__heap = []  # (fire timestamp, sequence number, job)
+        self.__sequence = itertools.count()
+        self.__cancelled = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.running = False
+
+    def start(self):
+        with self.__condition:
+            if self.running:
+                return
+            self.running = True
+            self.__thread = threading.Thread(target=self.__dispatch,
+                                             name='HeapScheduler')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def shutdown(self, wait=True, shutdown_threadpool=True):
+        with self.__condition:
+            if not self.running:
+                return
+            self.running = False
+            self.__condition.notify_all()
+        if wait and self.__thread != threading.current_thread():
+            self.__thread.join()
+        if shutdown_threadpool and self.executor != None:
+            self.executor.shutdown(wait)
+
+    def add_cron_job(self, func, year=None, month=None, day=None, week=None,
+                     day_of_week=None, hour=None, minute=None, second=None,
+                     start_date=None, args=None, kwargs=None, **options):
+        if week != None or start_date != None:
+            raise ValueError("week and start_date are not supported")
+        values = {'year': year, 'month': month, 'day': day,
+                  'day_of_week': day_of_week, 'hour': hour,
+                  'minute': minute, 'second': second}
+        # same defaults as apscheduler: fields, that are more significant
+        # than the most significant given one, default to '*', the rest
+        # default to their minimum
+        defaults = {'year': '*', 'month': 1, 'day': 1, 'day_of_week': '*',
+                    'hour': 0, 'minute': 0, 'second': 0}
+        given = False
+        for name in ('second', 'minute', 'hour', 'day_of_week', 'day',
+                     'month', 'year'):
+            if values[name] != None:
+                given = True
+            elif given:
+                values[name] = '*'
+            else:
+                values[name] = defaults[name]
+        expr = " ".join(str(values[field[0]]) for field in Cron.FIELDS)
+        trigger = Cron.compile(expr)
+        return self.__add(HeapJob(func, trigger, args, kwargs))
+
+    def add_date_job(self, func, date, args=None, kwargs=None, **options):
+        return self.__add(HeapJob(func, DateTrigger(date), args, kwargs))
+
+    def addJobsAt(self, jobs):
+        '''Adds many cron jobs, whose next fire times are already known,
+           e.g. restored from a snapshot. Neither crons are compiled nor
+           fire times are computed, and the heap is rebuilt once, so it
+           costs O(n) rather than O(n log n)
+           :param jobs: iterable of (func, cron string, fire timestamp)
+           :rtype: list of jobs in the same order'''
+        added = []
+        with self.__condition:
+            for func, cron, fireTime in jobs:
+                job = HeapJob(func, LazyCronTrigger(cron))
+                job.nextFire = fireTime
+                job.scheduled = True
+                self.__heap.append((fireTime, next(self.__sequence), job))
+                added.append(job)
+            heapq.heapify(self.__heap)
+            self.__condition.notify()
+        return added
+
+    def unschedule_job(self, job):
+        with self.__condition:
+            if not job.scheduled:
+                raise KeyError(job)
+            job.scheduled = False
+            self.__cancelled += 1
+            # drop cancelled jobs once they take the most of the heap, so
+            # that memory is not wasted on them
+            if self.__cancelled > len(self.__heap) // 2:
+                self.__heap = [item for item in self.__heap
+                               if item[2].scheduled]
+                heapq.heapify(self.__heap)
+                self.__cancelled = 0
+
+    def get_jobs(self):
+        with self.__condition:
+            return [item[2] for item in self.__heap if item[2].scheduled]
+
+    def __add(self, job):
+        fire = job.trigger.nextFireAfter(datetime.datetime.now())
+        if fire == None:
+            raise ValueError('Not adding job since it would never be run')
+        with self.__condition:
+            self.__push(job, fire)
+            job.scheduled = True
+            if self.__heap[0][2] is job:
+                self.__condition.notify()
+        return job
+
+    def __push(self, job, fire):
+        job.nextFire = fire.timestamp()
+        heapq.heappush(self.__heap,
+                       (job.nextFire, next(self.__sequence), job))
+
+    def __dispatch(self):
+        while True:
+            with self.__condition:
+                job = None
+                while self.running and job == None:
+                    now = time.time()
+                    if not self.__heap:
+                        self.__condition.wait()
+                    elif not self.__heap[0][2].scheduled:
+                        heapq.heappop(self.__heap)
+                        self.__cancelled -= 1
+                    elif self.__heap[0][0] > now:
+                        self.__condition.wait(self.__heap[0][0] - now)
+                    else:
+                        fireTime, _, job = heapq.heappop(self.__heap)
+                if not self.running:
+                    return
+
+                # multiple missed runs are coalesced into a single one
+                fire = job.trigger.nextFireAfter(
+                    datetime.datetime.fromtimestamp(max(now, fireTime)))
+                if fire == None:
+                    job.scheduled = False
+                else:
+                    self.__push(job, fire)
+
+            if self.executor != None:
+                self.executor.submit(self.__run, job, fireTime)
+            else:
+                self.__run(job, fireTime)
+
+    def __run(self, job, fireTime):
+        # the misfire grace is checked here, since a job may wait for a
+        # free thread of the executor as well
+        late = time.time() - fireTime
+        if late > self.misfire_grace_time:
+            logging.warning("Run time of job %s was missed by %s" % (
+                job.func, datetime.timedelta(seconds=late)))
+            return
+        try:
+            job.func(*job.args, **job.kwargs)
+        except Exception:
+            logging.exception("Job %s raised an exception" % job.func)
@@ -0,0 +1,107 @@
+"""
+Incremental import of schedule files into a config. A file, that wasn't
+changed since its last import, is not parsed at all. Otherwise hashes of
+the parsed entries are compared with the ones in the config, so that only
+new, changed or removed entries are written and passed to the scheduler.
+"""
+
+import hashlib
+import os
+import schedcaster.scheduler as Scheduler
+
+
+class Importer(object):
+    def __init__(self, config, parse, scheduler=None):
+        '''
+           :param config: config to import entries into
+           :param parse: function, that parses a file into an iterable of
+                         entries with ids and hashes, e.g.
+                         lambda f: officeopenXML.iterParse(f, spec)
+           :param scheduler: Scheduler to notify of changed entries. An
+                             AsyncScheduler must be notified from its loop,
+                             so importFile must be run there as well'''
+        self.config = config
+        self.parse = parse
+        self.scheduler = scheduler
+
+    def importFile(self, filename, force=False):
+        '''Imports new and changed entries of a file and removes entries,
+           that are not in the file anymore. Entries, that were done
+           already, stay done unless their cron was changed
+           :param force: whether to parse the file even if it wasn't changed
+           :rtype: ImportStats'''
+        stats = ImportStats()
+        source = os.path.abspath(filename)
+        stat = os.stat(source)
+        digest = fileDigest(source)
+        last = self.config.getImport(source)
+        if not force and last != None and last[2] == digest:
+            stats.skipped = True
+            if last[:2] != (stat.st_size, stat.st_mtime):
+                # touched, but not changed
+                self.config.saveImport(source, stat.st_size, stat.st_mtime,
+                                       digest)
+            return stats
+
+        known = dict(self.config.iterateImported(source))
+        seen = set()
+        changed = {}  # id => entry
+        for entry in self.parse(source):
+            entry.arg(Scheduler.ARG_IMPORT, source)
+            seen.add(entry.id)
+            # the last of the rows, that have the same id, wins
+            if known.get(entry.id) == entry.args[Scheduler.ARG_HASH].value:
+                changed.pop(entry.id, None)
+                stats.unchanged += 1
+            else:
+                changed[entry.id] = entry
+        removed = [id for id in known if id not in seen]
+
+        self.__keepState(changed)
+        saved = self.config.saveMany(changed.values())
+        stats.inserted = saved.inserted
+        stats.updated = saved.updated
+        stats.unchanged += saved.unchanged
+        stats.removed = self.config.remove(removed)
+        self.config.saveImport(source, stat.st_size, stat.st_mtime, digest)
+
+        if self.scheduler != None:
+            for entry in changed.values():
+                self.scheduler.upsertEntry(entry)
+            for id in removed:
+                self.scheduler.removeEntry(id)
+        return stats
+
+    def __keepState(self, changed):
+        '''Carries over the runtime state of entries, that are in the config
+           already, so that an edit doesn't make a done entry fire again'''
+        for old in self.config.iterate(list(changed.keys())):
+            entry = changed[old.id]
+            if old.cron == entry.cron:
+                entry.state |= old.state & Scheduler.STATE_DONE
+                entry.status = old.status
+
+
+def fileDigest(filename, blockSize=1 << 20):
+    '''Gets a digest of a file's content'''
+    digest = hashlib.blake2b(digest_size=Scheduler.DIGEST_SIZE)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+class ImportStats(object):
+    '''Entry counters of Importer.importFile'''
+    def __init__(self, skipped=False, inserted=0, updated=0, unchanged=0,
+                 removed=0):
+        self.skipped = skipped
+        self.inserted = inserted
+        self.updated = updated
+        self.unchanged = unchanged
+        self.removed = removed
+
+    def __repr__(self):
+        return "ImportStats(skipped=%s, inserted=%d, updated=%d, " \
+               "unchanged=%d, removed=%d)" % (self.skipped, self.inserted,
+               self.updated, self.unchanged, self.removed)
@@ -0,0 +1,498 @@
+"""
+In-process metrics: counters, gauges and histograms, that are cheap enough
+to be updated on every fire and every consumer call, and an export of them
+in Prometheus text format, either to a file for node_exporter's textfile
+collector or over a local HTTP endpoint.
+
+Metrics of schedcaster itself are registered in REGISTRY by the modules,
+that update them, e.g. schedcaster_fire_lag_seconds by the scheduler.
+"""
+
+import bisect
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+# upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(object):
+    '''Base of metrics. A metric with label names holds a child metric per
+       combination of label values, see labels'''
+    type = 'untyped'
+
+    def __init__(self, name, help='', labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.__children = {}  # label values => metric
+        self.__childrenLock = threading.Lock()
+
+    def labels(self, *values):
+        '''Gets the child metric of label values. Children are kept forever,
+           so values must come from a small set, e.g. handler names
+           :rtype: Metric'''
+        child = self.__children.get(values)
+        if child != None:
+            return child
+        if len(values) != len(self.labelNames):
+            raise RuntimeError("metric %s has labels %s, got %s" %
+                               (self.name, self.labelNames, values))
+        with self.__childrenLock:
+            return self.__children.setdefault(values, self.newChild())
+
+    def newChild(self):
+        return type(self)(self.name)
+
+    def samples(self):
+        '''Gets current values of the metric
+           :rtype: list of (name suffix, {label: value}, value)'''
+        if not self.labelNames:
+            return self.ownSamples()
+        with self.__childrenLock:
+            children = list(self.__children.items())
+        samples = []
+        for values, child in children:
+            labels = dict(zip(self.labelNames, values))
+            for suffix, extra, value in child.ownSamples():
+                extra.update(labels)
+                samples.append((suffix, extra, value))
+        return samples
+
+    def ownSamples(self):
+        '''Gets values of the metric itself, rather than of its children.
+           A plain Metric holds no values
+           :rtype: list of (name suffix, {label: value}, value)'''
+        return []
+
+
+class Counter(Metric):
+    '''Value, that only goes up, e.g. number of fired entries'''
+    type = 'counter'
+
+    def __init__(self, name, help='', labelNames=()):
+        Metric.__init__(self, name, help, labelNames)
+        self.__lock = threading.Lock()
+        self.__value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+
+    def value(self):
+        return self.__value
+
+    def ownSamples(self):
+        return [('_total', {}, self.__value)]
+
+
+class Gauge(Metric):
+    '''Value, that goes up and down, e.g. depth of a queue'''
+    type = 'gauge'
+
+    def __init__(self, name, help='', labelNames=()):
+        Metric.__init__(self, name, help, labelNames)
+        self.__lock = threading.Lock()
+        self.__value = 0
+        self.__function = None
+
+    def set(self, value):
+        self.__value = value
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def setFunction(self, fn):
+        '''Makes the gauge read its value from fn when it is collected,
+           so that nothing is done on the hot path. None to stop it'''
+        self.__function = fn
+
+    def value(self):
+        fn = self.__function
+        if fn != None:
+            try:
+                return fn()
+            except Exception:
+                logging.exception("failed to read gauge %s" % self.name)
+        return self.__value
+
+    def ownSamples(self):
+        return [('', {}, self.value())]
+
+
+class Histogram(Metric):
+    '''Distribution of observed values, e.g. of call latencies, counted in
+       buckets, so that percentiles can be estimated'''
+    type = 'histogram'
+
+    def __init__(self, name, help='', labelNames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self.__lock = threading.Lock()
+        # the last one counts values above all of the bounds
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0.0
+
+    def newChild(self):
+        return Histogram(self.name, buckets=self.buckets)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value
+
+    def time(self):
+        '''Gets a timer, that observes seconds taken by a with block or by
+           each call of a decorated function
+           :rtype: Timer'''
+        return Timer(self)
+
+    def timeIteration(self, iterable):
+        '''Yields items of an iterable, observing seconds taken to get all
+           of them once it is exhausted or closed. Time the caller spends
+           between items isn't counted, unlike with time()
+           :rtype: generator'''
+        iterator = iter(iterable)
+        spent = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    spent += time.perf_counter() - started
+                yield item
+        finally:
+            self.observe(spent)
+
+    def count(self):
+        return sum(self.__counts)
+
+    def quantile(self, q):
+        '''Estimates a quantile of the observed values, e.g. 0.99 for p99,
+           interpolating within its bucket the way Prometheus does
+           :rtype: float or None, if nothing was observed'''
+        with self.__lock:
+            counts = list(self.__counts)
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count > 0:
+                if index == len(self.buckets):
+                    # nothing is known above the largest bound
+                    return self.buckets[-1]
+                lower = index > 0 and self.buckets[index - 1] or 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def ownSamples(self):
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', {'le': bound}, cumulative))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, cumulative))
+        return samples
+
+
+class Timer(object):
+    '''Observes seconds taken, see Histogram.time'''
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.__started = []  # nested or recursive uses
+
+    def __enter__(self):
+        self.__started.append(time.perf_counter())
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.perf_counter() - self.__started.pop())
+        return False
+
+    def __call__(self, fn):
+        histogram = self.histogram
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        timed.__name__ = fn.__name__
+        timed.__doc__ = fn.__doc__
+        return timed
+
+
+class Registry(object):
+    '''Set of metrics, that are exported together'''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = collections.OrderedDict()  # name => Metric
+
+    def register(self, metric):
+        '''Adds a metric. A metric of the same name and type, that was
+           added before, is returned instead, so that modules may share
+           metrics
+           :rtype: Metric'''
+        with self.__lock:
+            existing = self.__metrics.get(metric.name)
+            if existing == None:
+                self.__metrics[metric.name] = metric
+                return metric
+        if type(existing) != type(metric) or \
+           existing.labelNames != metric.labelNames:
+            raise RuntimeError("metric %s is registered already as %s" %
+                               (metric.name, existing.type))
+        return existing
+
+    def unregister(self, name):
+        with self.__lock:
+            return self.__metrics.pop(name, None) != None
+
+    def get(self, name):
+        '''Gets a metric by its name
+           :rtype: Metric or None'''
+        with self.__lock:
+            return self.__metrics.get(name)
+
+    def counter(self, name, help='', labelNames=()):
+        return self.register(Counter(name, help, labelNames))
+
+    def gauge(self, name, help='', labelNames=()):
+        return self.register(Gauge(name, help, labelNames))
+
+    def histogram(self, name, help='', labelNames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelNames, buckets))
+
+    def render(self):
+        '''Gets all metrics in Prometheus text format
+           :rtype: str'''
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            if metric.help:
+                lines.append("# HELP %s %s" % (metric.name,
+                             metric.help.replace('\\', '\\\\')
+                                        .replace('\n', '\\n')))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append("%s%s%s %s" % (metric.name, suffix,
+                                            formatLabels(labels),
+                                            formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+    def writeTextFile(self, filename):
+        '''Writes all metrics to a file. The file is replaced at once, so
+           that a collector never reads it half-written'''
+        temporary = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temporary, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(temporary, filename)
+
+    def exportTextFile(self, filename, interval=15.0):
+        '''Writes all metrics to a file every interval seconds in background
+           :rtype: threading.Event, that stops the export once set'''
+        stopped = threading.Event()
+
+        def export():
+            while not stopped.is_set():
+                try:
+                    self.writeTextFile(filename)
+                except Exception:
+                    logging.exception("failed to write metrics to %s" %
+                                      filename)
+                stopped.wait(interval)
+        thread = threading.Thread(target=export, name='MetricsExport')
+        thread.daemon = True
+        thread.start()
+        return stopped
+
+    def serve(self, port=9108, host='127.0.0.1', profiler=None):
+        '''Serves all metrics over HTTP at /metrics in background, and
+           stacks sampled by a profiler, if any, at /profile
+           :param port: port to listen at, 0 for any free one
+           :param host: address to listen at, the local one by default
+           :param profiler: SamplingProfiler
+           :rtype: http.server.HTTPServer, call its shutdown to stop it'''
+        # most processes never serve metrics, and http.server is slow to
+        # import
+        import http.server
+        import socketserver
+
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path in ('/', '/metrics'):
+                    body = registry.render()
+                elif path == '/profile' and profiler != None:
+                    body = profiler.folded()
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format % args)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='MetricsServer')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class SamplingProfiler(object):
+    '''Samples stacks of all threads at a fixed interval and counts them, so
+       that hot spots of a running service can be found without restarting
+       it under a profiler. Costs about the time to walk every stack once
+       per interval, nothing between samples'''
+    def __init__(self, interval=0.01, maxDepth=64):
+        '''
+           :param interval: seconds between samples
+           :param maxDepth: max number of frames kept per stack'''
+        self.interval = interval
+        self.maxDepth = maxDepth
+        self.__lock = threading.Lock()
+        self.__stacks = collections.Counter()  # folded stack => samples
+        self.__samples = 0
+        self.__stopped = None
+
+    def start(self):
+        with self.__lock:
+            if self.__stopped != None:
+                return
+            self.__stopped = threading.Event()
+            thread = threading.Thread(target=self.__run,
+                                      args=(self.__stopped,),
+                                      name='SamplingProfiler')
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self.__lock:
+            if self.__stopped != None:
+                self.__stopped.set()
+                self.__stopped = None
+
+    def clear(self):
+        with self.__lock:
+            self.__stacks = collections.Counter()
+            self.__samples = 0
+
+    def samples(self):
+        return self.__samples
+
+    def top(self, n=20):
+        '''Gets functions, that were on top of the most samples
+           :rtype: list of (function, number of samples)'''
+        functions = collections.Counter()
+        with self.__lock:
+            for stack, count in self.__stacks.items():
+                functions[stack.rsplit(';', 1)[-1]] += count
+        return functions.most_common(n)
+
+    def folded(self):
+        '''Gets sampled stacks in the folded format of flamegraph.pl, one
+           'frame;frame;frame count' line per stack
+           :rtype: str'''
+        with self.__lock:
+            stacks = sorted(self.__stacks.items())
+        return "".join("%s %d\n" % item for item in stacks)
+
+    def __run(self, stopped):
+        me = threading.get_ident()
+        while not stopped.wait(self.interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stacks.append(self.__fold(frame))
+            with self.__lock:
+                self.__stacks.update(stacks)
+                self.__samples += 1
+
+    def __fold(self, frame):
+        frames = []
+        while frame != None and len(frames) < self.maxDepth:
+            code = frame.f_code
+            frames.append("%s:%s" % (os.path.basename(code.co_filename),
+                                     code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, formatLabel(value))
+        for name, value in sorted(labels.items()))
+
+
+def formatLabel(value):
+    if isinstance(value, float):
+        return formatValue(value)
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+                     .replace('\n', '\\n')
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return "+Inf"
+    if value == float('-inf'):
+        return "-Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# metrics of schedcaster
+REGISTRY = Registry()
+
+
+def counter(name, help='', labelNames=()):
+    return REGISTRY.counter(name, help, labelNames)
+
+
+def gauge(name, help='', labelNames=()):
+    return REGISTRY.gauge(name, help, labelNames)
+
+
+def histogram(name, help='', labelNames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, labelNames, buckets)
@@ -0,0 +1,145 @@
+"""
+Parser of schedules exported as CSV or NDJSON (a JSON value per line). A
+file holds a single sheet of the same Spec, that is used for workbooks, and
+rows give the same entries as the same rows of a workbook would.
+
+Columns of a CSV file are referred to by letters ('A', 'B', ...), by
+0-based positions or, if the file has a header, by names from the header.
+NDJSON rows may be arrays, that are mapped the same way as CSV rows, or
+objects, whose columns are referred to by keys.
+"""
+
+import csv
+import itertools
+import json
+import os
+from schedcaster.parser.spec import columnIndex, parseRow, sheetColumns
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+
+# extension => format
+EXTENSIONS = {
+    '.csv': FORMAT_CSV,
+    '.ndjson': FORMAT_NDJSON,
+    '.jsonl': FORMAT_NDJSON,
+}
+
+
+def parse(filename, spec, sheetName=None, format=None, header=False,
+          encoding='utf-8', **csvOptions):
+    return list(iterParse(filename, spec, sheetName, format, header,
+                          encoding, **csvOptions))
+
+
+def iterParse(filename, spec, sheetName=None, format=None, header=False,
+              encoding='utf-8', **csvOptions):
+    '''Parses a file row by row
+       :param sheetName: sheet of the spec, that describes the file, the only
+                         sheet of the spec or the file name without extension
+                         by default
+       :param format: FORMAT_CSV or FORMAT_NDJSON, guessed by the extension
+                      by default
+       :param header: whether the first row of a CSV file names its columns
+       :param csvOptions: csv.reader dialect and format parameters
+       :rtype: generator of Entry'''
+    if format == None:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in EXTENSIONS:
+            raise RuntimeError("unknown format of %s" % filename)
+        format = EXTENSIONS[extension]
+    sheetSpec = __sheetSpec(filename, spec, sheetName)
+
+    with open(filename, newline='', encoding=encoding) as f:
+        if format == FORMAT_CSV:
+            entries = iterCSV(f, sheetSpec, header, **csvOptions)
+        elif format == FORMAT_NDJSON:
+            entries = iterNDJSON(f, sheetSpec)
+        else:
+            raise RuntimeError("unknown format: %s" % format)
+        for entry in entries:
+            yield entry
+
+
+def iterChunks(filename, spec, chunkSize=1000, **kwargs):
+    '''Same as iterParse, but yields lists of up to chunkSize entries, e.g.
+       to save them with Config.saveMany
+       :rtype: generator of lists of Entry'''
+    entries = iterParse(filename, spec, **kwargs)
+    while True:
+        chunk = list(itertools.islice(entries, chunkSize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iterCSV(f, sheetSpec, header=False, **csvOptions):
+    '''Parses CSV rows of an open file
+       :rtype: generator of Entry'''
+    reader = csv.reader(f, **csvOptions)
+    names = None
+    firstRow = 1
+    if header:
+        names = next(reader, [])
+        firstRow = 2
+    columns, hashColumns = sheetColumns(sheetSpec,
+                                        lambda name: __indexOf(name, names))
+
+    for i, row in enumerate(reader):
+        # empty cells are None, as they are in workbooks
+        row = [value if value != '' else None for value in row]
+        entry = parseRow(row, str(firstRow + i), sheetSpec.name, columns,
+                         hashColumns)
+        if entry != None:
+            yield entry
+
+
+def iterNDJSON(f, sheetSpec):
+    '''Parses NDJSON rows of an open file
+       :rtype: generator of Entry'''
+    # objects are turned into rows of the referenced keys
+    keys = []
+    for name in itertools.chain(sheetSpec.columns.keys(),
+                                sheetSpec.hashSpec.columnNames):
+        if name not in keys:
+            keys.append(name)
+    byKey = sheetColumns(sheetSpec, keys.index)
+    byPosition = None
+
+    for i, line in enumerate(f):
+        if not line.strip():
+            continue
+        value = json.loads(line)
+        if isinstance(value, dict):
+            row = [value.get(key) for key in keys]
+            columns, hashColumns = byKey
+        elif isinstance(value, list):
+            row = value
+            if byPosition == None:
+                byPosition = sheetColumns(sheetSpec, __indexOf)
+            columns, hashColumns = byPosition
+        else:
+            raise RuntimeError("line %d of %s is neither an object nor an "
+                               "array" % (i + 1, sheetSpec.name))
+        entry = parseRow(row, str(i + 1), sheetSpec.name, columns,
+                         hashColumns)
+        if entry != None:
+            yield entry
+
+
+def __sheetSpec(filename, spec, sheetName):
+    if sheetName == None:
+        if len(spec.sheets) == 1:
+            return list(spec.sheets.values())[0]
+        sheetName = os.path.splitext(os.path.basename(filename))[0]
+    if sheetName not in spec.sheets:
+        raise RuntimeError("no sheet %s in the spec" % sheetName)
+    return spec.sheets[sheetName]
+
+
+def __indexOf(name, header=None):
+    if isinstance(name, int):
+        return name
+    if header != None and name in header:
+        return header.index(name)
+    return columnIndex(name)
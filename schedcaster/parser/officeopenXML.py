@@ -5,99 +5,156 @@ Created on Thu Aug  2 19:16:58 2012
 @author: avsh
 """
 
-from openpyxl import load_workbook
-import schedcaster
-import hashlib
+import logging
+import multiprocessing
+import pickle
+# spec classes used to live here, so they are still importable from here
+from schedcaster.parser.spec import Spec, SheetSpec, ColumnSpec, HashSpec, \
+    acceptAll, keepValue, newEntry, parseRow, sheetColumns
 
+# state of parseParallel workers, set by __initWorker in them only
+__workerSpec = None
+__workerBook = None
 
-def parse(filename, spec):
-    wb = load_workbook(filename)
-    return parseWorkbook(wb, spec)
-
-
-def parseWorkbook(wb, spec):
-    entries = []
-
-    # iterate only sheets, that we support via sheetToType
-    for sheetName in filter(lambda s: s in spec.sheets, wb.get_sheet_names()):
-        sheet = wb.get_sheet_by_name(sheetName)
-        sheetSpec = spec.sheets[sheetName]
-
-        rows = sheet.get_highest_row()
-        for i in range(1, rows + 1):
-            rowName = str(i)
-            entry = schedcaster.scheduler.Entry(
-                                    state=schedcaster.scheduler.STATE_ONESHOT,
-                                    handler='post')
-
-            poisoned = False  # indicates if row cannot be parsed
-            for col in sheetSpec.columns.items():
-                columnName = col[0]
-                argName = col[1].argName
-                filterFn = col[1].filterFn
-                # use trivial preprocessor if none given
-                preprocessorFn = col[1].processorFn
-
-                cellValue = sheet.cell(columnName + rowName).value
-                # if filter fails, skip this row
-                if not filterFn(cellValue):
-                    poisoned = True
-                    break
-                cellRealValue = preprocessorFn(cellValue)
-
-                if argName[0] == '@':
-                    argName = argName[1:]
-                    if argName == 'cron':
-                        entry.cron = cellRealValue
-                    else:
-                        raise RuntimeError('wrong parameter @%s' % columnName)
-                else:
-                    entry.arg(argName, cellRealValue)
-
-            # if row has incorrect format, do not add it
-            if poisoned:
-                continue
-
-            # compute hash based on the cells provided
-            # hash is used to check if the value is already used in the db
-            hashSrc = "&".join(
-                map(lambda col: str(sheet.cell(col + rowName).value or ""),
-                    sheetSpec.hashSpec.columnNames)).encode('utf-16')
-            entry.arg('hash', hashlib.md5(hashSrc).digest())
-            #use as id instead
-            entry.id = hashSrc
 
-            entries.append(entry)
-
-    return entries
-
-
-class Spec(object):
-    def __init__(self, sheets=[]):
-        self.sheets = {}
-        for sheet in sheets:
-            self.sheets[sheet.name] = sheet
+def parse(filename, spec):
+    return list(iterParse(filename, spec))
 
 
-class SheetSpec(object):
-    def __init__(self, name, columns=[], hashSpec=None):
-        self.name = name
-        self.columns = {}
-        for column in columns:
-            self.columns[column.name] = column
-        self.hashSpec = hashSpec
+def iterParse(filename, spec):
+    '''Parses a workbook row by row without loading it into memory
+       :rtype: generator of Entry'''
+    wb = __loadWorkbook(filename)
+    try:
+        for entry in iterWorkbook(wb, spec):
+            yield entry
+    finally:
+        # read-only workbooks keep the file open
+        wb.close()
 
 
-class ColumnSpec(object):
-    def __init__(self, name, argName,
-                      filterFn=lambda v: True,
-                      processorFn=lambda v: v):
-        self.name = name
-        self.argName = argName
-        self.filterFn = filterFn
-        self.processorFn = processorFn
+def parseWorkbook(wb, spec):
+    return list(iterWorkbook(wb, spec))
 
 
-class HashSpec(object):
-    def __init__(self, columnNames=[]):
-        self.columnNames = columnNames
+def iterWorkbook(wb, spec):
+    '''Parses sheets of a workbook, reading each row only once
+       :rtype: generator of Entry'''
+    # iterate only sheets, that we support via sheetToType
+    for sheetName in filter(lambda s: s in spec.sheets, wb.sheetnames):
+        for entry in __iterSheet(wb[sheetName], spec.sheets[sheetName]):
+            yield entry
+
+
+def parseParallel(filename, spec, processes=None, chunkRows=None):
+    return list(iterParseParallel(filename, spec, processes, chunkRows))
+
+
+def iterParseParallel(filename, spec, processes=None, chunkRows=None):
+    '''Parses sheets of a workbook, or ranges of their rows, in a pool of
+       processes. Entries come in the same order as from iterParse.
+       Workers get the spec by forking, where fork isn't available it is
+       pickled, so its functions must be module level ones. A spec, that
+       can't be pickled, is parsed in this process
+       :param processes: number of processes, defaults to number of cpus
+       :param chunkRows: max number of rows parsed by a single task, whole
+                         sheets are parsed by a single task if None. Each
+                         task reads its sheet from the start, so it pays
+                         off only when rows are expensive to process
+       :rtype: generator of Entry'''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        pickledSpec = None
+    else:
+        context = multiprocessing.get_context()
+        try:
+            pickledSpec = pickle.dumps(spec)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            logging.warning("spec can't be pickled, parsing %s in a single "
+                            "process: %s" % (filename, e))
+            for entry in iterParse(filename, spec):
+                yield entry
+            return
+
+    tasks = [(filename,) + task for task in __tasks(filename, spec, chunkRows)]
+    # forked workers inherit initargs as they are, others get them pickled,
+    # so the spec goes pickled by hand, to be able to fall back above
+    pool = context.Pool(processes, __initWorker,
+                        (pickledSpec == None and spec or None, pickledSpec))
+    try:
+        # imap keeps the order of tasks, so merging is deterministic
+        for rows in pool.imap(__parseTask, tasks):
+            for id, cron, args in rows:
+                entry = newEntry(id, cron)
+                for name, value in args:
+                    entry.arg(name, value)
+                yield entry
+    finally:
+        pool.terminate()
+
+
+def __tasks(filename, spec, chunkRows):
+    '''Splits parsing of a workbook into (sheet name, min row, max row)'''
+    wb = __loadWorkbook(filename)
+    try:
+        tasks = []
+        for sheetName in filter(lambda s: s in spec.sheets, wb.sheetnames):
+            # max_row comes from the sheet dimensions, it may be unknown
+            maxRow = wb[sheetName].max_row
+            if chunkRows == None or not maxRow:
+                tasks.append((sheetName, 1, None))
+                continue
+            for minRow in range(1, maxRow + 1, chunkRows):
+                tasks.append((sheetName, minRow,
+                              min(minRow + chunkRows - 1, maxRow)))
+        return tasks
+    finally:
+        wb.close()
+
+
+def __loadWorkbook(filename):
+    # openpyxl takes long to import, so it is imported only when a workbook
+    # is actually read
+    from openpyxl import load_workbook
+    return load_workbook(filename, read_only=True)
+
+
+def __initWorker(spec, pickledSpec):
+    global __workerSpec, __workerBook
+    __workerSpec = pickledSpec == None and spec or pickle.loads(pickledSpec)
+    __workerBook = None
+
+
+def __parseTask(task):
+    global __workerBook
+    filename, sheetName, minRow, maxRow = task
+    # a worker usually gets many tasks of the same workbook
+    if __workerBook == None or __workerBook[0] != filename:
+        if __workerBook != None:
+            __workerBook[1].close()
+        __workerBook = (filename, __loadWorkbook(filename))
+    return __parseRows(__workerBook[1], __workerSpec, sheetName, minRow,
+                       maxRow)
+
+
+def __parseRows(wb, spec, sheetName, minRow, maxRow):
+    '''Parses a range of rows of a sheet
+       :rtype: list of (id, cron, [(arg name, value)])'''
+    # plain tuples are much cheaper to pickle than entries with their args
+    return [(entry.id, entry.cron,
+             [(arg.name, arg.value) for arg in entry.args.values()])
+            for entry in __iterSheet(wb[sheetName], spec.sheets[sheetName],
+                                     minRow, maxRow)]
+
+
+def __iterSheet(sheet, sheetSpec, minRow=1, maxRow=None):
+    # map column letters to positions in a row once per sheet
+    columns, hashColumns = sheetColumns(sheetSpec)
+
+    rows = sheet.iter_rows(min_row=minRow, max_row=maxRow, values_only=True)
+    for i, row in enumerate(rows):
+        entry = parseRow(row, str(minRow + i), sheetSpec.name, columns,
+                         hashColumns)
+        # if row has incorrect format, do not add it
+        if entry != None:
+            yield entry
@@ -0,0 +1,142 @@
+"""
+Description of the tabular schedule format, shared by all parsers: which
+columns of which sheets hold entry args and which ones identify an entry.
+Parsers turn their rows into tuples of cell values and leave the rest to
+parseRow, so the same row gives the same Entry whatever the file format.
+"""
+
+import logging
+import schedcaster.scheduler
+from schedcaster import cron as Cron
+
+
+def columnIndex(name):
+    '''Gets position of a column in a row by its letters, e.g. 'A' is 0 and
+       'AA' is 26
+       :rtype: int'''
+    index = 0
+    for letter in name.upper():
+        if not 'A' <= letter <= 'Z':
+            raise RuntimeError("wrong column name: %s" % name)
+        index = index * 26 + ord(letter) - ord('A') + 1
+    if index == 0:
+        raise RuntimeError("wrong column name: %s" % name)
+    return index - 1
+
+
+def sheetColumns(sheetSpec, indexOf=columnIndex):
+    '''Maps columns of a sheet spec to positions in a row once, so that rows
+       are parsed without looking columns up by name
+       :param indexOf: function, that gets position of a column by its name
+       :rtype: ([(position, ColumnSpec)], [position of a hash column])'''
+    columns = [(indexOf(name), column)
+               for name, column in sheetSpec.columns.items()]
+    hashColumns = [indexOf(name) for name in sheetSpec.hashSpec.columnNames]
+    return columns, hashColumns
+
+
+def newEntry(id=None, cron=None):
+    '''Makes an empty entry the way parsers do'''
+    entry = schedcaster.scheduler.Entry(
+                            id=id,
+                            state=schedcaster.scheduler.STATE_ONESHOT,
+                            handler='post')
+    if cron != None:
+        entry.cron = cron
+    return entry
+
+
+def parseRow(row, rowName, sheetName, columns, hashColumns):
+    '''Makes an entry of a row
+       :param row: sequence of cell values, None for empty cells
+       :param columns: columns as given by sheetColumns
+       :rtype: Entry or None, if the row cannot be parsed'''
+    entry = newEntry()
+
+    for index, column in columns:
+        argName = column.argName
+        cellValue = __cell(row, index)
+        # if filter fails, skip this row
+        if not column.filterFn(cellValue):
+            return None
+        cellRealValue = column.processorFn(cellValue)
+
+        if argName[0] == '@':
+            argName = argName[1:]
+            if argName == 'cron':
+                # reject malformed crons here rather than when they reach
+                # the scheduler
+                try:
+                    Cron.compile(cellRealValue)
+                except ValueError as e:
+                    logging.warning("skipping row %s of %s: %s" %
+                                    (rowName, sheetName, e))
+                    return None
+                entry.cron = cellRealValue
+            else:
+                raise RuntimeError('wrong parameter @%s' % column.name)
+        else:
+            entry.arg(argName, cellRealValue)
+
+    # id is based on the hash columns, so it stays the same when the rest
+    # of the row is edited
+    hashSrc = "&".join(
+        map(lambda index: str(__cell(row, index) or ""),
+            hashColumns)).encode('utf-16')
+    entry.id = schedcaster.scheduler.makeId(hashSrc)
+    # while hash covers every parsed cell, so it tells if the row was
+    # changed since the last import
+    contentSrc = "&".join(
+        map(lambda item: str(__cell(row, item[0]) or ""),
+            sorted(columns, key=lambda item: item[0]))).encode('utf-16')
+    entry.arg(schedcaster.scheduler.ARG_HASH,
+              schedcaster.scheduler.digest(hashSrc + b'&' + contentSrc))
+    return entry
+
+
+def __cell(row, index):
+    # rows may omit trailing empty cells
+    if index < len(row):
+        return row[index]
+    return None
+
+
+def acceptAll(value):
+    '''Default ColumnSpec filter'''
+    return True
+
+
+def keepValue(value):
+    '''Default ColumnSpec processor'''
+    return value
+
+
+class Spec(object):
+    def __init__(self, sheets=[]):
+        self.sheets = {}
+        for sheet in sheets:
+            self.sheets[sheet.name] = sheet
+
+
+class SheetSpec(object):
+    def __init__(self, name, columns=[], hashSpec=None):
+        self.name = name
+        self.columns = {}
+        for column in columns:
+            self.columns[column.name] = column
+        self.hashSpec = hashSpec
+
+
+class ColumnSpec(object):
+    def __init__(self, name, argName,
+                      filterFn=acceptAll,
+                      processorFn=keepValue):
+        self.name = name
+        self.argName = argName
+        self.filterFn = filterFn
+        self.processorFn = processorFn
+
+
+class HashSpec(object):
+    def __init__(self, columnNames=[]):
+        self.columnNames = columnNames
@@ -1,18 +1,144 @@
-import apscheduler.scheduler as apscheduler
+import concurrent.futures
+import datetime
+import gc
+import hashlib
 import logging
+import math
+import os
+import threading
+import time
+from schedcaster import cron as Cron
+from schedcaster import metrics as Metrics
+from schedcaster import snapshot as Snapshot
+from schedcaster.engine import HeapScheduler
+from schedcaster.config.writebehind import WriteBehind
+from schedcaster.catchup import CatchUpQueue, STATUS_EXPIRED
 
 STATE_DONE = 1
 STATE_ONESHOT = 2
 
+# arg with a digest of the entry's source data
+ARG_HASH = 'hash'
+# arg with the name of the file, an entry was imported from. Args starting
+# with ':' are not passed to handlers
+ARG_IMPORT = ':import'
+
+
+# size of entry ids and digests in bytes
+DIGEST_SIZE = 16
+
+# per thread state of entry processing, see currentEntryId and currentDue
+processing = threading.local()
+
+FIRE_LAG = Metrics.histogram('schedcaster_fire_lag_seconds',
+    'Seconds entries are fired after their cron time')
+HANDLER_SECONDS = Metrics.histogram('schedcaster_handler_seconds',
+    'Seconds taken by entry handlers', ('handler',))
+HANDLER_ERRORS = Metrics.counter('schedcaster_handler_errors',
+    'Exceptions raised by entry handlers', ('handler',))
+RESCHEDULE_SECONDS = Metrics.histogram('schedcaster_reschedule_seconds',
+    'Seconds taken to synchronize jobs with the config')
+SCHEDULED_ENTRIES = Metrics.gauge('schedcaster_scheduled_entries',
+    'Number of entries scheduled by the last refreshed scheduler')
+
+BACKEND_APSCHEDULER = 'apscheduler'
+BACKEND_HEAP = 'heap'
+
+
+def withoutCollection(fn):
+    '''Decorator, that pauses garbage collection during the call. Making
+       many long-lived objects at once triggers full collections, that scan
+       all of them again and again'''
+    def uncollected(*args, **kwargs):
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if collecting:
+                gc.enable()
+    return uncollected
+
 
 class Scheduler:
-    def __init__(self, config, grace_time=None):
+    def __init__(self, config, grace_time=None, backend=BACKEND_APSCHEDULER,
+                 flushInterval=1.0, catchUpRate=1.0, catchUpBurst=1,
+                 sharding=None, window=None, topUpInterval=None,
+                 snapshot=None, watchInterval=None, maxThreads=20):
+        '''
+           :param config: config provider to get entries from
+           :param grace_time: seconds after the designated fire time, during
+                              which a missed job is still run
+           :param backend: BACKEND_APSCHEDULER or BACKEND_HEAP, the latter
+                           scales better for very large sets of entries
+           :param flushInterval: max seconds state changes of fired entries
+                                 wait to be written to the config together,
+                                 0 to write each of them at once
+           :param catchUpRate: max number of missed one-shots fired per
+                               second, oldest ones go first
+           :param catchUpBurst: max number of missed one-shots fired at once
+           :param sharding: ShardLeases, so that several processes may share
+                            the config, each of them firing only entries of
+                            the shards it holds, None to fire all entries
+           :param window: seconds to look ahead, only entries due within
+                          the window are loaded, so that memory depends on
+                          the near-term load rather than on the size of the
+                          schedule, None to load all active entries
+           :param topUpInterval: seconds between loads of entries, that
+                                 enter the window, defaults to a quarter of
+                                 the window
+           :param snapshot: file to keep compiled jobs in between runs. It
+                            is written on stop and used on start instead of
+                            loading the config, unless the config was
+                            changed meanwhile. It must not be shared with
+                            other schedulers
+           :param watchInterval: seconds between checks of the config for
+                                 changes made elsewhere, e.g. by other
+                                 processes or by admin tools. Changed
+                                 entries are rescheduled without a refresh.
+                                 None not to watch, see
+                                 Config.changesSince
+           :param maxThreads: max number of handlers run at once by the heap
+                              backend, the same as the default thread pool
+                              of apscheduler. Fires, that wait for a thread
+                              past grace_time, are skipped'''
+        if backend not in (BACKEND_APSCHEDULER, BACKEND_HEAP):
+            raise RuntimeError("unknown scheduler backend: %s" % backend)
+        if window != None:
+            topUpInterval = topUpInterval or window / 4.0
+            if topUpInterval >= window:
+                raise RuntimeError("window must be longer than the interval "
+                                   "it is topped up at")
         self.config = config
         self.grace_time = grace_time or 60 * 60 * 24  # 1 day
-        self.scheduler_real = apscheduler.Scheduler(
-            misfire_grace_time=self.grace_time)
-        apscheduler.logger = logging
+        self.backend = backend
+        # shared by backends made on every stop, it outlives them, so that
+        # handlers in progress aren't waited for
+        self.__executor = backend == BACKEND_HEAP and \
+            concurrent.futures.ThreadPoolExecutor(
+                maxThreads, thread_name_prefix='Scheduler') or None
+        self.scheduler_real = self.__makeBackend()
         self.handlers = {}
+        self.__jobs = {}  # entry id => Job
+        self.__jobsLock = threading.RLock()
+        # states of fired entries are already known to this scheduler, so
+        # they don't make its snapshot stale
+        self.__writer = WriteBehind(config, interval=flushInterval,
+                                    track=False)
+        self.__catchUp = CatchUpQueue(catchUpRate, catchUpBurst,
+                                      self.grace_time)
+        self.__catchUpCondition = threading.Condition()
+        self.__catchUpThread = None
+        self.__sharding = sharding
+        self.window = window
+        self.topUpInterval = topUpInterval
+        self.__topUpStopped = None
+        self.snapshot = snapshot
+        self.__counter = None  # change counter of the config, jobs match
+        self.__horizon = None  # timestamp, all jobs due before are loaded
+        self.watchInterval = watchInterval
+        self.__watchStopped = None
+        self.__position = None  # position in the change log of the config
 
     def addHandler(self, name, handler):
         self.handlers[name] = handler
@@ -25,9 +151,39 @@ class Scheduler:
         if self.started():
             return
         try:
+            # a snapshot is used at most once, it is stale as soon as
+            # entries are fired
+            snapshot = self.__takeSnapshot()
+            if self.watchInterval != None:
+                # taken before the entries are loaded, so that changes made
+                # meanwhile are applied again rather than missed
+                self.__position = self.config.changesSince()[0]
+            if self.__sharding != None:
+                self.__sharding.addListener(self.__shardsChanged)
+                self.__sharding.start()
             self.scheduler_real.start()
-            if refresh:
+            with self.__catchUpCondition:
+                self.__catchUpThread = threading.Thread(
+                    target=self.__runCatchUp, name='CatchUp')
+                self.__catchUpThread.daemon = True
+                self.__catchUpThread.start()
+            if self.window != None:
+                self.__topUpStopped = threading.Event()
+                thread = threading.Thread(target=self.__runTopUp,
+                                          args=(self.__topUpStopped,),
+                                          name='TopUp')
+                thread.daemon = True
+                thread.start()
+            if refresh and not (snapshot != None and
+                                self.__restore(snapshot)):
                 self.refresh(False)
+            if self.watchInterval != None:
+                self.__watchStopped = threading.Event()
+                thread = threading.Thread(target=self.__runWatch,
+                                          args=(self.__watchStopped,),
+                                          name='Watch')
+                thread.daemon = True
+                thread.start()
         except ValueError as e:
             logging.error(\
               "[BUG] failed to add unknown scheduler entry: %s" % str(e))
@@ -36,95 +192,489 @@ class Scheduler:
         if not self.started():
             return
         self.scheduler_real.shutdown(shutdown_threadpool=False)
+        with self.__catchUpCondition:
+            thread = self.__catchUpThread
+            self.__catchUpThread = None
+            self.__catchUp.clear()
+            self.__catchUpCondition.notify()
+        if thread != threading.current_thread():
+            thread.join()
+        if self.__topUpStopped != None:
+            self.__topUpStopped.set()
+            self.__topUpStopped = None
+        if self.__watchStopped != None:
+            self.__watchStopped.set()
+            self.__watchStopped = None
+        if self.__sharding != None:
+            self.__sharding.removeListener(self.__shardsChanged)
+            self.__sharding.stop()
         # a hack, because apscheduler doesn't clears its jobs list
         # even with shutdown(..., close_jobstores=True)
-        self.scheduler_real = apscheduler.Scheduler(
-            misfire_grace_time=self.grace_time)
+        self.scheduler_real = self.__makeBackend()
+        with self.__jobsLock:
+            jobs = self.__jobs
+            self.__jobs = {}
+        # write down what was done before the stop
+        self.__writer.close()
+        if self.snapshot != None and self.__counter != None:
+            self.__saveSnapshot(jobs.values())
 
-    def refresh(self, restart=True):
+    def refresh(self, restart=False):
+        '''Synchronizes scheduled jobs with active entries of the config.
+           Only jobs of new, changed or removed entries are touched
+           :param restart: whether to drop all jobs and rebuild them from
+                           scratch'''
         if self.started() and restart:
             self.stop()
         if restart:
             self.start(False)
         self.__reschedule()
 
+    def upsertEntry(self, entry):
+        '''Schedules a new entry or reschedules a changed one, unchanged
+           entries are left as they are. Allows to apply a change without
+           reloading the whole config
+           :param entry: entry to schedule
+           :rtype: whether the entry was (re)scheduled'''
+        if entry.state & STATE_DONE or (self.__sharding != None and
+                                        not self.__sharding.owns(entry.id)):
+            self.removeEntry(entry.id)
+            return False
+
+        fingerprint = entryFingerprint(entry)
+        with self.__jobsLock:
+            job = self.__jobs.get(entry.id)
+            if job != None:
+                if job.fingerprint == fingerprint:
+                    return False
+                self.__unschedule(job)
+            self.__jobs[entry.id] = self.__schedule(Job(entry, fingerprint))
+        # args of entries loaded from the config are loaded again on fire
+        entry.dropArgs()
+        return True
+
+    def preview(self, entry, n=10, after=None):
+        '''Computes the next fire times of an entry
+           :param n: max number of fire times to compute
+           :param after: datetime to start from, defaults to now
+           :rtype: list of datetime'''
+        return Cron.compile(entry.cron).nextFires(
+            after or datetime.datetime.now(), n)
+
+    def removeEntry(self, id):
+        '''Unschedules an entry
+           :param id: id of the entry
+           :rtype: whether the entry was scheduled'''
+        with self.__jobsLock:
+            job = self.__jobs.pop(id, None)
+            if job == None:
+                return False
+            self.__unschedule(job)
+        return True
+
+    def catchUpStats(self):
+        '''Gets number of missed one-shots waiting to be fired and seconds
+           it takes to fire them, see CatchUpQueue.stats
+           :rtype: dict'''
+        return self.__catchUp.stats()
+
+    def __makeBackend(self):
+        if self.backend == BACKEND_HEAP:
+            return HeapScheduler(misfire_grace_time=self.grace_time,
+                                 executor=self.__executor)
+        # imported only when it is used, it takes long to import
+        import apscheduler.scheduler as apscheduler
+        apscheduler.logger = logging
+        return apscheduler.Scheduler(misfire_grace_time=self.grace_time)
+
+    @RESCHEDULE_SECONDS.time()
     def __reschedule(self):
-        for entry in self.config.getActive():
+        # one-shots, that were done already, must not be seen as active
+        self.__writer.flush()
+        if self.snapshot != None:
+            # read before the entries, so that changes made meanwhile make
+            # the snapshot stale
+            counter = self.config.changeCounter()
+        seen = set()
+        if self.window != None:
+            horizon = time.time() + self.window
+            entries = self.config.iterateDue(horizon)
+        else:
+            horizon = math.inf
+            entries = self.config.iterateActive()
+        for entry in entries:
+            seen.add(entry.id)
+            self.upsertEntry(entry)
+
+        with self.__jobsLock:
+            removed = [id for id in self.__jobs if id not in seen]
+        for id in removed:
+            self.removeEntry(id)
+        with self.__jobsLock:
+            SCHEDULED_ENTRIES.set(len(self.__jobs))
+        if self.snapshot != None:
+            self.__counter = counter
+        self.__horizon = horizon
+
+    @withoutCollection
+    def __takeSnapshot(self):
+        '''Loads the snapshot and removes its file
+           :rtype: Snapshot or None, if there is none'''
+        if self.snapshot == None:
+            return None
+        try:
+            snapshot = Snapshot.load(self.snapshot)
+        except FileNotFoundError:
+            return None
+        except (OSError, RuntimeError) as e:
+            logging.warning("failed to load snapshot: %s" % e)
+            snapshot = None
+        try:
+            os.remove(self.snapshot)
+        except OSError as e:
+            logging.warning("failed to remove snapshot: %s" % e)
+            snapshot = None
+        return snapshot
+
+    @withoutCollection
+    def __restore(self, snapshot):
+        '''Schedules jobs of a snapshot instead of loading the config, if
+           the config was not changed since the snapshot was taken
+           :rtype: whether the jobs were restored'''
+        if snapshot.counter != self.config.changeCounter():
+            logging.info("config was changed since the snapshot was taken")
+            return False
+        # entries, that enter the window before the first top-up, must be
+        # in the snapshot
+        if snapshot.horizon < (self.window == None and math.inf or
+                               time.time() + self.topUpInterval):
+            logging.info("snapshot doesn't cover the window")
+            return False
+
+        now = time.time()
+        loader = self.config.getArgs
+        with self.__jobsLock:
+            due = []
+            for id, cron, handler, state, fire, argsDigest in \
+                    snapshot.entries:
+                if self.__sharding != None and \
+                   not self.__sharding.owns(id):
+                    continue
+                job = Job(Entry(id, cron, state, handler=handler,
+                                loader=loader),
+                          (cron, handler, state, argsDigest))
+                self.__jobs[id] = job
+                if self.backend == BACKEND_HEAP and fire != None and \
+                   fire > now:
+                    job.due = fire
+                    due.append(job)
+                else:
+                    # missed ones are caught up as usual
+                    self.__schedule(job)
+            if due:
+                handles = self.scheduler_real.addJobsAt(
+                    (self.__firing(job), job.entry.cron, job.due)
+                    for job in due)
+                for job, handle in zip(due, handles):
+                    job.handle = handle
+            SCHEDULED_ENTRIES.set(len(self.__jobs))
+        self.__counter = snapshot.counter
+        self.__horizon = snapshot.horizon
+        logging.info("restored %d jobs from the snapshot" %
+                     len(snapshot.entries))
+        return True
+
+    def __saveSnapshot(self, jobs):
+        entries = [(job.entry.id, job.entry.cron, job.entry.handler,
+                    job.entry.state, job.due, job.fingerprint[3])
+                   for job in jobs]
+        try:
+            Snapshot.save(self.snapshot, Snapshot.Snapshot(
+                self.__counter, self.__horizon, entries))
+        except (OSError, RuntimeError) as e:
+            logging.error("failed to save snapshot: %s" % e)
+
+    def __firing(self, job):
+        '''Gets a function, that fires a job, for the backend'''
+        # a hack (job=job) to avoid lexical passing of object
+        # see: http://stackoverflow.com/questions/233673
+        def doProcess(job=job):
+            self.__fire(job)
+        return doProcess
+
+    def __schedule(self, job):
+        entry = job.entry
+        doProcess = self.__firing(job)
+
+        try:
+            cron = Cron.compile(entry.cron)
+        except ValueError as e:
+            logging.error("not scheduling entry %s: %s" % (entry.id, e))
+            return job
+
+        try:
+            fire = cron.nextFireAfter(datetime.datetime.now())
+            if fire == None:
+                raise ValueError('Not adding job since it would never be run')
+            job.due = fire.timestamp()
+            job.handle = self.scheduler_real.add_cron_job(doProcess,
+                                                          **cron.fields)
+        except ValueError as e:
+            # if job is scheduled at the past and it was not done before,
+            # let it catch up along with the other missed ones
+            if str(e) != 'Not adding job since it would never be run':
+                raise
+            due = cron.firstFire()
+            if    entry.state & STATE_ONESHOT and\
+              not entry.state & STATE_DONE and due != None:
+                with self.__catchUpCondition:
+                    self.__catchUp.put(job, due.timestamp())
+                    self.__catchUpCondition.notify()
+        return job
+
+    def __fire(self, job, due=None):
+        entry = job.entry
+        if not entry.state & STATE_DONE:
+            now = time.time()
+            due = due or job.due
+            if due != None:
+                FIRE_LAG.observe(max(now - due, 0.0))
+            else:
+                # every process agrees on the second
+                due = math.floor(now)
+            if not entry.state & STATE_ONESHOT:
+                fire = Cron.compile(entry.cron).nextFireAfter(
+                    datetime.datetime.fromtimestamp(now))
+                job.due = fire and fire.timestamp()
+            if self.__sharding != None and \
+               not self.__sharding.claim(entry.id, due):
+                if not entry.state & STATE_ONESHOT:
+                    return
+                if self.__sharding.claimed(entry.id, due):
+                    # fired by another process
+                    self.__forget(job)
+                else:
+                    # our lease lapsed, the fire is retried until the lease
+                    # is renewed or the shard is given away along with it
+                    with self.__catchUpCondition:
+                        self.__catchUp.put(job, due)
+                        self.__catchUpCondition.notify()
+                return
+            self.__process(entry, due)
+            if entry.state & STATE_ONESHOT:
+                entry.state |= STATE_DONE
+                self.__writer.put(entry.id, {'state': entry.state,
+                                             'next_fire': None})
+                self.__forget(job)
+            else:
+                # lets windowed schedulers tell when to load the entry
+                self.__writer.put(entry.id, {'next_fire': job.due})
+
+    def __expire(self, job, due):
+        entry = job.entry
+        logging.warning("Entry %s was missed by %s, it won't be run" % (
+            entry.id, datetime.timedelta(seconds=time.time() - due)))
+        entry.state |= STATE_DONE
+        entry.status = STATUS_EXPIRED
+        self.__writer.put(entry.id, {'state': entry.state,
+                                     'status': entry.status})
+        self.__forget(job)
+
+    def __forget(self, job):
+        '''Unschedules a job of a done one-shot'''
+        with self.__jobsLock:
+            if self.__jobs.get(job.entry.id) is job:
+                self.__jobs.pop(job.entry.id)
+        # we need to unschedule one-shots with non-one-shot crons
+        # (e.g. * * * * * * *)
+        self.__unschedule(job)
+
+    def __shardsChanged(self, acquired, released):
+        # entries of acquired shards are loaded, the rest are dropped
+        if self.started():
+            self.__reschedule()
+
+    def __runTopUp(self, stopped):
+        while not stopped.wait(self.topUpInterval):
+            try:
+                # loads entries, that entered the window, and drops the ones,
+                # that left it
+                self.__reschedule()
+            except Exception:
+                logging.exception("failed to top the window up")
+
+    def __runWatch(self, stopped):
+        while not stopped.wait(self.watchInterval):
+            try:
+                self.__applyChanges()
+            except Exception:
+                logging.exception("failed to apply changes of the config")
+
+    def __applyChanges(self):
+        '''Reschedules entries, that were changed since the last check'''
+        # one-shots, that were done already, must not be seen as active
+        self.__writer.flush()
+        position, ids = self.config.changesSince(self.__position)
+        if ids == None:
+            # the changes are lost, so everything is compared
+            self.__reschedule()
+        elif ids:
+            found = set()
+            for entry in self.config.iterate(list(ids)):
+                found.add(entry.id)
+                # entries beyond the window are loaded by top-ups
+                if self.window != None and \
+                   (nextFireOf(entry.cron, entry.state) or math.inf) > \
+                   (self.__horizon or 0):
+                    self.removeEntry(entry.id)
+                else:
+                    self.upsertEntry(entry)
+            for id in ids - found:
+                self.removeEntry(id)
+            with self.__jobsLock:
+                SCHEDULED_ENTRIES.set(len(self.__jobs))
+        self.__position = position
+
+    def __runCatchUp(self):
+        thread = threading.current_thread()
+        while True:
+            with self.__catchUpCondition:
+                item = None
+                while self.__catchUpThread is thread and item == None:
+                    item = self.__catchUp.pop()
+                    if item == None:
+                        self.__catchUpCondition.wait(self.__catchUp.wait())
+                if self.__catchUpThread is not thread:
+                    return
+
+            job, due, expired = item
+            with self.__jobsLock:
+                # the entry was changed or removed while it waited
+                if self.__jobs.get(job.entry.id) is not job:
+                    continue
             try:
-                sjob = []
-
-                # a hack (entry=entry) to avoid lexical passing of object
-                # see: http://stackoverflow.com/questions/233673
-                #
-                # using reference type for sjob to modify it further in the
-                # code if sjob = 0 was used, it would be copied here and
-                # issuing sjob = self.sceduler_real... later would be of no use
-                def doProcess(entry=entry, sjob=sjob):
-                    if not entry.state & STATE_DONE:
-                        self.__process(entry)
-                        if entry.state & STATE_ONESHOT:
-                            entry.state |= STATE_DONE
-                            self.config.update(entry)
-                            try:
-                                self.scheduler_real.unschedule_job(sjob[0])
-                            except KeyError:
-                                # apscheduler automatically unshecules
-                                # one-shot cron jobs, so unshedule_job will
-                                # fail in this case and raise KeyError,
-                                # we can't know if job is unscheduled,
-                                # but we need to unschedule one-shots with
-                                # non-one-shot crons (e.g. * * * * * * *)
-                                # that is done above, in the 'try' block
-                                pass
-                sjob.append(self.scheduler_real.add_cron_job(doProcess,
-                                             **self.__cronToAPMap(entry.cron)))
-            except ValueError as e:
-                # if job is scheduled at the past and it was not done before,
-                # issue it to be done immediately
-                if str(e) != 'Not adding job since it would never be run':
-                    raise
-                if    entry.state & STATE_ONESHOT and\
-                  not entry.state & STATE_DONE:
-                    entry.cron = '* * * * * * *'
-                    sjob.append(self.scheduler_real.add_cron_job(doProcess,
-                                             **self.__cronToAPMap(entry.cron)))
-
-    def __process(self, entry):
+                if expired:
+                    self.__expire(job, due)
+                else:
+                    self.__fire(job, due)
+            except Exception:
+                logging.exception("Catch-up of entry %s failed" %
+                                  job.entry.id)
+
+    def __unschedule(self, job):
+        if job.handle == None:
+            return
+        try:
+            self.scheduler_real.unschedule_job(job.handle)
+        except KeyError:
+            # apscheduler automatically unshecules one-shot cron jobs, so
+            # unshedule_job will fail in this case and raise KeyError
+            pass
+
+    def __process(self, entry, due=None):
         if entry.handler in self.handlers:
-            self.handlers[entry.handler](**self.__argsToMap(entry.args))
-
-    def __argsToMap(self, args):
-        theMap = {}
-        for arg in args.values():
-            if len(arg.name) < 1 or arg.name[0] == ':':
-                break
-            theMap[arg.name] = arg.value
-        return theMap
-
-    def __cronToAPMap(self, cron):
-        theMap = {}
-        split = str(cron).split(" ")
-        theMap['second'] = split[0]
-        theMap['minute'] = split[1]
-        theMap['hour'] = split[2]
-        theMap['day'] = split[3]
-        theMap['month'] = split[4]
-        theMap['year'] = split[5]
-        theMap['day_of_week'] = split[6]
-        return theMap
+            processing.entryId = entry.id
+            processing.due = due
+            started = time.perf_counter()
+            try:
+                self.handlers[entry.handler](**argsToMap(entry.args))
+            except:
+                HANDLER_ERRORS.labels(entry.handler).inc()
+                raise
+            finally:
+                processing.entryId = None
+                processing.due = None
+                HANDLER_SECONDS.labels(entry.handler).observe(
+                    time.perf_counter() - started)
 
     def started(self):
         return self.scheduler_real.running
 
 
+def entryFingerprint(entry):
+    '''Gets a value, that changes whenever a change of the entry requires
+       its job to be rescheduled'''
+    args = []
+    for arg in entry.args.values():
+        value = arg.value
+        if isinstance(value, (list, dict)):
+            value = repr(value)
+        args.append((arg.name, value))
+    args.sort()
+    # a digest rather than the args themselves, so that jobs stay small
+    return (entry.cron, entry.handler, entry.state,
+            digest(repr(tuple(args)).encode('utf-8')))
+
+
+def nextFireOf(cron, state, after=None):
+    '''Gets the time an entry is due at, as it is kept in the config: the
+       next fire time, or the time of a missed one-shot, that was not done,
+       so that it is caught up
+       :param after: datetime to start from, defaults to now
+       :rtype: timestamp or None, if the entry is never fired again'''
+    state = state or 0
+    if state & STATE_DONE:
+        return None
+    try:
+        cron = Cron.compile(cron)
+    except ValueError:
+        return None
+    fire = cron.nextFireAfter(after or datetime.datetime.now())
+    if fire == None and state & STATE_ONESHOT:
+        fire = cron.firstFire()
+    return fire and fire.timestamp()
+
+
+def currentEntryId():
+    '''Gets id of the entry, that is being processed by this thread, e.g.
+       to tell which entry a message comes from
+       :rtype: id or None, if no entry is processed'''
+    return getattr(processing, 'entryId', None)
+
+
+def currentDue():
+    '''Gets the scheduled fire time of the entry, that is being processed
+       by this thread, so that fires of a recurring entry are told apart
+       :rtype: timestamp or None, if no entry is processed'''
+    return getattr(processing, 'due', None)
+
+
+def makeId(source):
+    '''Gets a compact fixed size id of an entry
+       :param source: bytes, that identify the entry'''
+    return digest(source)
+
+
+def digest(data):
+    '''Gets a DIGEST_SIZE bytes long digest of bytes'''
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def argsToMap(args):
+    '''Gets keyword arguments of a handler from entry args'''
+    theMap = {}
+    for arg in args.values():
+        if len(arg.name) < 1 or arg.name[0] == ':':
+            continue
+        theMap[arg.name] = arg.value
+    return theMap
+
+
 class Entry(object):
+    __slots__ = ('id', 'cron', 'state', 'name', 'handler', 'status',
+                 '__args', '__loader')
+
     def __init__(self, id=None,
                  cron="*/15 * * * * * *",
                  state=0,
                  name="",
                  handler="",
                  status="",
-                 args=None):
+                 args=None,
+                 loader=None):
+        '''
+           :param loader: function, that loads args by entry id, args are
+                          loaded by it on the first access if not given'''
         self.id = id
         self.cron = cron
         self.state = state
@@ -134,22 +684,53 @@ class Entry(object):
         # can't set default args to {}, because that would create static list,
         # that would be shared between Entry objects and thus would contain
         # incorrect info
-        if args == None:
-            self.args = {}  # a small hack (see above)
-        else:
-            self.args = args
+        if args == None and loader == None:
+            args = {}  # a small hack (see above)
+        self.__args = args
+        self.__loader = loader
+
+    @property
+    def args(self):
+        '''Map of arg names to Arg'''
+        if self.__args == None:
+            self.__args = self.__loader(self.id)
+        return self.__args
+
+    @args.setter
+    def args(self, args):
+        self.__args = args
 
     def arg(self, *args, **kwargs):
-        arg = Arg(self, *args, **kwargs)
+        arg = Arg(None, *args, **kwargs)
         self.args[arg.name] = arg
 
+    def dropArgs(self):
+        '''Frees memory taken by args, if they can be loaded again
+           :rtype: whether the args were dropped'''
+        if self.__loader == None:
+            return False
+        self.__args = None
+        return True
+
+
+class Job(object):
+    '''Scheduled entry along with its backend job'''
+    __slots__ = ('entry', 'fingerprint', 'handle', 'due')
+
+    def __init__(self, entry, fingerprint, handle=None):
+        self.entry = entry
+        self.fingerprint = fingerprint
+        self.handle = handle
+        self.due = None  # timestamp of the next fire, if known
+
 
 class Arg(object):
-    source = None
-    name = None
-    value = None
+    __slots__ = ('name', 'value')
 
     def __init__(self, source=None, name="in", value=""):
-        self.source = source
+        '''
+           :param source: ignored, args used to refer to their entry, it is
+                          kept for callers, that pass name and value by
+                          position'''
         self.name = name
-        self.value = value
\ No newline at end of file
+        self.value = value
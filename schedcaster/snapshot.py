@@ -0,0 +1,154 @@
+"""
+Compact binary snapshot of a compiled schedule: ids of scheduled entries,
+their next fire times and indices of their crons and handlers, along with
+the change counter of the config, it was taken at. A scheduler writes it on
+stop and loads it on start instead of querying the config, as long as the
+config was not changed meanwhile, see Config.changeCounter.
+
+Layout of the file, all numbers are little-endian:
+
+    header   magic, version, change counter, creation time, horizon,
+             number of strings, number of entries
+    strings  crons and handlers, each one as uint16 length and utf-8 bytes
+    entries  per entry: uint32 cron index, uint32 handler index, int32
+             state, float64 next fire (NaN if unknown), digest of args
+    ids      kinds of ids (a byte per entry), uint16 lengths of ids, bytes
+             of all ids one after another
+"""
+
+import array
+import math
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'SCSNAP'
+VERSION = 1
+
+__header = struct.Struct('<6sHqddII')
+__entry = struct.Struct('<IIid16s')
+__length = struct.Struct('<H')
+
+# kinds of ids, they are stored as bytes
+__KIND_BYTES = b'b'[0]
+__KIND_STR = b's'[0]
+__KIND_INT = b'i'[0]
+
+
+class Snapshot(object):
+    def __init__(self, counter, horizon=math.inf, entries=None, created=None):
+        '''
+           :param counter: change counter of the config, the entries were
+                           loaded at
+           :param horizon: timestamp, all entries due before which are
+                           included, inf if all active entries are
+           :param entries: list of (id, cron, handler, state, next fire
+                           timestamp or None, digest of args)
+           :param created: timestamp, defaults to now'''
+        self.counter = counter
+        self.horizon = horizon
+        self.entries = entries or []
+        self.created = created or time.time()
+
+
+def save(filename, snapshot):
+    '''Writes a snapshot to a file, replacing it at once, so that a crash
+       never leaves a half-written one'''
+    strings = {}  # string => index
+    records = []
+    kinds = bytearray()
+    lengths = array.array('H')
+    ids = []
+    for id, cron, handler, state, nextFire, argsDigest in snapshot.entries:
+        kind, id = __encodeId(id)
+        kinds.append(kind)
+        lengths.append(len(id))
+        ids.append(id)
+        records.append(__entry.pack(
+            strings.setdefault(cron, len(strings)),
+            strings.setdefault(handler or "", len(strings)),
+            state, math.nan if nextFire == None else nextFire,
+            argsDigest))
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+
+    chunks = [__header.pack(MAGIC, VERSION, snapshot.counter,
+                            snapshot.created, snapshot.horizon,
+                            len(strings), len(records))]
+    for string in strings:
+        data = string.encode('utf-8')
+        chunks.append(__length.pack(len(data)))
+        chunks.append(data)
+    chunks.extend(records)
+    chunks.extend((bytes(kinds), lengths.tobytes()))
+    chunks.extend(ids)
+
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(b''.join(chunks))
+    os.replace(temporary, filename)
+
+
+def load(filename):
+    '''Reads a snapshot written by save
+       :rtype: Snapshot'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    try:
+        magic, version, counter, created, horizon, nStrings, nEntries = \
+            __header.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError("not a schedule snapshot of version %d: %s" %
+                               (VERSION, filename))
+        offset = __header.size
+        strings = []
+        for i in range(nStrings):
+            length, = __length.unpack_from(data, offset)
+            offset += __length.size
+            strings.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+
+        end = offset + __entry.size * nEntries
+        records = __entry.iter_unpack(data[offset:end])
+        kinds = data[end:end + nEntries]
+        offset = end + nEntries
+        lengths = array.array('H', data[offset:offset + 2 * nEntries])
+        if sys.byteorder != 'little':
+            lengths.byteswap()
+        offset += 2 * nEntries
+
+        entries = []
+        for (cron, handler, state, nextFire, argsDigest), kind, length in \
+                zip(records, kinds, lengths):
+            id = data[offset:offset + length]
+            offset += length
+            if kind != __KIND_BYTES:
+                id = __decodeId(kind, id)
+            entries.append((id, strings[cron], strings[handler], state,
+                            None if math.isnan(nextFire) else nextFire,
+                            argsDigest))
+    except (struct.error, IndexError, UnicodeDecodeError, ValueError) as e:
+        raise RuntimeError("broken schedule snapshot %s: %s" % (filename, e))
+    if len(entries) != nEntries or offset != len(data):
+        raise RuntimeError("broken schedule snapshot %s: wrong size" %
+                           filename)
+    return Snapshot(counter, horizon, entries, created)
+
+
+def __encodeId(id):
+    if isinstance(id, bytes):
+        return __KIND_BYTES, id
+    if isinstance(id, str):
+        return __KIND_STR, id.encode('utf-8')
+    if isinstance(id, int):
+        return __KIND_INT, str(id).encode('ascii')
+    raise RuntimeError("can't snapshot entry id of type %s" % type(id))
+
+
+def __decodeId(kind, id):
+    if kind == __KIND_STR:
+        return id.decode('utf-8')
+    if kind == __KIND_INT:
+        return int(id)
+    raise ValueError("unknown kind of id: %r" % kind)
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from schedcaster.caster.asynccaster import AsyncCaster
+from schedcaster.caster.multicaster import Caster
+from schedcaster.caster.outbox import Outbox
+from schedcaster.caster.ratelimit import RateLimiter
+from tests.test_outbox import Recorder
+
+
+class Blocker(object):
+    '''Consumer, that waits for an event before each call returns'''
+    def __init__(self):
+        self.event = threading.Event()
+        self.calls = []
+
+    def consume(self, post):
+        self.calls.append(post)
+        self.event.wait(5)
+        return post
+
+
+class QueueLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.casters = []
+
+    def tearDown(self):
+        for caster in self.casters:
+            caster.stop(wait=False)
+        shutil.rmtree(self.directory)
+
+    def caster(self, **kwargs):
+        caster = Caster(maxThreads=1, **kwargs)
+        self.casters.append(caster)
+        return caster
+
+    def busy(self, caster, consumer, **kwargs):
+        '''Sends a job and waits until the only worker runs it'''
+        caster.send(None, "busy", **kwargs)
+        deadline = time.time() + 5
+        while not consumer.calls and time.time() < deadline:
+            time.sleep(0.01)
+
+    def testFullQueueRejects(self):
+        caster = self.caster(maxQueue=1, timeout=0)
+        consumer = Blocker()
+        caster.attach(consumer)
+        self.busy(caster, consumer)
+        caster.send(None, "queued")
+        self.assertRaises(queue.Full, caster.send, None, "rejected")
+        consumer.event.set()
+
+    def testFullQueueTimesOut(self):
+        caster = self.caster(maxQueue=1, timeout=0.2)
+        consumer = Blocker()
+        caster.attach(consumer)
+        self.busy(caster, consumer)
+        caster.send(None, "queued")
+        started = time.time()
+        self.assertRaises(queue.Full, caster.send, None, "rejected")
+        self.assertTrue(time.time() - started >= 0.2)
+        consumer.event.set()
+
+    def testFullQueueBlocksUntilRoom(self):
+        caster = self.caster(maxQueue=1, timeout=5)
+        consumer = Blocker()
+        caster.attach(consumer)
+        self.busy(caster, consumer)
+        caster.send(None, "queued")
+        threading.Timer(0.2, consumer.event.set).start()
+        started = time.time()
+        caster.send(None, "blocked").wait(5)
+        self.assertTrue(time.time() - started >= 0.2)
+        self.assertEqual(consumer.calls, ["busy", "queued", "blocked"])
+
+    def testOutboxIsBounded(self):
+        outbox = Outbox(os.path.join(self.directory, 'outbox.db'))
+        caster = self.caster(maxQueue=1, timeout=0, outbox=outbox)
+        consumer = Blocker()
+        caster.attach(consumer, key='blocker')
+        self.busy(caster, consumer, entryId=b'busy')
+        caster.send(None, "queued", entryId=b'queued')
+        self.assertRaises(queue.Full, caster.send, None, "rejected",
+                          entryId=b'rejected')
+        consumer.event.set()
+        outbox.flush()
+
+    def testParkedJobsCountTowardsLimit(self):
+        caster = self.caster(maxQueue=2, timeout=0)
+        consumer = Recorder()
+        # the first call takes the only token, the rest are parked
+        caster.attach(consumer, limiter=RateLimiter(0.1))
+        caster.send(None, "first").wait(5)
+        caster.send(None, "second")
+        caster.send(None, "third")
+        # lets the worker park them
+        time.sleep(0.2)
+        self.assertEqual(caster.queueDepth(), 2)
+        self.assertRaises(queue.Full, caster.send, None, "fourth")
+        self.assertEqual(consumer.calls, ["first"])
+
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        self.caster = Caster(maxThreads=1)
+
+    def tearDown(self):
+        self.caster.stop(wait=False)
+
+    def testCancelledJobFreesLimiter(self):
+        consumer = Blocker()
+        limiter = RateLimiter(100)
+        self.caster.attach(consumer, limiter=limiter)
+        first = self.caster.send(None, "first")
+        second = self.caster.send(None, "second")
+        self.assertEqual(second.cancel(), 1)
+        consumer.event.set()
+        first.wait(5)
+        third = self.caster.send(None, "third")
+        done, notDone = third.wait(5)
+        self.assertFalse(notDone)
+        done, notDone = second.wait(5)
+        self.assertFalse(notDone)
+        self.assertEqual(consumer.calls, ["first", "third"])
+        self.assertEqual(self.caster.queueDepth(), 0)
+        self.assertEqual(limiter.stats()['inFlight'], 0)
+
+
+class Sleeper(object):
+    '''Consumer, that is awaited on the loop and hangs on a given post'''
+    def __init__(self):
+        self.calls = []
+
+    async def consume(self, post):
+        self.calls.append(post)
+        if post == "hang":
+            await asyncio.sleep(60)
+        return post
+
+
+class AsyncCancelTest(unittest.TestCase):
+    def testCancelledTaskFreesLimiter(self):
+        consumer = Sleeper()
+        limiter = RateLimiter(100)
+
+        async def run():
+            caster = AsyncCaster()
+            caster.attach(consumer, limiter=limiter)
+            task, = caster.send(None, "hang")
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            task, = caster.send(None, "next")
+            return await asyncio.wait_for(task, 5)
+        self.assertEqual(asyncio.run(run()), "next")
+        self.assertEqual(consumer.calls, ["hang", "next"])
+        self.assertEqual(limiter.stats()['inFlight'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import datetime
+import threading
+import time
+import unittest
+
+import schedcaster.scheduler as Scheduler
+from schedcaster.catchup import CatchUpQueue, STATUS_EXPIRED
+from schedcaster.scheduler import Entry, STATE_DONE, STATE_ONESHOT
+from tests.test_config import ConfigTest
+
+
+class CatchUpQueueTest(unittest.TestCase):
+    def testOldestFirst(self):
+        queue = CatchUpQueue(rate=1000, burst=10)
+        now = time.time()
+        for name, due in (('second', now - 20), ('third', now - 10),
+                          ('first', now - 30)):
+            queue.put(name, due)
+        self.assertEqual([queue.pop(now)[0] for i in range(3)],
+                         ['first', 'second', 'third'])
+        self.assertEqual(queue.pop(now), None)
+        self.assertEqual(queue.wait(now), None)
+
+    def testSameDueKeepsOrderOfPut(self):
+        queue = CatchUpQueue(rate=1000, burst=10)
+        now = time.time()
+        for name in ('a', 'b', 'c'):
+            queue.put(name, now - 5)
+        self.assertEqual([queue.pop(now)[0] for i in range(3)],
+                         ['a', 'b', 'c'])
+
+    def testRate(self):
+        queue = CatchUpQueue(rate=2, burst=2)
+        now = time.time()
+        for i in range(5):
+            queue.put(i, now - 10 + i)
+        # the burst is released at once, the rest at the rate
+        self.assertEqual([queue.pop(now)[0] for i in range(2)], [0, 1])
+        self.assertEqual(queue.pop(now), None)
+        self.assertAlmostEqual(queue.wait(now), 0.5, 3)
+        self.assertEqual(queue.pop(now + 0.25), None)
+        self.assertEqual(queue.pop(now + 0.5)[0], 2)
+        self.assertEqual(queue.pop(now + 0.5), None)
+        self.assertEqual(queue.pop(now + 1.0)[0], 3)
+        self.assertEqual(queue.pop(now + 1.5)[0], 4)
+        self.assertEqual(len(queue), 0)
+
+    def testExpiredAreTakenRegardlessOfRate(self):
+        queue = CatchUpQueue(rate=1, burst=1, graceTime=60)
+        now = time.time()
+        queue.put('fresh', now - 30)
+        queue.put('stale', now - 120)
+        queue.put('older', now - 180)
+        queue.put('late', now - 50)
+        self.assertEqual(queue.pop(now), ('older', now - 180, True))
+        self.assertEqual(queue.pop(now), ('stale', now - 120, True))
+        self.assertEqual(queue.pop(now), ('late', now - 50, False))
+        # the token is spent, until it is back only expired jobs are taken
+        self.assertEqual(queue.pop(now), None)
+        self.assertEqual(queue.wait(now + 0.5), 0.5)
+        self.assertEqual(queue.wait(now + 31), 0)
+        self.assertEqual(queue.pop(now + 31), ('fresh', now - 30, True))
+
+    def testNoGraceTimeNeverExpires(self):
+        queue = CatchUpQueue(rate=1000, burst=1)
+        now = time.time()
+        queue.put('ancient', now - 10 ** 6)
+        self.assertEqual(queue.pop(now), ('ancient', now - 10 ** 6, False))
+
+    def testStats(self):
+        queue = CatchUpQueue(rate=2, burst=1, graceTime=60)
+        now = time.time()
+        self.assertEqual(queue.stats(now), {'backlog': 0, 'eta': 0.0,
+                                            'oldest': 0.0, 'released': 0,
+                                            'expired': 0})
+        for due in (now - 100, now - 10, now - 5, now - 1):
+            queue.put(due, due)
+        queue.pop(now)
+        queue.pop(now)
+        stats = queue.stats(now)
+        self.assertAlmostEqual(stats.pop('oldest'), 5)
+        self.assertEqual(stats, {'backlog': 2, 'eta': 1.0, 'released': 1,
+                                 'expired': 1})
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.pop(now + 10), None)
+
+
+class Calls(object):
+    '''Handler, that remembers its calls'''
+    def __init__(self):
+        self.calls = []  # (name, time of the call)
+        self.condition = threading.Condition()
+
+    def __call__(self, name):
+        with self.condition:
+            self.calls.append((name, time.time()))
+            self.condition.notify_all()
+
+    def waitFor(self, n, timeout=5):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.calls) >= n, timeout)
+            return list(self.calls)
+
+
+class SchedulerCatchUpTest(ConfigTest):
+    def oneShot(self, name, secondsAgo):
+        due = datetime.datetime.now() - datetime.timedelta(seconds=secondsAgo)
+        entry = Entry(id=name.encode('utf-8'), cron=due.strftime(
+            '%S %M %H %d %m %Y *'), state=STATE_ONESHOT, handler='call')
+        entry.arg('name', name)
+        return entry
+
+    def scheduler(self, config, **kwargs):
+        scheduler = Scheduler.Scheduler(config,
+                                        backend=Scheduler.BACKEND_HEAP,
+                                        **kwargs)
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def testMissedOneShotsAreFiredOldestFirstAtRate(self):
+        config = self.config()
+        config.saveMany([self.oneShot('second', 20),
+                         self.oneShot('third', 10),
+                         self.oneShot('first', 30)])
+        calls = Calls()
+        scheduler = self.scheduler(config, catchUpRate=4, catchUpBurst=1)
+        scheduler.addHandler('call', calls)
+        scheduler.start()
+        fired = calls.waitFor(3)
+        self.assertEqual([name for name, at in fired],
+                         ['first', 'second', 'third'])
+        # the first one takes the only token, the rest wait for theirs
+        self.assertGreaterEqual(fired[2][1] - fired[0][1], 0.4)
+        scheduler.stop()
+        self.assertEqual([entry.state & STATE_DONE for entry in config.get()],
+                         [STATE_DONE] * 3)
+
+    def testOneShotsMissedPastGraceExpire(self):
+        config = self.config()
+        config.saveMany([self.oneShot('missed', 120),
+                         self.oneShot('caught', 5)])
+        calls = Calls()
+        scheduler = self.scheduler(config, grace_time=60, catchUpRate=100)
+        scheduler.addHandler('call', calls)
+        scheduler.start()
+        self.assertEqual([name for name, at in calls.waitFor(2, 1)],
+                         ['caught'])
+        scheduler.stop()
+        entries = dict((entry.id, entry) for entry in config.get())
+        self.assertEqual(entries[b'missed'].status, STATUS_EXPIRED)
+        self.assertTrue(entries[b'missed'].state & STATE_DONE)
+        self.assertNotEqual(entries[b'caught'].status, STATUS_EXPIRED)
+        self.assertEqual(scheduler.catchUpStats()['expired'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import schedcaster.scheduler as Scheduler
+from schedcaster.config.pool import ConnectionPool
+from schedcaster.config.sqlite import Config
+from schedcaster.scheduler import Entry, STATE_DONE, STATE_ONESHOT
+
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'config.db')
+        self.configs = []
+
+    def tearDown(self):
+        for config in self.configs:
+            config.close()
+        shutil.rmtree(self.directory)
+
+    def config(self, **kwargs):
+        config = Config(self.filename, **kwargs)
+        self.configs.append(config)
+        return config
+
+    def nextFire(self, id):
+        connection = sqlite3.connect(self.filename)
+        try:
+            return connection.execute("""select next_fire from tbl_sched
+                where id = ?""", (id,)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def changes(self):
+        connection = sqlite3.connect(self.filename)
+        try:
+            return connection.execute("""select count(*) from tbl_changes""")\
+                .fetchone()[0]
+        finally:
+            connection.close()
+
+
+class CacheTest(ConfigTest):
+    def testGetNoIds(self):
+        config = self.config(cacheSize=10)
+        config.save(Entry(id=b'entry', cron='0 0 0 1 1 * *', handler='post'))
+        self.assertEqual(config.get([]), [])
+        self.assertEqual(config.get(()), [])
+
+    def testGetSeesChangesOfOthers(self):
+        config = self.config(cacheSize=10)
+        config.save(Entry(id=b'entry', cron='0 0 0 1 1 * *', handler='post'))
+        self.assertEqual(config.get(b'entry')[0].handler, 'post')
+        self.config().updateMany([(b'entry', {'handler': 'other'})])
+        self.assertEqual(config.get(b'entry')[0].handler, 'other')
+
+
+class SaveManyTest(ConfigTest):
+    def entry(self, id, cron='0 0 0 1 1 * *', **args):
+        entry = Entry(id=id, cron=cron, handler='post')
+        for name, value in args.items():
+            entry.arg(name, value)
+        return entry
+
+    def counts(self, stats):
+        return stats.inserted, stats.updated, stats.unchanged
+
+    def argRows(self, id):
+        connection = sqlite3.connect(self.filename)
+        try:
+            return dict(connection.execute("""select name, value
+                from tbl_sched_args where source_id = ?""", (id,)))
+        finally:
+            connection.close()
+
+    def testCounts(self):
+        config = self.config()
+        entries = [self.entry(b'a', post='a'), self.entry(b'b', post='b'),
+                   self.entry(b'c', post='c')]
+        self.assertEqual(self.counts(config.saveMany(entries)), (3, 0, 0))
+        self.assertEqual(self.counts(config.saveMany(entries)), (0, 0, 3))
+        changed = [self.entry(b'a', '0 0 0 2 1 * *', post='a'),
+                   self.entry(b'b', post='changed'),
+                   self.entry(b'c', post='c'),
+                   self.entry(b'd', post='d')]
+        self.assertEqual(self.counts(config.saveMany(changed)), (1, 2, 1))
+        self.assertEqual(config.getArgs(b'b')['post'].value, 'changed')
+        # the last one of the same id wins, the rest are unchanged
+        self.assertEqual(self.counts(config.saveMany(
+            [self.entry(b'e', post='1'), self.entry(b'e', post='2')])),
+            (1, 0, 1))
+        self.assertEqual(config.getArgs(b'e')['post'].value, '2')
+
+    def testNonTextArgsAreUnchanged(self):
+        config = self.config()
+        entry = self.entry(b'a', flag=True, off=False, count=3, ratio=0.1,
+                           big=1e20, third=1 / 3, raw=b'\x00blob', text='1')
+        self.assertEqual(self.counts(config.saveMany([entry])), (1, 0, 0))
+        self.assertEqual(self.counts(config.saveMany([entry])), (0, 0, 1))
+        self.assertEqual(self.argRows(b'a')['flag'], '1')
+        self.assertEqual(self.argRows(b'a')['big'], '1.0e+20')
+        self.assertEqual(self.counts(config.saveMany(
+            [self.entry(b'a', flag=False)])), (0, 1, 0))
+        self.assertEqual(self.argRows(b'a')['flag'], '0')
+
+    def testArrayArgs(self):
+        config = self.config()
+        config.saveMany([self.entry(b'a', tags=['x', 'y', 'z'])])
+        self.assertEqual(config.getArgs(b'a')['tags'].value, ['x', 'y', 'z'])
+        self.assertEqual(self.counts(config.saveMany(
+            [self.entry(b'a', tags=['x', 'y', 'z'])])), (0, 0, 1))
+        self.assertEqual(self.counts(config.saveMany(
+            [self.entry(b'a', tags=['x', 'changed', 'z'])])), (0, 1, 0))
+        self.assertEqual(config.getArgs(b'a')['tags'].value,
+                         ['x', 'changed', 'z'])
+        self.assertEqual(self.counts(config.saveMany(
+            [self.entry(b'a', tags={'first': 'x'})])), (0, 1, 0))
+        self.assertEqual(self.argRows(b'a')['tags:first'], 'x')
+
+
+class UpdateManyTest(ConfigTest):
+    def testDoneStateClearsNextFire(self):
+        config = self.config()
+        config.save(Entry(id=b'entry', cron='* * * * * * *'))
+        self.assertNotEqual(self.nextFire(b'entry'), None)
+        config.updateMany([(b'entry', {'state': STATE_DONE})])
+        self.assertEqual(self.nextFire(b'entry'), None)
+
+    def testStateWithoutCronMakesEntryDue(self):
+        config = self.config()
+        config.save(Entry(id=b'entry', cron='0 0 0 1 1 * 2000',
+                          state=STATE_DONE | STATE_ONESHOT))
+        self.assertEqual(self.nextFire(b'entry'), None)
+        config.updateMany([(b'entry', {'state': STATE_ONESHOT})])
+        self.assertEqual(self.nextFire(b'entry'), 0)
+        self.assertEqual([entry.id for entry in config.iterateDue(0)],
+                         [b'entry'])
+
+    def testCronAndStateGiveNextFire(self):
+        config = self.config()
+        config.save(Entry(id=b'entry', cron='0 0 0 1 1 * *'))
+        config.updateMany([(b'entry', {'cron': '0 0 0 2 1 * *',
+                                       'state': STATE_ONESHOT})])
+        nextFire = Scheduler.nextFireOf('0 0 0 2 1 * *', STATE_ONESHOT)
+        self.assertNotEqual(nextFire, None)
+        self.assertEqual(self.nextFire(b'entry'), nextFire)
+
+
+class ChangeLogTest(ConfigTest):
+    def testReaderPrunesLog(self):
+        self.config().save(Entry(id=b'entry', cron='0 0 0 1 1 * *'))
+        self.assertEqual(self.changes(), 1)
+        # everything is older than a negative retention
+        self.config(changeRetention=-1).changesSince()
+        self.assertEqual(self.changes(), 0)
+
+    def testUntrackedUpdatePrunesLog(self):
+        self.config().save(Entry(id=b'entry', cron='0 0 0 1 1 * *'))
+        self.config(changeRetention=-1).updateMany(
+            [(b'entry', {'status': 'fired'})], track=False)
+        self.assertEqual(self.changes(), 0)
+
+
+
+class PoolTest(ConfigTest):
+    def pool(self, **kwargs):
+        pool = ConnectionPool(self.filename, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def inThread(self, fn, *args):
+        '''Runs fn in a new thread and waits for it
+           :rtype: what fn returned'''
+        result = []
+        thread = threading.Thread(target=lambda: result.append(fn(*args)))
+        thread.start()
+        thread.join(10)
+        return result[0]
+
+    def testNestedCheckout(self):
+        pool = self.pool(maxSize=1, timeout=0)
+        outer = pool.checkout()
+        inner = pool.checkout()
+        self.assertTrue(inner is outer)
+        pool.checkin(inner)
+        self.assertEqual(pool.stats()['inUse'], 1)
+        pool.checkin(outer)
+        self.assertEqual(pool.stats()['inUse'], 0)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def testWaitsForConnection(self):
+        pool = self.pool(maxSize=1)
+        connection = pool.checkout()
+        timer = threading.Timer(0.2, pool.checkin, (connection,))
+        timer.start()
+        started = time.time()
+        got = self.inThread(lambda: (pool.checkout(), time.time()))
+        self.assertTrue(got[0] is connection)
+        self.assertTrue(got[1] - started >= 0.2)
+        self.assertEqual(pool.stats()['waits'], 1)
+
+    def testTimesOut(self):
+        pool = self.pool(maxSize=1, timeout=0.2)
+        pool.checkout()
+
+        def checkout():
+            started = time.time()
+            try:
+                pool.checkout()
+            except RuntimeError:
+                return time.time() - started
+        waited = self.inThread(checkout)
+        self.assertTrue(waited != None and waited >= 0.2, waited)
+
+    def testReapsLeasesOfDeadThreads(self):
+        pool = self.pool(maxSize=1, timeout=5)
+        leaked = self.inThread(pool.checkout)
+        self.assertTrue(pool.checkout() is leaked)
+        self.assertEqual(pool.stats()['reaped'], 1)
+
+    def testCheckinFromForeignThread(self):
+        pool = self.pool(maxSize=1, timeout=0)
+        connection = self.inThread(pool.checkout)
+        pool.checkin(connection)
+        self.assertEqual(pool.stats()['inUse'], 0)
+        self.assertEqual(pool.stats()['reaped'], 0)
+        # a second checkin of the same connection is ignored
+        pool.checkin(connection)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def testAbandonedIterateIsClosedByAnotherThread(self):
+        config = self.config(poolSize=1)
+        config.saveMany([Entry(id=i, cron='0 0 0 1 1 * *') for i in range(3)])
+        entries = config.iterate()
+        self.assertEqual(next(entries).id, 0)
+        self.assertEqual(config.poolStats()['inUse'], 1)
+        self.inThread(entries.close)
+        self.assertEqual(config.poolStats()['inUse'], 0)
+        self.assertEqual(len(config.get()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import datetime
+import itertools
+import unittest
+
+from schedcaster import cron as Cron
+
+
+def at(*args):
+    return datetime.datetime(*args)
+
+
+class CronTest(unittest.TestCase):
+    def assertFires(self, cron, after, expected):
+        '''Checks the next fire times of a cron after a datetime'''
+        self.assertEqual(Cron.compile(cron).nextFires(after, len(expected)),
+                         expected)
+
+    def testEverySecond(self):
+        self.assertFires('* * * * * * *', at(2024, 1, 1, 0, 0, 0, 500),
+                         [at(2024, 1, 1, 0, 0, 1), at(2024, 1, 1, 0, 0, 2)])
+
+    def testFireIsStrictlyLater(self):
+        self.assertFires('0 0 12 * * * *', at(2024, 1, 1, 12),
+                         [at(2024, 1, 2, 12)])
+
+    def testSteps(self):
+        self.assertFires('*/20 * * * * * *', at(2024, 1, 1, 0, 0, 5),
+                         [at(2024, 1, 1, 0, 0, 20), at(2024, 1, 1, 0, 0, 40),
+                          at(2024, 1, 1, 0, 1, 0)])
+        # a step from a single value runs up to the end of the range
+        self.assertFires('0 50/5 * * * * *', at(2024, 1, 1, 0, 52),
+                         [at(2024, 1, 1, 0, 55), at(2024, 1, 1, 1, 50)])
+
+    def testRangesAndLists(self):
+        self.assertFires('0 0 9-10,14 * * * *', at(2024, 1, 1, 9, 30),
+                         [at(2024, 1, 1, 10), at(2024, 1, 1, 14),
+                          at(2024, 1, 2, 9)])
+        self.assertFires('0 0 0 1-10/3 * * *', at(2024, 1, 1),
+                         [at(2024, 1, 4), at(2024, 1, 7), at(2024, 1, 10),
+                          at(2024, 2, 1)])
+
+    def testNames(self):
+        # 2024-01-01 is a monday
+        self.assertFires('0 0 0 * * * sat,sun', at(2024, 1, 1),
+                         [at(2024, 1, 6), at(2024, 1, 7), at(2024, 1, 13)])
+        self.assertFires('0 0 0 * * * tue-thu', at(2024, 1, 1),
+                         [at(2024, 1, 2), at(2024, 1, 3), at(2024, 1, 4),
+                          at(2024, 1, 9)])
+        self.assertEqual(Cron.compile('0 0 0 * * * 5').nextFireAfter(
+            at(2024, 1, 1)), at(2024, 1, 6))
+        self.assertFires('0 0 0 1 feb,DEC * *', at(2024, 1, 1),
+                         [at(2024, 2, 1), at(2024, 12, 1), at(2025, 2, 1)])
+
+    def testDayAndWeekdayMustBothMatch(self):
+        # fridays, that are the 13th
+        self.assertFires('0 0 0 13 * * fri', at(2024, 1, 1),
+                         [at(2024, 9, 13), at(2024, 12, 13)])
+
+    def testLastDay(self):
+        self.assertFires('0 0 0 last * * *', at(2024, 1, 31),
+                         [at(2024, 2, 29), at(2024, 3, 31), at(2024, 4, 30)])
+        self.assertFires('0 0 0 1,last * * *', at(2023, 2, 1),
+                         [at(2023, 2, 28), at(2023, 3, 1)])
+
+    def testMonthsWithoutTheDayAreSkipped(self):
+        self.assertFires('0 0 0 31 * * *', at(2024, 1, 31),
+                         [at(2024, 3, 31), at(2024, 5, 31), at(2024, 7, 31),
+                          at(2024, 8, 31)])
+        self.assertFires('0 0 0 29 2 * *', at(2021, 1, 1),
+                         [at(2024, 2, 29), at(2028, 2, 29)])
+        self.assertFires('0 0 0 30 2 * *', at(2024, 1, 1), [])
+
+    def testYear(self):
+        self.assertFires('0 0 0 1 1 2030 *', at(2024, 1, 1),
+                         [at(2030, 1, 1)])
+        self.assertFires('0 0 0 1 1 2030-2032 *', at(2030, 1, 1),
+                         [at(2031, 1, 1), at(2032, 1, 1)])
+        self.assertEqual(Cron.compile('0 0 0 1 1 2000 *').nextFireAfter(
+            at(2024, 1, 1)), None)
+
+    def testFirstFire(self):
+        self.assertEqual(Cron.compile('30 15 10 5 6 2000 *').firstFire(),
+                         at(2000, 6, 5, 10, 15, 30))
+        self.assertEqual(Cron.compile('0 0 0 1 1 * *').firstFire(),
+                         at(Cron.MIN_YEAR, 1, 1))
+        self.assertEqual(Cron.compile('0 0 0 30 2 * *').firstFire(), None)
+
+    def testNextFiresStopsAtTheLast(self):
+        self.assertFires('0 0 0 1 1 2030-2031 *', at(2024, 1, 1),
+                         [at(2030, 1, 1), at(2031, 1, 1)])
+        self.assertEqual(len(Cron.compile('0 0 0 1 1 2030-2031 *').nextFires(
+            at(2024, 1, 1), 5)), 2)
+
+    def testMatchesBruteForce(self):
+        # every minute of three months, including the end of february
+        start = at(2024, 1, 15)
+        minutes = [start + datetime.timedelta(minutes=i)
+                   for i in range(60 * 24 * 90)]
+        for cron, matches in (
+                ('0 */7 1-3 * * * *', lambda t: t.minute % 7 == 0 and
+                    1 <= t.hour <= 3),
+                ('0 0 12 last * * mon-fri', lambda t: t.hour == 12 and
+                    t.minute == 0 and t.weekday() < 5 and
+                    (t + datetime.timedelta(days=1)).day == 1),
+                ('0 15,45 */6 2-30/7 * * *', lambda t: t.minute in (15, 45)
+                    and t.hour % 6 == 0 and t.day in (2, 9, 16, 23, 30))):
+            expected = [t for t in minutes if matches(t)]
+            fires = list(itertools.takewhile(
+                lambda t: t <= minutes[-1],
+                Cron.compile(cron).nextFires(start - datetime.timedelta(
+                    seconds=1), len(expected) + 1)))
+            self.assertEqual(fires, expected, cron)
+
+    def testMalformed(self):
+        for cron in ('* * * * * *', '* * * * * * * *', '60 * * * * * *',
+                     '* * 24 * * * *', '* * * 0 * * *', '* * * * 13 * *',
+                     '* * * * * 1969 *', '* * * * * * 7', '*/0 * * * * * *',
+                     '5-3 * * * * * *', 'a * * * * * *', '* * * * * * funday',
+                     '* * * * jun-mon * *', '* * * last * * mon-last', ''):
+            self.assertRaises(ValueError, Cron.compile, cron)
+
+    def testCompiledAreShared(self):
+        self.assertTrue(Cron.compile('0 0 0 1 1 * *') is
+                        Cron.compile('0 0 0 1 1 * *'))
+
+    def testSplit(self):
+        self.assertEqual(Cron.split('1 2 3 4 5 2030 mon'),
+                         {'second': '1', 'minute': '2', 'hour': '3',
+                          'day': '4', 'month': '5', 'year': '2030',
+                          'day_of_week': 'mon'})
+
+
+if __name__ == '__main__':
+    unittest.main()
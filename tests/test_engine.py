@@ -0,0 +1,131 @@
+import concurrent.futures
+import datetime
+import threading
+import time
+import unittest
+
+from schedcaster.engine import HeapScheduler
+
+
+class Calls(object):
+    '''Function for jobs, that remembers its calls'''
+    def __init__(self):
+        self.calls = []
+        self.condition = threading.Condition()
+
+    def __call__(self, name):
+        with self.condition:
+            self.calls.append(name)
+            self.condition.notify_all()
+
+    def waitFor(self, n, timeout=5):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.calls) >= n, timeout)
+            return list(self.calls)
+
+
+class HeapSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = Calls()
+        self.schedulers = []
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler.shutdown()
+
+    def scheduler(self, **kwargs):
+        scheduler = HeapScheduler(**kwargs)
+        self.schedulers.append(scheduler)
+        return scheduler
+
+    def later(self, seconds):
+        return datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+    def testCancelledJobsAreCompacted(self):
+        scheduler = self.scheduler()
+        jobs = [scheduler.add_date_job(self.calls, self.later(3600),
+                                       args=(i,)) for i in range(10)]
+        for job in jobs[:5]:
+            scheduler.unschedule_job(job)
+        # as many cancelled jobs as scheduled ones are kept
+        self.assertEqual(scheduler._HeapScheduler__cancelled, 5)
+        self.assertEqual(len(scheduler._HeapScheduler__heap), 10)
+        scheduler.unschedule_job(jobs[5])
+        self.assertEqual(scheduler._HeapScheduler__cancelled, 0)
+        self.assertEqual(len(scheduler._HeapScheduler__heap), 4)
+        self.assertEqual(scheduler.get_jobs(), jobs[6:])
+        self.assertRaises(KeyError, scheduler.unschedule_job, jobs[0])
+
+    def testCancelledJobsArePoppedByDispatcher(self):
+        scheduler = self.scheduler()
+        cancelled = scheduler.add_date_job(self.calls, self.later(0.1),
+                                           args=('cancelled',))
+        scheduler.add_date_job(self.calls, self.later(0.2), args=('kept',))
+        scheduler.add_date_job(self.calls, self.later(3600), args=('late',))
+        scheduler.unschedule_job(cancelled)
+        scheduler.start()
+        self.assertEqual(self.calls.waitFor(1), ['kept'])
+        self.assertEqual(scheduler._HeapScheduler__cancelled, 0)
+        self.assertEqual(len(scheduler._HeapScheduler__heap), 1)
+
+    def testMissedRunsAreCoalesced(self):
+        scheduler = self.scheduler(misfire_grace_time=60)
+        job, = scheduler.addJobsAt([(self.calls, '* * * * * * *',
+                                     time.time() - 10)])
+        job.args = ('every second',)
+        scheduler.start()
+        self.assertEqual(self.calls.waitFor(1), ['every second'])
+        # ten missed runs are run once, the next one is in the future
+        self.assertTrue(job.nextFire > time.time() - 1)
+        time.sleep(0.5)
+        self.assertTrue(len(self.calls.calls) <= 2)
+
+    def testMisfireGrace(self):
+        scheduler = self.scheduler(misfire_grace_time=1)
+        missed, = scheduler.addJobsAt([(self.calls, '0 0 0 1 1 * *',
+                                        time.time() - 10)])
+        missed.args = ('missed',)
+        graced, = scheduler.addJobsAt([(self.calls, '0 0 0 1 1 * *',
+                                        time.time() - 0.5)])
+        graced.args = ('graced',)
+        scheduler.start()
+        self.assertEqual(self.calls.waitFor(2, 0.5), ['graced'])
+        # a missed job stays scheduled for its next fire
+        self.assertEqual(sorted(job.args for job in scheduler.get_jobs()),
+                         [('graced',), ('missed',)])
+
+    def testAddJobsAtKeepsOrder(self):
+        scheduler = self.scheduler(misfire_grace_time=60)
+        now = time.time()
+        jobs = scheduler.addJobsAt([(self.calls, '0 0 0 1 1 * *', now + i)
+                                    for i in (0.3, 0.1, 0.2)])
+        for job, name in zip(jobs, ('third', 'first', 'second')):
+            job.args = (name,)
+        self.assertEqual([job.nextFire for job in jobs],
+                         [now + 0.3, now + 0.1, now + 0.2])
+        scheduler.start()
+        self.assertEqual(self.calls.waitFor(3), ['first', 'second', 'third'])
+
+    def testSlowJobDoesNotDelayOthers(self):
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        scheduler = self.scheduler(executor=executor)
+        blocked = threading.Event()
+        scheduler.add_date_job(blocked.wait, self.later(0.1), args=(5,))
+        scheduler.add_date_job(self.calls, self.later(0.2), args=('quick',))
+        scheduler.start()
+        self.assertEqual(self.calls.waitFor(1, 2), ['quick'])
+        blocked.set()
+
+    def testJobLateForExecutorIsSkipped(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        scheduler = self.scheduler(misfire_grace_time=0.5, executor=executor)
+        blocked = threading.Event()
+        scheduler.add_date_job(blocked.wait, self.later(0.1), args=(1.5,))
+        scheduler.add_date_job(self.calls, self.later(0.2), args=('late',))
+        scheduler.start()
+        time.sleep(2)
+        self.assertEqual(self.calls.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
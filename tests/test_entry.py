@@ -0,0 +1,62 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from schedcaster.config.sqlite import Config
+from schedcaster.scheduler import Arg, Entry, makeId
+
+
+class ArgTest(unittest.TestCase):
+    def testPositionalSourceIsIgnored(self):
+        arg = Arg(b'entry', 'text', 'hi')
+        self.assertEqual((arg.name, arg.value), ('text', 'hi'))
+
+    def testKeywords(self):
+        arg = Arg(name='text', value='hi')
+        self.assertEqual((arg.name, arg.value), ('text', 'hi'))
+
+    def testEntryArg(self):
+        entry = Entry(id=b'entry')
+        entry.arg('text', 'hi')
+        self.assertEqual(entry.args['text'].value, 'hi')
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'old.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testOnlyParserIdsAreRewritten(self):
+        parserId = "a&b".encode('utf-16')
+        connection = sqlite3.connect(self.filename)
+        connection.execute("""create table tbl_sched
+            (id blob, cron varchar, state integer, name varchar,
+             handler varchar, status text, primary key (id))""")
+        connection.execute("""create table tbl_sched_args
+            (source_id integer, name varchar, value text,
+             primary key (source_id, name))""")
+        for id in (parserId, b'external'):
+            connection.execute("""insert into tbl_sched
+                values (?, '0 0 0 1 1 * *', 0, '', 'post', '')""", (id,))
+            connection.execute("""insert into tbl_sched_args
+                values (?, 'post', 'hi')""", (id,))
+        connection.commit()
+        connection.close()
+
+        config = Config(self.filename)
+        try:
+            ids = set(entry.id for entry in config.get())
+            self.assertEqual(ids, set([makeId(parserId), b'external']))
+            for id in ids:
+                self.assertEqual(config.getArgs(id)['post'].value, 'hi')
+        finally:
+            config.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
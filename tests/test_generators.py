@@ -0,0 +1,52 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from benchmarks import generators
+from benchmarks.parser import parserOf, writeFiles
+from schedcaster import cron as Cron
+from schedcaster.scheduler import STATE_ONESHOT
+
+
+class GeneratorsTest(unittest.TestCase):
+    def testSameSeedSameEntries(self):
+        def keys(entries):
+            return [(entry.id, entry.cron, entry.state,
+                     sorted((arg.name, arg.value)
+                            for arg in entry.args.values()))
+                    for entry in entries]
+        self.assertEqual(keys(generators.makeEntries(50, 1)),
+                         keys(generators.makeEntries(50, 1)))
+        self.assertNotEqual(keys(generators.makeEntries(50, 1)),
+                            keys(generators.makeEntries(50, 2)))
+
+    def testEntriesMixOneShotsAndRecurring(self):
+        entries = generators.makeEntries(1000)
+        oneShots = [entry for entry in entries
+                    if entry.state & STATE_ONESHOT]
+        self.assertTrue(800 < len(oneShots) < 1000)
+        self.assertEqual(len(set(entry.id for entry in entries)), 1000)
+        for entry in entries:
+            self.assertNotEqual(Cron.compile(entry.cron).nextFireAfter(
+                datetime.datetime.now()), None)
+
+    def testRowsParseInEveryFormat(self):
+        rows = generators.makeRows(100)
+        self.assertEqual([row[1] for row in generators.makeRows(100)],
+                         [row[1] for row in rows])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spec = generators.makeSpec()
+        parsed = {}
+        for format, filename in writeFiles(directory, rows).items():
+            parsed[format] = [(entry.id, entry.cron) for entry in
+                              parserOf(format)(filename, spec)]
+        self.assertEqual(len(parsed['csv']), 100)
+        self.assertEqual(len(set(parsed['csv'])), 100)
+        for format, entries in parsed.items():
+            self.assertEqual(entries, parsed['csv'], format)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import csv
+import os
+import unittest
+
+import schedcaster.scheduler as Scheduler
+from schedcaster.importer import Importer
+from schedcaster.parser import flatfile
+from schedcaster.parser.spec import ColumnSpec, HashSpec, SheetSpec, Spec
+from schedcaster.scheduler import STATE_DONE, STATE_ONESHOT
+from tests.test_config import ConfigTest
+
+SPEC = Spec([SheetSpec('schedule', [ColumnSpec('A', 'name'),
+                                    ColumnSpec('B', '@cron'),
+                                    ColumnSpec('C', 'post')],
+                       HashSpec(['A']))])
+CRON = '0 0 0 1 1 2099 *'
+
+
+class Notified(object):
+    '''Scheduler, that remembers the entries it was notified of'''
+    def __init__(self):
+        self.upserted = []
+        self.removed = []
+
+    def upsertEntry(self, entry):
+        self.upserted.append(entry.args['name'].value)
+
+    def removeEntry(self, id):
+        self.removed.append(id)
+
+
+class ImporterTest(ConfigTest):
+    def setUp(self):
+        ConfigTest.setUp(self)
+        self.schedule = os.path.join(self.directory, 'schedule.csv')
+        self.parsed = 0
+        self.scheduler = Notified()
+        self.importer = Importer(self.config(), self.parse, self.scheduler)
+
+    def parse(self, filename):
+        self.parsed += 1
+        return flatfile.iterParse(filename, SPEC)
+
+    def write(self, rows, mtime=None):
+        with open(self.schedule, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+        if mtime != None:
+            os.utime(self.schedule, (mtime, mtime))
+
+    def importFile(self, **kwargs):
+        '''Imports the schedule
+           :rtype: (inserted, updated, unchanged, removed, skipped)'''
+        self.scheduler.upserted = []
+        self.scheduler.removed = []
+        stats = self.importer.importFile(self.schedule, **kwargs)
+        return (stats.inserted, stats.updated, stats.unchanged,
+                stats.removed, stats.skipped)
+
+    def entries(self):
+        '''Gets entries of the config by name'''
+        return dict((entry.args['name'].value, entry)
+                    for entry in self.importer.config.get())
+
+    def testFirstImportInsertsEverything(self):
+        self.write([['a', CRON, 'first'], ['b', CRON, 'second']])
+        self.assertEqual(self.importFile(), (2, 0, 0, 0, False))
+        self.assertEqual(sorted(self.scheduler.upserted), ['a', 'b'])
+        entries = self.entries()
+        self.assertEqual(entries['b'].args['post'].value, 'second')
+        self.assertEqual(entries['a'].args[Scheduler.ARG_IMPORT].value,
+                         os.path.abspath(self.schedule))
+
+    def testUnchangedFileIsNotParsed(self):
+        self.write([['a', CRON, 'first']], mtime=1000)
+        self.importFile()
+        self.assertEqual(self.importFile(), (0, 0, 0, 0, True))
+        self.assertEqual(self.parsed, 1)
+        self.assertEqual(self.scheduler.upserted, [])
+        # a touched file is compared by content and remembered as is
+        os.utime(self.schedule, (2000, 2000))
+        self.assertEqual(self.importFile(), (0, 0, 0, 0, True))
+        self.assertEqual(self.parsed, 1)
+        self.assertEqual(self.importer.config.getImport(
+            os.path.abspath(self.schedule))[1], 2000)
+
+    def testForcedImportWritesNothingNew(self):
+        self.write([['a', CRON, 'first'], ['b', CRON, 'second']])
+        self.importFile()
+        self.assertEqual(self.importFile(force=True), (0, 0, 2, 0, False))
+        self.assertEqual(self.parsed, 2)
+        self.assertEqual(self.scheduler.upserted, [])
+
+    def testInsertUpdateRemove(self):
+        self.write([['a', CRON, 'first'], ['b', CRON, 'second'],
+                    ['c', CRON, 'third']])
+        self.importFile()
+        ids = dict((name, entry.id)
+                   for name, entry in self.entries().items())
+        self.write([['a', CRON, 'first'], ['c', CRON, 'edited'],
+                    ['d', CRON, 'fourth']])
+        self.assertEqual(self.importFile(), (1, 1, 1, 1, False))
+        self.assertEqual(sorted(self.scheduler.upserted), ['c', 'd'])
+        self.assertEqual(self.scheduler.removed, [ids['b']])
+        entries = self.entries()
+        self.assertEqual(sorted(entries), ['a', 'c', 'd'])
+        # the id comes from the hash columns, so an edit keeps it
+        self.assertEqual(entries['c'].id, ids['c'])
+        self.assertEqual(entries['c'].args['post'].value, 'edited')
+
+    def testLastOfSameIdWins(self):
+        self.write([['a', CRON, 'first'], ['a', CRON, 'second']])
+        self.assertEqual(self.importFile()[:2], (1, 0))
+        self.assertEqual(self.entries()['a'].args['post'].value, 'second')
+        # an edited row is overridden by a later one, that matches the config
+        self.write([['a', CRON, 'third'], ['a', CRON, 'second']])
+        self.assertEqual(self.importFile()[:3], (0, 0, 1))
+        self.assertEqual(self.scheduler.upserted, [])
+
+    def testEditKeepsDoneStateUnlessCronChanged(self):
+        later = '0 0 0 1 1 2098 *'
+        self.write([['a', CRON, 'first'], ['b', CRON, 'second']])
+        self.importFile()
+        config = self.importer.config
+        config.updateMany([(entry.id, {'state': STATE_ONESHOT | STATE_DONE,
+                                       'status': 'fired'})
+                           for entry in config.get()])
+        self.write([['a', CRON, 'edited'], ['b', later, 'second']])
+        self.assertEqual(self.importFile()[:2], (0, 2))
+        entries = self.entries()
+        self.assertTrue(entries['a'].state & STATE_DONE)
+        self.assertEqual(entries['a'].status, 'fired')
+        self.assertFalse(entries['b'].state & STATE_DONE)
+        self.assertEqual(entries['b'].cron, later)
+
+    def testFilesDoNotRemoveEntriesOfEachOther(self):
+        self.write([['a', CRON, 'first']])
+        self.importFile()
+        other = os.path.join(self.directory, 'other.csv')
+        with open(other, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows([['b', CRON, 'second']])
+        stats = self.importer.importFile(other)
+        self.assertEqual((stats.inserted, stats.removed), (1, 0))
+        self.write([])
+        self.assertEqual(self.importFile()[3], 1)
+        self.assertEqual(sorted(self.entries()), ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
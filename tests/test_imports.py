@@ -0,0 +1,42 @@
+import subprocess
+import sys
+import unittest
+
+
+def run(code):
+    '''Runs code in a fresh interpreter, so that nothing is imported yet
+       :rtype: its output'''
+    return subprocess.check_output([sys.executable, '-c', code],
+                                   stderr=subprocess.STDOUT).decode().strip()
+
+
+class LazyImportTest(unittest.TestCase):
+    def testSubmodulesAfterBareImport(self):
+        self.assertEqual(run("import schedcaster\n"
+                             "print(schedcaster.scheduler.Entry.__name__)\n"
+                             "print(schedcaster.config.__name__)"),
+                         "Entry\nschedcaster.config")
+
+    def testSchedulerClass(self):
+        self.assertEqual(run("import schedcaster\n"
+                             "print(schedcaster.Scheduler.__name__)"),
+                         "Scheduler")
+
+    def testUnknownName(self):
+        self.assertEqual(run("import schedcaster\n"
+                             "try:\n"
+                             "    schedcaster.nothing\n"
+                             "except AttributeError as e:\n"
+                             "    print(e)"),
+                         "module 'schedcaster' has no attribute 'nothing'")
+
+    def testBareImportIsLight(self):
+        self.assertEqual(run("import sys, schedcaster\n"
+                             "print(sorted(name for name in sys.modules\n"
+                             "    if name.split('.')[0] in ('schedcaster',\n"
+                             "        'apscheduler', 'openpyxl')))"),
+                         "['schedcaster']")
+
+
+if __name__ == '__main__':
+    unittest.main()
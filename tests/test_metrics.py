@@ -0,0 +1,36 @@
+import time
+import unittest
+
+from schedcaster import metrics as Metrics
+
+
+class MetricTest(unittest.TestCase):
+    def testPlainMetricHasNoSamples(self):
+        metric = Metrics.Metric('plain', labelNames=('kind',))
+        metric.labels('some')
+        self.assertEqual(metric.samples(), [])
+
+    def testTimeIterationSkipsCallerTime(self):
+        histogram = Metrics.Histogram('iteration')
+
+        def slowly():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+        for i in histogram.timeIteration(slowly()):
+            time.sleep(0.05)
+        self.assertEqual(histogram.count(), 1)
+        samples = dict((suffix, value) for suffix, labels, value
+                       in histogram.ownSamples() if suffix == '_sum')
+        self.assertTrue(0.03 <= samples['_sum'] < 0.1, samples['_sum'])
+
+    def testTimeIterationObservesClosed(self):
+        histogram = Metrics.Histogram('iteration')
+        items = histogram.timeIteration(range(10))
+        next(items)
+        items.close()
+        self.assertEqual(histogram.count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from schedcaster.caster.multicaster import Caster
+from schedcaster.caster.outbox import Outbox
+from schedcaster.config.sqlite import Config
+from schedcaster.scheduler import Scheduler, Entry, BACKEND_HEAP
+
+
+class Recorder(object):
+    '''Consumer, that remembers its calls and fails the first ones'''
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def consume(self, post):
+        with self.lock:
+            self.calls.append(post)
+            if len(self.calls) <= self.failures:
+                raise RuntimeError("failed on purpose")
+        return len(self.calls)
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'outbox.db')
+        self.outbox = Outbox(self.filename)
+        self.caster = Caster(outbox=self.outbox)
+
+    def tearDown(self):
+        self.caster.stop()
+        shutil.rmtree(self.directory)
+
+    def testSameFireIsSentOnce(self):
+        consumer = Recorder()
+        self.caster.attach(consumer, key='recorder')
+        self.caster.send(None, "post", entryId=b'entry', due=100.0).wait(5)
+        self.caster.send(None, "post", entryId=b'entry', due=100.0).wait(5)
+        self.assertEqual(consumer.calls, ["post"])
+
+    def testFailedFireIsSentAgain(self):
+        consumer = Recorder(failures=1)
+        self.caster.attach(consumer, key='recorder')
+        self.caster.send(None, "post", entryId=b'entry', due=100.0).wait(5)
+        self.outbox.flush()
+        self.caster.send(None, "post", entryId=b'entry', due=100.0).wait(5)
+        self.assertEqual(consumer.calls, ["post", "post"])
+
+    def testEveryFireOfRecurringEntryIsSent(self):
+        consumer = Recorder()
+        self.caster.attach(consumer, key='recorder')
+        config = Config(self.filename)
+        entry = Entry(id=b'recurring', cron='* * * * * * *', handler='post')
+        entry.arg('post', "tick")
+        config.saveMany([entry])
+
+        scheduler = Scheduler(config, backend=BACKEND_HEAP)
+        scheduler.addHandler('post', lambda post: self.caster.send(None, post))
+        scheduler.start()
+        try:
+            deadline = time.time() + 10
+            while len(consumer.calls) < 2 and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            scheduler.stop()
+            config.close()
+        self.assertGreaterEqual(len(consumer.calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from benchmarks.generators import makeRows
+from schedcaster.parser import officeopenXML
+from schedcaster.parser.spec import ColumnSpec, HashSpec, SheetSpec, Spec, \
+    acceptAll
+from schedcaster.scheduler import ARG_HASH
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+SHEETS = ('first', 'second', 'third')
+
+
+def sheetSpec(name, filterFn=acceptAll):
+    return SheetSpec(name, [ColumnSpec('A', '@cron'),
+                            ColumnSpec('B', 'post', filterFn),
+                            ColumnSpec('C', 'attachments')],
+                     HashSpec(['A', 'B']))
+
+
+def keys(entries):
+    return [(entry.id, entry.cron,
+             sorted((arg.name, arg.value) for arg in entry.args.values()))
+            for entry in entries]
+
+
+@unittest.skipUnless(openpyxl, "openpyxl is not installed")
+class ParallelParseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'schedule.xlsx')
+        # sheets of different sizes, and one, that isn't in the spec
+        wb = openpyxl.Workbook(write_only=True)
+        for name, n, seed in (('first', 150, 1), ('skipped', 10, 2),
+                              ('second', 40, 3), ('third', 1, 4)):
+            sheet = wb.create_sheet(name)
+            for row in makeRows(n, seed):
+                sheet.append(row)
+        wb.save(self.filename)
+        self.spec = Spec([sheetSpec(name) for name in SHEETS])
+        self.expected = keys(officeopenXML.parse(self.filename, self.spec))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testSameEntriesInSameOrder(self):
+        self.assertEqual(len(self.expected), 191)
+        for chunkRows in (None, 1, 7, 1000):
+            self.assertEqual(keys(officeopenXML.iterParseParallel(
+                self.filename, self.spec, 2, chunkRows)), self.expected,
+                chunkRows)
+
+    def testParsesAtOnceKeepTheirSpecs(self):
+        # the second spec gives other args, so a mixed up spec shows
+        specs = [self.spec, Spec([SheetSpec(name, [ColumnSpec('A', '@cron'),
+                                                   ColumnSpec('B', 'text')],
+                                            HashSpec(['A']))
+                                  for name in SHEETS])]
+        names = {}
+
+        def parse(spec):
+            for i in range(3):
+                names.setdefault(id(spec), set()).update(
+                    arg.name for entry in officeopenXML.parseParallel(
+                        self.filename, spec, 2, 50)
+                    for arg in entry.args.values())
+        threads = [threading.Thread(target=parse, args=(spec,))
+                   for spec in specs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        self.assertEqual(names[id(specs[0])],
+                         set(['post', 'attachments', ARG_HASH]))
+        self.assertEqual(names[id(specs[1])], set(['text', ARG_HASH]))
+
+    def testSpecIsPickledWithoutFork(self):
+        spawn = multiprocessing.get_context('spawn')
+        with unittest.mock.patch.object(multiprocessing,
+                                        'get_all_start_methods',
+                                        return_value=['spawn']), \
+             unittest.mock.patch.object(multiprocessing, 'get_context',
+                                        return_value=spawn):
+            entries = officeopenXML.parseParallel(self.filename, self.spec,
+                                                  2, 64)
+        self.assertEqual(keys(entries), self.expected)
+
+    def testUnpicklableSpecIsParsedInThisProcess(self):
+        spec = Spec([sheetSpec(name, lambda value: value != None)
+                     for name in SHEETS])
+        expected = keys(officeopenXML.parse(self.filename, spec))
+        with unittest.mock.patch.object(multiprocessing,
+                                        'get_all_start_methods',
+                                        return_value=['spawn']), \
+             unittest.mock.patch.object(multiprocessing, 'get_context') \
+                as getContext, \
+             self.assertLogs(level='WARNING') as logs:
+            entries = officeopenXML.parseParallel(self.filename, spec, 2)
+        self.assertEqual(keys(entries), expected)
+        self.assertIn("can't be pickled", logs.output[0])
+        self.assertFalse(getContext.return_value.Pool.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import collections
+import datetime
+import glob
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import schedcaster.scheduler as Scheduler
+from schedcaster.config.sqlite import Config
+from schedcaster.config.sharding import ShardLeases
+from benchmarks.generators import cronAt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSES = 3
+SHARDS = 8
+
+
+def work(filename, log, runFor):
+    '''Runs a sharded scheduler in a process of its own, logging every
+       fire as the entry's post and its fire time'''
+    config = Config(filename)
+    leases = ShardLeases(filename, SHARDS, ttl=1.5)
+    out = open("%s.%d" % (log, os.getpid()), 'a', buffering=1)
+    scheduler = Scheduler.Scheduler(config, backend=Scheduler.BACKEND_HEAP,
+                                    sharding=leases, flushInterval=0.2,
+                                    catchUpRate=100, catchUpBurst=10)
+    scheduler.addHandler('post', lambda post: out.write(
+        "%s %d\n" % (post, Scheduler.currentDue())))
+    scheduler.start()
+    time.sleep(runFor)
+    scheduler.stop()
+    config.close()
+
+
+class ShardingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'sched.db')
+        self.log = os.path.join(self.directory, 'fires')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testFiresExactlyOnceAcrossProcesses(self):
+        config = Config(self.filename)
+        entries = []
+        for i in range(60):
+            entry = Scheduler.Entry(id=b'recurring %d' % i,
+                                    cron='* * * * * * *', handler='post')
+            entry.arg('post', 'r%d' % i)
+            entries.append(entry)
+        # due after one of the processes is killed
+        fire = datetime.datetime.now() + datetime.timedelta(seconds=5)
+        for i in range(30):
+            entry = Scheduler.Entry(id=b'one-shot %d' % i, cron=cronAt(fire),
+                                    state=Scheduler.STATE_ONESHOT,
+                                    handler='post')
+            entry.arg('post', 'o%d' % i)
+            entries.append(entry)
+        config.saveMany(entries)
+        config.close()
+
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + sys.path[1:])
+        processes = [subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.filename,
+             self.log, '10'], env=environment, cwd=ROOT)
+            for i in range(PROCESSES)]
+        time.sleep(3)
+        processes[0].send_signal(signal.SIGKILL)
+        killed = time.time()
+        for process in processes:
+            process.wait()
+
+        fires = collections.Counter()
+        for name in glob.glob(self.log + '.*'):
+            with open(name) as f:
+                for line in f:
+                    post, due = line.split()
+                    fires[(post, int(due))] += 1
+        self.assertEqual([fire for fire, n in fires.items() if n > 1], [])
+        oneShots = set(post for post, due in fires if post[0] == 'o')
+        self.assertEqual(len(oneShots), 30)
+        # shards of the killed process are taken over
+        alive = set(post for post, due in fires
+                    if post[0] == 'r' and due > killed + 3)
+        self.assertEqual(len(alive), 60)
+
+    def testLapsedLeaseDoesNotLoseOneShot(self):
+        config = Config(self.filename)
+        fire = datetime.datetime.now() + datetime.timedelta(seconds=2)
+        entry = Scheduler.Entry(id=b'one-shot', cron=cronAt(fire),
+                                state=Scheduler.STATE_ONESHOT, handler='post')
+        entry.arg('post', 'o')
+        config.saveMany([entry])
+
+        leases = ShardLeases(self.filename, SHARDS, ttl=60)
+        scheduler = Scheduler.Scheduler(config,
+                                        backend=Scheduler.BACKEND_HEAP,
+                                        sharding=leases, catchUpRate=10,
+                                        catchUpBurst=10)
+        fired = []
+        done = threading.Event()
+        scheduler.addHandler('post', lambda post: fired.append(post) or
+                             done.set())
+        scheduler.start()
+        try:
+            # the lease lapses, as if renewals failed, before the fire
+            connection = sqlite3.connect(self.filename)
+            connection.execute("""update tbl_leases set expires=0
+                where owner=?""", (leases.owner,))
+            connection.commit()
+            connection.close()
+            time.sleep(3)
+            self.assertEqual(fired, [])
+            # the same owner renews the lease, so no shard changes hands
+            leases.renew()
+            done.wait(5)
+        finally:
+            scheduler.stop()
+            config.close()
+        self.assertEqual(fired, ['o'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        work(sys.argv[1], sys.argv[2], float(sys.argv[3]))
+    else:
+        unittest.main()
@@ -0,0 +1,109 @@
+import json
+import sys
+import threading
+import types
+import unittest
+import unittest.mock
+import urllib.parse
+import urllib.request
+
+from benchmarks.fakevk import FakeVK
+from schedcaster.caster.ratelimit import Throttled
+from schedcaster.consumer.vk import Batcher, postId
+
+
+class VKError(Exception):
+    '''Same as vkontakte.VKError, the only part of vkontakte used here'''
+    def __init__(self, error):
+        Exception.__init__(self, str(error))
+        self.error = error
+
+    @property
+    def code(self):
+        return self.error['error_code']
+
+
+class HTTPAPI(object):
+    '''Calls methods of a VK-like endpoint the way vkontakte.API does,
+       raising VKError for failed calls'''
+    def __init__(self, url, method=''):
+        self.url = url
+        self.method = method
+
+    def __getattr__(self, name):
+        return HTTPAPI(self.url, self.method and self.method + '.' + name
+                       or name)
+
+    def __call__(self, **args):
+        body = urllib.parse.urlencode(args).encode('utf-8')
+        with urllib.request.urlopen(self.url + self.method, body, 10) as f:
+            reply = json.loads(f.read().decode('utf-8'))
+        if 'error' in reply:
+            raise VKError(reply['error'])
+        return reply['response']
+
+
+class BatcherTest(unittest.TestCase):
+    def setUp(self):
+        # the legacy package may be missing, and the tests talk to the fake
+        # server anyway
+        stub = types.ModuleType('vkontakte')
+        stub.VKError = VKError
+        modules = unittest.mock.patch.dict(sys.modules, {'vkontakte': stub})
+        modules.start()
+        self.addCleanup(modules.stop)
+        self.fake = FakeVK(latency=0.01, rejected=["rejected"]).start()
+        self.api = HTTPAPI(self.fake.url)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def post(self, batcher, messages):
+        '''Posts messages from a thread per message
+           :rtype: dict of message => post id or exception'''
+        results = {}
+
+        def post(message):
+            try:
+                results[message] = postId(message,
+                                          batcher.post({'message': message}))
+            except Exception as e:
+                results[message] = e
+        threads = [threading.Thread(target=post, args=(message,))
+                   for message in messages]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results
+
+    def testFullBatchIsOneExecute(self):
+        messages = ["post %d" % i for i in range(5)]
+        results = self.post(Batcher(self.api, size=5, delay=10), messages)
+        self.assertEqual(self.fake.stats()['methods'], {'execute': 1})
+        self.assertEqual(sorted(results.values()), [1, 2, 3, 4, 5])
+
+    def testPartialBatchIsSentAfterDelay(self):
+        results = self.post(Batcher(self.api, size=25, delay=0.1),
+                            ["first", "second"])
+        self.assertEqual(self.fake.stats()['methods'], {'execute': 1})
+        self.assertEqual(sorted(results.values()), [1, 2])
+
+    def testFailedCallFailsOnlyItsPost(self):
+        results = self.post(Batcher(self.api, size=3, delay=10),
+                            ["first", "rejected", "third"])
+        self.assertEqual(self.fake.stats()['methods'], {'execute': 1})
+        self.assertIsInstance(results.pop("rejected"), RuntimeError)
+        self.assertEqual(sorted(results.values()), [1, 2])
+
+    def testThrottledExecuteThrottlesEveryPost(self):
+        self.fake.throttleShare = 1.0
+        results = self.post(Batcher(self.api, size=3, delay=10),
+                            ["first", "second", "third"])
+        self.assertEqual(self.fake.stats()['throttled'], 1)
+        for result in results.values():
+            self.assertIsInstance(result, Throttled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+
+from schedcaster.config.writebehind import WriteBehind
+from schedcaster.scheduler import Entry
+from tests.test_config import ConfigTest
+
+
+class Recorder(object):
+    '''Config, that remembers calls of updateMany and fails the first ones'''
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []  # (dict of updates, track)
+        self.condition = threading.Condition()
+
+    def updateMany(self, updates, track=True):
+        updates = dict((id, dict(columns)) for id, columns in updates)
+        with self.condition:
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError("failed on purpose")
+            self.calls.append((updates, track))
+            self.condition.notify_all()
+        return len(updates)
+
+    def waitFor(self, n, timeout=5):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.calls) >= n, timeout)
+            return list(self.calls)
+
+
+class WriteBehindTest(unittest.TestCase):
+    def writer(self, config, **kwargs):
+        writer = WriteBehind(config, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def testUpdatesAreMerged(self):
+        config = Recorder()
+        writer = self.writer(config, interval=60)
+        writer.put(b'a', {'state': 1})
+        writer.put(b'a', {'status': 'fired'})
+        writer.put(b'a', {'state': 3})
+        writer.put(b'b', {'state': 1})
+        self.assertEqual(config.calls, [])
+        writer.flush()
+        self.assertEqual(config.calls,
+                         [({b'a': {'state': 3, 'status': 'fired'},
+                            b'b': {'state': 1}}, True)])
+        self.assertEqual(writer.stats(), {'pending': 0, 'flushes': 1,
+                                          'written': 2})
+
+    def testFlushesOnceFull(self):
+        config = Recorder()
+        writer = self.writer(config, maxSize=3, interval=60)
+        for id in (b'a', b'b', b'a', b'c'):
+            writer.put(id, {'state': 1})
+        calls = config.waitFor(1)
+        self.assertEqual(sorted(calls[0][0]), [b'a', b'b', b'c'])
+
+    def testFlushesAfterInterval(self):
+        config = Recorder()
+        writer = self.writer(config, interval=0.1)
+        started = time.time()
+        writer.put(b'a', {'state': 1})
+        self.assertEqual(len(config.waitFor(1)), 1)
+        self.assertTrue(time.time() - started < 2)
+
+    def testZeroIntervalWritesAtOnce(self):
+        config = Recorder()
+        writer = self.writer(config, interval=0, track=False)
+        writer.put(b'a', {'state': 1})
+        self.assertEqual(config.calls, [({b'a': {'state': 1}}, False)])
+        self.assertEqual(writer.stats()['pending'], 0)
+
+    def testFailedFlushKeepsUpdatesUnderNewerOnes(self):
+        config = Recorder(failures=1)
+        writer = self.writer(config, interval=60)
+        writer.put(b'a', {'state': 1, 'status': 'old'})
+        self.assertRaises(RuntimeError, writer.flush)
+        writer.put(b'a', {'state': 2})
+        writer.flush()
+        self.assertEqual(config.calls, [({b'a': {'state': 2,
+                                                 'status': 'old'}}, True)])
+
+    def testCloseWritesPendingAndMayBeReused(self):
+        config = Recorder()
+        writer = self.writer(config, interval=60)
+        writer.put(b'a', {'state': 1})
+        writer.close()
+        self.assertEqual(len(config.calls), 1)
+        writer.put(b'b', {'state': 1})
+        writer.close()
+        self.assertEqual([sorted(updates) for updates, track in config.calls],
+                         [[b'a'], [b'b']])
+
+    def testFlushesAreInOrder(self):
+        config = Recorder()
+        writer = self.writer(config, maxSize=1, interval=60)
+        for state in range(50):
+            writer.put(b'a', {'state': state})
+        writer.flush()
+        states = [updates[b'a']['state'] for updates, track in config.calls]
+        self.assertEqual(states, sorted(states))
+        self.assertEqual(states[-1], 49)
+
+
+class ConfigWriteBehindTest(ConfigTest):
+    def testWritesToConfig(self):
+        config = self.config()
+        config.saveMany([Entry(id=b'a', cron='0 0 0 1 1 * *'),
+                         Entry(id=b'b', cron='0 0 0 1 1 * *')])
+        counter = config.changeCounter()
+        writer = WriteBehind(config, interval=60, track=False)
+        writer.put(b'a', {'status': 'fired'})
+        writer.put(b'b', {'status': 'expired'})
+        writer.close()
+        self.assertEqual(dict((entry.id, entry.status)
+                              for entry in config.get()),
+                         {b'a': 'fired', b'b': 'expired'})
+        self.assertEqual(config.changeCounter(), counter)
+
+
+if __name__ == '__main__':
+    unittest.main()